@@ -7,20 +7,137 @@ IAMI 专属 Agent 系统
 3. IAMIAnalysisAgent - 分析模式（生成洞察）
 """
 
+import io
 import os
+import re
 import json
+import mmap
 import logging
 import asyncio
+import functools
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple, Type
 from datetime import datetime
 from langchain_openai import ChatOpenAI
+from langchain_core.messages import SystemMessage, HumanMessage
+from pydantic import BaseModel
 from graphrag.indexer.hybrid_indexer import HybridIndexer
 from graphrag.llm_providers import create_llm, LLMProviderFactory
 
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import ijson
+    IJSON_AVAILABLE = True
+except ImportError:
+    IJSON_AVAILABLE = False
+
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# 支持 JSON 模式（response_format=json_object）的服务商，其余回退到文本解析
+_JSON_MODE_PROVIDERS = {"deepseek", "glm", "openai"}
+
+# LLM 返回的 JSON 常被包裹在 ```json 代码块中
+_JSON_FENCE = re.compile(r"```(?:json)?\s*(\{.*\}|\[.*\])\s*```", re.DOTALL)
+
+
+def _extract_json(text: str) -> str:
+    """提取 LLM 响应中的 JSON 文本（去除代码块包裹）"""
+    stripped = text.strip()
+    if stripped[:1] in ("{", "["):
+        # 没有代码块包裹（JSON 模式的常见情况），无需正则扫描
+        return stripped
+    m = _JSON_FENCE.search(text)
+    return m.group(1) if m else stripped
+
+
+# 历史记录中对 LLM 有用的字段，其余（时间戳、证据等）在提示词中省略
+_COMPACT_HISTORY_KEYS = ("trait", "value", "confidence", "value_type", "description", "pattern")
+_EMPTY_VALUES = (None, "", [], {})
+
+
+def _compact_memories(node: Any) -> Any:
+    """
+    生成用于提示词的紧凑记忆视图
+
+    去掉 _meta、空值和空容器，历史记录只保留 _COMPACT_HISTORY_KEYS 中的字段。
+    """
+    if isinstance(node, dict):
+        compact = {}
+        for key, value in node.items():
+            if key == "_meta":
+                continue
+            if key == "history" and isinstance(value, list):
+                value = [
+                    {k: item[k] for k in _COMPACT_HISTORY_KEYS if item.get(k) is not None}
+                    for item in value if isinstance(item, dict)
+                ]
+            else:
+                value = _compact_memories(value)
+            if value not in _EMPTY_VALUES:
+                compact[key] = value
+        return compact
+
+    if isinstance(node, list):
+        items = (_compact_memories(item) for item in node)
+        return [item for item in items if item not in _EMPTY_VALUES]
+
+    return node
+
+
+def _lenient_json(text: str) -> Dict[str, Any]:
+    """
+    宽松解析可能被截断的 JSON 对象（需要 ijson）
+
+    LLM 输出超过 max_tokens 时结尾会被截断，这里返回已完整到达的顶层字段。
+    """
+    start = text.find("{")
+    if not IJSON_AVAILABLE or start == -1:
+        return {}
+
+    items = {}
+    try:
+        for key, value in ijson.kvitems(io.BytesIO(text[start:].encode("utf-8")), "", use_float=True):
+            items[key] = value
+    except ijson.JSONError:
+        pass
+    return items
+
+
+# 本进程中已确认存在的目录，避免每次写文件都发起 mkdir 系统调用
+_READY_DIRS: set = set()
+
+
+def _ensure_dir(path: Path):
+    """确保目录存在（每个目录每个进程只创建一次）"""
+    if path not in _READY_DIRS:
+        path.mkdir(parents=True, exist_ok=True)
+        _READY_DIRS.add(path)
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_llm(provider: Optional[str]) -> ChatOpenAI:
+    """同一服务商的 LLM 客户端在进程内共享，复用其 HTTP 连接池"""
+    return create_llm(provider)
+
+
+def _dumps_compact(data: Any) -> str:
+    """无缩进的 JSON 序列化（用于提示词和紧凑存储）"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
 
 class IAMIBaseAgent:
     """IAMI 代理基类"""
@@ -44,7 +161,8 @@ class IAMIBaseAgent:
         self.base_user_dir = Path(f"data/users/{self.user_id}")
 
         # 使用统一的LLM配置系统
-        self.llm = create_llm(llm_provider)
+        self.llm_provider = (llm_provider or os.getenv("LLM_PROVIDER", "deepseek")).lower()
+        self.llm = _shared_llm(llm_provider)
 
         # 批量Token记录队列
         self._pending_usage_records = []
@@ -52,19 +170,31 @@ class IAMIBaseAgent:
         self._flush_interval = 10  # 每10条记录批量写入一次
         self._max_pending_records = 50  # 最多缓存50条记录
 
-    async def invoke_llm(self, prompt: str, call_type: str = "unknown"):
+    async def invoke_llm(
+        self,
+        prompt: str,
+        call_type: str = "unknown",
+        system_prompt: Optional[str] = None
+    ):
         """
         调用 LLM 并记录 Token 使用情况
 
         Args:
-            prompt: 提示词
+            prompt: 提示词（每次调用变化的部分）
             call_type: 调用类型标识（用于统计）
+            system_prompt: 固定的系统提示词（可选）。内容保持字节级不变时，
+                        服务端的前缀缓存可以跨调用复用
 
         Returns:
             LLM响应对象
         """
+        if system_prompt:
+            llm_input = [SystemMessage(content=system_prompt), HumanMessage(content=prompt)]
+        else:
+            llm_input = prompt
+
         try:
-            response = await self.llm.ainvoke(prompt)
+            response = await self.llm.ainvoke(llm_input)
         except Exception as e:
             logger.error(f"LLM invocation failed for call_type '{call_type}': {e}")
             raise
@@ -78,6 +208,82 @@ class IAMIBaseAgent:
 
         return response
 
+    def _supports_structured_output(self) -> bool:
+        """当前服务商是否支持 JSON 模式"""
+        return (
+            self.llm_provider in _JSON_MODE_PROVIDERS
+            and hasattr(self.llm, "with_structured_output")
+        )
+
+    async def invoke_llm_structured(
+        self,
+        prompt: str,
+        schema: Type[BaseModel],
+        call_type: str = "unknown",
+        system_prompt: Optional[str] = None
+    ) -> Tuple[Optional[Dict[str, Any]], Any]:
+        """
+        调用 LLM 并按 schema 解析 JSON 输出
+
+        支持 JSON 模式的服务商直接返回结构化结果；其余服务商回退到
+        去除代码块后 json.loads 的文本解析。
+
+        Returns:
+            (解析后的字典, 原始响应)；解析失败时字典为 None
+        """
+        if not self._supports_structured_output():
+            response = await self.invoke_llm(prompt, call_type=call_type, system_prompt=system_prompt)
+            return self._parse_json_output(response.content, schema, call_type), response
+
+        if system_prompt:
+            llm_input = [SystemMessage(content=system_prompt), HumanMessage(content=prompt)]
+        else:
+            llm_input = prompt
+
+        structured_llm = self.llm.with_structured_output(
+            schema, method="json_mode", include_raw=True
+        )
+        try:
+            result = await structured_llm.ainvoke(llm_input)
+        except Exception as e:
+            logger.error(f"LLM invocation failed for call_type '{call_type}': {e}")
+            raise
+
+        response = result["raw"]
+        try:
+            await self._queue_usage_record(response, call_type)
+        except Exception as e:
+            logger.warning(f"Token usage recording failed: {e}")
+
+        if result.get("parsing_error") or result.get("parsed") is None:
+            logger.warning(f"Failed to parse {call_type} response: {result.get('parsing_error')}")
+            return self._parse_json_output(response.content, schema, call_type), response
+
+        return result["parsed"].model_dump(), response
+
+    @staticmethod
+    def _parse_json_output(
+        text: str,
+        schema: Type[BaseModel],
+        call_type: str = "unknown"
+    ) -> Optional[Dict[str, Any]]:
+        """按 schema 解析 LLM 文本输出中的 JSON，截断时尽量恢复已到达的字段，失败返回 None"""
+        try:
+            # pydantic-core 一次完成 JSON 解析与校验，不经过中间的 json.loads 字典
+            return schema.model_validate_json(_extract_json(text)).model_dump()
+        except ValueError as e:
+            logger.warning(f"Failed to parse {call_type} response: {e}")
+
+        partial = _lenient_json(text)
+        if not partial:
+            return None
+        try:
+            data = schema.model_validate(partial).model_dump()
+        except ValueError:
+            return None
+        logger.warning(f"Recovered {len(partial)} fields from truncated {call_type} response")
+        return data
+
     async def _queue_usage_record(self, response, call_type: str):
         """将使用记录加入队列，等待批量写入"""
         async with self._usage_lock:
@@ -151,13 +357,29 @@ class IAMIBaseAgent:
         if not path.exists():
             return {}
 
+        if ORJSON_AVAILABLE:
+            return orjson.loads(path.read_bytes())
+
         with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
 
-    def _save_json_file(self, file_path: str, data: Dict[str, Any]):
-        """保存 JSON 文件"""
+    def _save_json_file(self, file_path: str, data: Dict[str, Any], compact: bool = False):
+        """
+        保存 JSON 文件
+
+        Args:
+            compact: 不缩进写入，用于只由程序读写、持续增长的状态文件
+        """
         path = Path(file_path)
-        path.parent.mkdir(parents=True, exist_ok=True)
+        _ensure_dir(path.parent)
+
+        if compact:
+            path.write_text(_dumps_compact(data), encoding='utf-8')
+            return
+
+        if ORJSON_AVAILABLE:
+            path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+            return
 
         with open(path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
@@ -295,6 +517,9 @@ class IAMILearningAgent(IAMIBaseAgent):
 4. **开放性**：鼓励用户进行叙述性回答，以便提取更多细节。
 """
 
+        # 已问问题每行一条，比缩进 JSON 少很多 token
+        asked_lines = "\n".join(f"- {text}" for text in already_asked_texts)
+
         # 构建提示词
         prompt = f"""你是 IAMI 系统的学习代理。你的任务是生成一个具体的、基于真实情境的{ "选择题" if question_type == "mcq" else "描述性问题" }，用于了解用户的{category}。
 
@@ -311,7 +536,7 @@ class IAMILearningAgent(IAMIBaseAgent):
 {profile_context}
 
 ## 已问过的问题（避免重复）
-{json.dumps(already_asked_texts, ensure_ascii=False, indent=2)}
+{asked_lines or "无"}
 
 ## 额外上下文
 {context or "无"}
@@ -330,15 +555,8 @@ class IAMILearningAgent(IAMIBaseAgent):
         response = await self.invoke_llm(prompt, call_type="learning_generate_question")
 
         try:
-            # 解析 JSON
-            content = response.content
-            # 提取 JSON（可能被包裹在代码块中）
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
-
-            question_data = json.loads(content)
+            # 解析 JSON（可能被包裹在代码块中）
+            question_data = json.loads(_extract_json(response.content))
 
             # 添加元数据
             question_data["timestamp"] = datetime.now().isoformat()
@@ -364,7 +582,7 @@ class IAMILearningAgent(IAMIBaseAgent):
                     "created_at": datetime.now().isoformat()
                 }
                 current_pool["questions"].append(pool_entry)
-                self._save_json_file(shared_pool_file, current_pool)
+                self._save_json_file(shared_pool_file, current_pool, compact=True)
             # --- End Save ---
 
             return question_data
@@ -460,13 +678,7 @@ class IAMILearningAgent(IAMIBaseAgent):
         response = await self.invoke_llm(prompt, call_type="learning_analyze_answer")
 
         try:
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
-
-            analysis = json.loads(content)
+            analysis = json.loads(_extract_json(response.content))
 
             # 添加元数据
             analysis["question_id"] = question.get("id")
@@ -556,7 +768,7 @@ class IAMILearningAgent(IAMIBaseAgent):
         # 保存对话记录
         conv_file = str(self.base_user_dir / f"memory/conversations/learning_{timestamp.split('T')[0]}.md")
         conv_path = Path(conv_file)
-        conv_path.parent.mkdir(parents=True, exist_ok=True)
+        _ensure_dir(conv_path.parent)
 
         with open(conv_path, 'a', encoding='utf-8') as f:
             f.write(f"\n## {timestamp}\n\n")
@@ -603,7 +815,7 @@ class IAMILearningAgent(IAMIBaseAgent):
             }
         })
 
-        self._save_json_file(self.questions_file, asked_history)
+        self._save_json_file(self.questions_file, asked_history, compact=True)
         results["updated_files"].append(self.questions_file)
 
         return results
@@ -678,7 +890,7 @@ class IAMILearningAgent(IAMIBaseAgent):
         asked_history["questions"] = [q for q in asked_history["questions"] if q.get("timestamp") != timestamp]
         
         if len(asked_history["questions"]) < initial_count:
-            self._save_json_file(self.questions_file, asked_history)
+            self._save_json_file(self.questions_file, asked_history, compact=True)
             return True
         return False
 
@@ -823,12 +1035,7 @@ class IAMILearningAgent(IAMIBaseAgent):
         response = await self.llm.ainvoke(prompt)
 
         try:
-            import json
-            result_content = response.content
-            if "```json" in result_content:
-                result_content = result_content.split("```json")[1].split("```")[0].strip()
-
-            analysis = json.loads(result_content)
+            analysis = json.loads(_extract_json(response.content))
             return analysis
         except:
             return {
@@ -864,11 +1071,8 @@ class IAMISimulationAgent(IAMIBaseAgent):
         Returns:
             模拟回答及元数据
         """
-        # 读取所有记忆
-        memories = await self._load_all_memories(use_latest_only)
-
-        # 构建人物画像摘要
-        profile_summary = self._build_profile_summary(memories)
+        # 构建人物画像摘要（记忆文件未变化时直接复用缓存）
+        profile_summary = await self._get_profile_summary(use_latest_only)
 
         # 使用混合检索器获取相关记忆
         relevant_context = ""
@@ -918,15 +1122,13 @@ class IAMISimulationAgent(IAMIBaseAgent):
             "simulated_response": response.content,
             "profile_summary": profile_summary,
             "timestamp": datetime.now().isoformat(),
-            "memories_used": len(memories),
+            "memories_used": len(self._memory_files()),
             "retrieval_context_length": len(relevant_context)
         }
 
-    async def _load_all_memories(self, use_latest_only: bool) -> Dict[str, Any]:
-        """加载所有记忆文件"""
-        memories = {}
-
-        memory_files = {
+    def _memory_files(self) -> Dict[str, str]:
+        """长期记忆文件路径"""
+        return {
             "personality": str(self.base_user_dir / "memory/long_term/personality.json"),
             "values": str(self.base_user_dir / "memory/long_term/values.json"),
             "thinking_patterns": str(self.base_user_dir / "memory/long_term/thinking_patterns.json"),
@@ -934,9 +1136,72 @@ class IAMISimulationAgent(IAMIBaseAgent):
             "knowledge": str(self.base_user_dir / "memory/long_term/knowledge.json")
         }
 
-        for key, file_path in memory_files.items():
-            data = self._load_json_file(file_path)
+    async def _get_profile_summary(self, use_latest_only: bool) -> str:
+        """
+        获取人物画像摘要
+
+        摘要缓存在 cache/profile_summary.msgpack 中，并记录源文件的 mtime；
+        只有源文件发生变化时才重新解析 JSON 并构建摘要。
+        """
+        source_mtimes = []
+        for file_path in self._memory_files().values():
+            try:
+                source_mtimes.append(os.stat(file_path).st_mtime_ns)
+            except FileNotFoundError:
+                source_mtimes.append(0)
+
+        cache_file = self.base_user_dir / "cache/profile_summary.msgpack"
+        cached = self._read_summary_cache(cache_file)
+        if (cached
+                and cached.get("mtime_sources") == source_mtimes
+                and cached.get("use_latest_only") == use_latest_only):
+            return cached["summary"]
 
+        memories = await self._load_all_memories(use_latest_only)
+        summary = self._build_profile_summary(memories)
+
+        self._write_summary_cache(cache_file, {
+            "mtime_sources": source_mtimes,
+            "use_latest_only": use_latest_only,
+            "summary": summary
+        })
+        return summary
+
+    def _read_summary_cache(self, cache_file: Path) -> Optional[Dict[str, Any]]:
+        """读取摘要缓存，缓存不可用时返回 None"""
+        if not MSGPACK_AVAILABLE or not cache_file.exists():
+            return None
+
+        try:
+            with open(cache_file, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return msgpack.unpackb(mm, raw=False)
+        except (OSError, ValueError, msgpack.UnpackException) as e:
+            logger.warning(f"Failed to read profile summary cache: {e}")
+            return None
+
+    def _write_summary_cache(self, cache_file: Path, data: Dict[str, Any]):
+        """写入摘要缓存（失败不影响主流程）"""
+        if not MSGPACK_AVAILABLE:
+            return
+
+        try:
+            _ensure_dir(cache_file.parent)
+            cache_file.write_bytes(msgpack.packb(data, use_bin_type=True))
+        except OSError as e:
+            logger.warning(f"Failed to write profile summary cache: {e}")
+
+    async def _load_all_memories(self, use_latest_only: bool) -> Dict[str, Any]:
+        """加载所有记忆文件（各文件在线程池中并发读取）"""
+        memories = {}
+        files = self._memory_files()
+        loop = asyncio.get_running_loop()
+        loaded = await asyncio.gather(*[
+            loop.run_in_executor(None, self._load_json_file, file_path)
+            for file_path in files.values()
+        ])
+
+        for key, data in zip(files, loaded):
             if use_latest_only and "history" in data:
                 # 只取最近的记录
                 data["history"] = sorted(
@@ -997,7 +1262,7 @@ class IAMIAnalysisAgent(IAMIBaseAgent):
         prompt = f"""基于以下记忆数据，生成一个综合的人物画像分析。
 
 ## 记忆数据
-{json.dumps(memories, ensure_ascii=False, indent=2)}
+{_dumps_compact(_compact_memories(memories))}
 
 请提供：
 1. **核心性格特征**（Big Five 维度）
@@ -1013,11 +1278,7 @@ class IAMIAnalysisAgent(IAMIBaseAgent):
         response = await self.invoke_llm(prompt, call_type="analysis_profile")
 
         try:
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-
-            profile = json.loads(content)
+            profile = json.loads(_extract_json(response.content))
             profile["generated_at"] = datetime.now().isoformat()
 
             # 保存
@@ -1046,7 +1307,7 @@ class IAMIAnalysisAgent(IAMIBaseAgent):
         prompt = f"""分析用户思想的演变过程。
 
 ## 时间快照
-{json.dumps(snapshots, ensure_ascii=False, indent=2)}
+{_dumps_compact(_compact_memories(snapshots.get("snapshots", [])))}
 
 请识别：
 1. 主要变化维度（性格、价值观、思维方式等）
@@ -1060,11 +1321,7 @@ class IAMIAnalysisAgent(IAMIBaseAgent):
         response = await self.invoke_llm(prompt, call_type="analysis_evolution")
 
         try:
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-
-            evolution = json.loads(content)
+            evolution = json.loads(_extract_json(response.content))
             evolution["analyzed_at"] = datetime.now().isoformat()
 
             return evolution
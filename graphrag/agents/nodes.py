@@ -6,6 +6,7 @@ This module contains individual node functions for the retrieval workflow.
 
 import os
 import logging
+from functools import lru_cache
 from typing import Dict, Any, List
 from langchain_openai import ChatOpenAI
 from graphrag.llm_providers import create_llm
@@ -14,10 +15,18 @@ from graphrag.llm_providers import create_llm
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=4)
+def _create_llm_cached(provider: str = None):
+    """按 provider 缓存 create_llm 的结果（抛出异常时不缓存）"""
+    return create_llm(provider)
+
+
 # Initialize LLM - 使用统一的配置系统
 def get_llm(provider: str = None):
     """
-    获取 LLM 实例
+    获取 LLM 实例（按 provider 缓存，复用底层 HTTP 连接池）
+
+    只缓存成功创建的实例；创建失败时返回回退配置且不缓存，下次调用会重试。
 
     Args:
         provider: LLM提供者名称 (None 则使用环境变量 LLM_PROVIDER)
@@ -26,9 +35,9 @@ def get_llm(provider: str = None):
         ChatOpenAI 实例
     """
     try:
-        return create_llm(provider)
+        return _create_llm_cached(provider)
     except Exception as e:
-        logger.error(f"Failed to create LLM: {e}")
+        logger.error("Failed to create LLM: %s", e)
         # 回退到默认配置
         return ChatOpenAI(
             model="deepseek-chat",
@@ -117,11 +126,13 @@ async def retrieve_lightrag_node(state: Dict[str, Any]) -> Dict[str, Any]:
             state["lightrag_docs"] = []
 
     except (ConnectionError, TimeoutError) as e:
-        logger.error(f"LightRAG connection/timeout error: {e}")
+        logger.error("LightRAG connection/timeout error: %s", e)
         state["lightrag_docs"] = []
+        state["error"] = True
     except Exception as e:
-        logger.warning(f"LightRAG retrieval error: {e}")
+        logger.warning("LightRAG retrieval error: %s", e)
         state["lightrag_docs"] = []
+        state["error"] = True
 
     return state
 
@@ -148,11 +159,13 @@ async def retrieve_chromadb_node(state: Dict[str, Any]) -> Dict[str, Any]:
         state["chromadb_docs"] = results
 
     except (ConnectionError, TimeoutError) as e:
-        logger.error(f"ChromaDB connection/timeout error: {e}")
+        logger.error("ChromaDB connection/timeout error: %s", e)
         state["chromadb_docs"] = []
+        state["error"] = True
     except Exception as e:
-        logger.warning(f"ChromaDB retrieval error: {e}")
+        logger.warning("ChromaDB retrieval error: %s", e)
         state["chromadb_docs"] = []
+        state["error"] = True
 
     return state
 
@@ -176,10 +189,8 @@ async def evaluate_relevance_node(state: Dict[str, Any]) -> Dict[str, Any]:
     # Add LightRAG results (assume high relevance)
     for doc in lightrag_docs:
         if doc.get("content"):
-            relevant_docs.append({
-                **doc,
-                "relevance_score": 0.9  # High default score for graph results
-            })
+            doc["relevance_score"] = 0.9  # High default score for graph results
+            relevant_docs.append(doc)
 
     # Add ChromaDB results with their similarity scores
     for doc in chromadb_docs:
@@ -190,10 +201,8 @@ async def evaluate_relevance_node(state: Dict[str, Any]) -> Dict[str, Any]:
         # Adjust threshold based on metric
         # For cosine distance, lower is better
         if similarity < 1.5:  # Threshold for relevance
-            relevant_docs.append({
-                **doc,
-                "relevance_score": 1.0 / (1.0 + similarity)  # Convert distance to similarity
-            })
+            doc["relevance_score"] = 1.0 / (1.0 + similarity)  # Convert distance to similarity
+            relevant_docs.append(doc)
 
     # Sort by relevance score
     relevant_docs.sort(key=lambda x: x.get("relevance_score", 0), reverse=True)
@@ -215,19 +224,13 @@ async def generate_answer_node(state: Dict[str, Any]) -> Dict[str, Any]:
         state["final_answer"] = "抱歉，我没有找到相关信息来回答这个问题。"
         return state
 
-    # Prepare context from relevant documents
-    context_parts = []
-
-    for i, doc in enumerate(relevant_docs[:5], 1):  # Use top 5 results
-        content = doc.get("content", "")
-        source = doc.get("source", "unknown")
-        score = doc.get("relevance_score", 0)
-
-        context_parts.append(
-            f"[来源 {i} - {source} - 相关度: {score:.2f}]\n{content}\n"
-        )
-
-    context = "\n---\n".join(context_parts)
+    # Prepare context from relevant documents (top 5 results)
+    top_docs = relevant_docs[:5]
+    context = "\n---\n".join(
+        f"[来源 {i} - {doc.get('source', 'unknown')} - 相关度: {doc.get('relevance_score', 0):.2f}]\n"
+        f"{doc.get('content', '')}\n"
+        for i, doc in enumerate(top_docs, 1)
+    )
 
     # Generate answer using LLM
     llm = get_llm()
@@ -246,11 +249,13 @@ async def generate_answer_node(state: Dict[str, Any]) -> Dict[str, Any]:
         response = await llm.ainvoke(prompt)
         state["final_answer"] = response.content
     except (ConnectionError, TimeoutError) as e:
-        logger.error(f"LLM connection/timeout error: {e}")
+        logger.error("LLM connection/timeout error: %s", e)
         state["final_answer"] = "抱歉，网络连接出现问题，请稍后重试。"
+        state["error"] = True
     except Exception as e:
-        logger.error(f"Answer generation error: {e}")
+        logger.error("Answer generation error: %s", e)
         state["final_answer"] = f"生成答案时出错: {str(e)}"
+        state["error"] = True
 
     return state
 
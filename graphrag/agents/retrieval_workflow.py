@@ -6,15 +6,21 @@ It orchestrates retrieval from multiple sources (LightRAG + ChromaDB)
 and intelligently routes queries based on content type.
 """
 
+import copy
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
 from typing import TypedDict, Annotated, Dict, Any, List
 from langgraph.graph import StateGraph, END
+from graphrag.indexer import run_sync
 from .nodes import (
     plan_query_node,
     retrieve_lightrag_node,
     retrieve_chromadb_node,
     evaluate_relevance_node,
     generate_answer_node,
-    should_retrieve_chromadb
+    should_retrieve_chromadb,
+    should_retrieve_lightrag
 )
 
 
@@ -42,6 +48,9 @@ class RetrievalState(TypedDict):
     # Output
     final_answer: str
 
+    # Set by any node that fell back after an exception
+    error: bool
+
 
 def build_retrieval_workflow() -> StateGraph:
     """
@@ -49,7 +58,7 @@ def build_retrieval_workflow() -> StateGraph:
 
     Workflow:
     1. Plan Query → Analyze query and determine retrieval strategy
-    2. Retrieve (LightRAG) → Get graph-based knowledge
+    2. Retrieve (LightRAG) → Get graph-based knowledge (skipped when the plan disables it)
     3. Retrieve (ChromaDB) → Get vector-based conversations
     4. Evaluate Relevance → Score and filter results
     5. Generate Answer → Create final response
@@ -71,8 +80,15 @@ def build_retrieval_workflow() -> StateGraph:
     workflow.set_entry_point("plan_query")
 
     # Add edges
-    # Plan → Retrieve LightRAG
-    workflow.add_edge("plan_query", "retrieve_lightrag")
+    # Plan → LightRAG, or straight to ChromaDB when LightRAG is disabled
+    workflow.add_conditional_edges(
+        "plan_query",
+        should_retrieve_lightrag,
+        {
+            "retrieve_lightrag": "retrieve_lightrag",
+            "retrieve_chromadb": "retrieve_chromadb"
+        }
+    )
 
     # LightRAG → ChromaDB (conditional)
     workflow.add_conditional_edges(
@@ -96,13 +112,28 @@ def build_retrieval_workflow() -> StateGraph:
     return workflow.compile()
 
 
+@lru_cache(maxsize=1)
+def _get_compiled_workflow():
+    """
+    Return the shared compiled workflow.
+
+    The graph topology is static and the indexer travels in the state,
+    so one compiled graph can serve every AdaptiveRAGAgent instance.
+    """
+    return build_retrieval_workflow()
+
+
 class AdaptiveRAGAgent:
     """
     High-level agent interface for adaptive RAG queries.
 
     This wraps the LangGraph workflow with a simple API.
+    Answers are cached per (query, indexer version), so repeated queries
+    skip retrieval and generation until the indexer ingests new documents.
     """
 
+    CACHE_MAXSIZE = 128
+
     def __init__(self, indexer):
         """
         Initialize the agent.
@@ -111,7 +142,16 @@ class AdaptiveRAGAgent:
             indexer: HybridIndexer instance
         """
         self.indexer = indexer
-        self.workflow = build_retrieval_workflow()
+        self.workflow = _get_compiled_workflow()
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def _cache_key(self, query: str) -> str:
+        digest = hashlib.blake2b(query.encode("utf-8"), digest_size=16).hexdigest()
+        return f"{digest}:{getattr(self.indexer, 'version', 0)}"
+
+    def clear_cache(self):
+        """Drop all cached answers."""
+        self._cache.clear()
 
     async def query(self, query: str) -> Dict[str, Any]:
         """
@@ -126,6 +166,12 @@ class AdaptiveRAGAgent:
             - relevant_docs: Retrieved documents
             - query_plan: Execution plan
         """
+        key = self._cache_key(query)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return copy.deepcopy(cached)
+
         # Initialize state
         initial_state = {
             "query": query,
@@ -135,14 +181,14 @@ class AdaptiveRAGAgent:
             "chromadb_docs": [],
             "relevant_docs": [],
             "has_sufficient_results": False,
-            "final_answer": ""
+            "final_answer": "",
+            "error": False
         }
 
         # Run workflow
         final_state = await self.workflow.ainvoke(initial_state)
 
-        # Return results
-        return {
+        result = {
             "query": query,
             "final_answer": final_state.get("final_answer", ""),
             "relevant_docs": final_state.get("relevant_docs", []),
@@ -150,6 +196,15 @@ class AdaptiveRAGAgent:
             "num_results": len(final_state.get("relevant_docs", []))
         }
 
+        # Only cache real answers: empty retrievals and error fallbacks
+        # should be retried on the next call, not served until reindex.
+        if result["relevant_docs"] and not final_state.get("error"):
+            self._cache[key] = copy.deepcopy(result)
+            if len(self._cache) > self.CACHE_MAXSIZE:
+                self._cache.popitem(last=False)
+
+        return result
+
     async def stream_query(self, query: str):
         """
         Stream the workflow execution (for observability).
@@ -168,7 +223,8 @@ class AdaptiveRAGAgent:
             "chromadb_docs": [],
             "relevant_docs": [],
             "has_sufficient_results": False,
-            "final_answer": ""
+            "final_answer": "",
+            "error": False
         }
 
         async for state in self.workflow.astream(initial_state):
@@ -177,12 +233,15 @@ class AdaptiveRAGAgent:
 
 # Synchronous wrapper
 class AdaptiveRAGAgentSync:
-    """Synchronous version of AdaptiveRAGAgent"""
+    """
+    Synchronous version of AdaptiveRAGAgent.
+
+    Runs on the process-wide background loop shared with HybridIndexerSync,
+    so HTTP keep-alive connections stay warm across calls.
+    """
 
     def __init__(self, indexer):
-        import asyncio
         self.agent = AdaptiveRAGAgent(indexer)
-        self.loop = asyncio.get_event_loop()
 
     def query(self, query: str) -> Dict[str, Any]:
         """
@@ -194,8 +253,7 @@ class AdaptiveRAGAgentSync:
         Returns:
             Query results
         """
-        import asyncio
-        return asyncio.run(self.agent.query(query))
+        return run_sync(self.agent.query(query))
 
 
 # Convenience function
@@ -7,21 +7,332 @@ IAMI 故事模式 Agent
 
 import os
 import json
+import asyncio
 import logging
 import random
 import re
-from typing import Dict, Any, List, Optional
+import time
+from collections import OrderedDict
+from typing import Dict, Any, AsyncIterator, Callable, List, Optional, Tuple, Type
 from datetime import datetime
 from pathlib import Path
 from langchain_openai import ChatOpenAI
+from langchain_core.messages import SystemMessage, HumanMessage
 from asgiref.sync import sync_to_async
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from pydantic import BaseModel, ConfigDict
 from accounts.models import StoryTemplate, UserStory
 from django.contrib.auth.models import User
 from .iami_agents import IAMIBaseAgent
+from .story_cache import GenCache
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# tension_change 无法直接转换为整数时，从文本中提取带符号的数字
+_TENSION_RE = re.compile(r'[-+]?\d+')
+
+_PROMPTS_DIR = Path(__file__).parent / "prompts"
+
+
+# ==================== 固定系统提示词 ====================
+# 较长的提示词放在 prompts/ 目录下的文本文件中。
+# 以下提示词不包含任何插值，保持字节级不变，
+# 以便 LLM 服务端的前缀缓存（prompt caching）跨调用复用。
+
+_SCENE_SYSTEM_PROMPT = """你是故事的推进者。基于当前故事状态和用户的选择，生成下一个场景。
+
+## 要求
+1. **延续性**：场景要自然承接上文
+2. **细节**：场景描写要细致入微（环境、氛围、人物动作、对话）
+3. **推进**：剧情要有实质性进展
+4. **选择**：提供 3-4 个有意义的选项
+5. **心理测试**：每个选项应反映不同的价值观/性格特征
+6. **事实抽取**：在 story_triples 中列出本场景的 3-6 条关键剧情事实
+
+返回 JSON 格式（scene_number 使用用户消息中给出的场景编号）：
+{
+    "scene_number": 场景编号,
+    "title": "场景标题",
+    "immediate_consequence": "对上一个选择的立即后果描写（150-200字，细致感人），如果你是开场第一章，这里可以为空字符串",
+    "description": "新的场景描写（400-500字，包含环境、人物、对话、动作等）",
+    "environment_details": "环境细节",
+    "character_emotions": "角色情绪",
+    "npc_reactions": {
+        "NPC名字": "基于上一个选择的反应描述"
+    },
+    "world_state_changes": {
+        "tension_level": "更新后的数值(1-10)",
+        "其他变量": "数值或状态变化"
+    },
+    "key_moment": "关键时刻/冲突点",
+    "choices": [
+        {
+            "id": 1,
+            "text": "选项描述（第一人称）",
+            "motivation": "这个选择反映的动机",
+            "psychological_dimension": "对应的心理学维度（如：Openness, Benevolence, Harm/Care）",
+            "potential_consequence": "可能的后果提示（模糊）"
+        }
+    ],
+    "npcs_present": ["在场的 NPC 名字"],
+    "story_triples": [
+        {"subject": "主体（人物名）", "action": "行为/关系", "object": "对象"}
+    ],
+    "tension_change": "+1 或 -1 或 0（紧张度变化）"
+}
+"""
+
+_SCENE_STREAM_SYSTEM_PROMPT = _SCENE_SYSTEM_PROMPT + """
+## 输出格式（流式）
+先输出 <DESC>新的场景描写</DESC>，随后输出上述 JSON。
+场景描写只出现在 <DESC> 标签中，JSON 里的 description 字段留空。
+"""
+
+_CHOICE_SYSTEM_PROMPT = """用户在故事场景中做出了选择。请生成后果和心理分析。
+
+请结合用户消息中**预设的动机和后果提示**，分析用户做出此选择的深层心理原因。
+
+请返回 JSON：
+{
+    "immediate_consequence": "立即后果（100-150字，具体描写）",
+    "long_term_impact": "长期影响（提示）",
+    "npc_reactions": {
+        "NPC名字": "反应描述"
+    },
+    "world_state_changes": {
+        "变量名": "变化"
+    },
+    "psychological_analysis": {
+        "trait_revealed": "揭示的特征",
+        "value_reflected": "反映的价值观",
+        "moral_stance": "道德立场",
+        "decision_style": "决策风格",
+        "confidence": 4
+    }
+}
+"""
+
+_ANALYSIS_SYSTEM_PROMPT = """基于用户在整个故事中的选择，生成综合人格分析。
+
+请生成综合分析（返回 JSON）：
+{
+    "overall_personality": {
+        "openness": "评分和描述",
+        "conscientiousness": "评分和描述",
+        "extraversion": "评分和描述",
+        "agreeableness": "评分和描述",
+        "neuroticism": "评分和描述"
+    },
+    "core_values": ["识别出的核心价值观"],
+    "moral_foundations": {
+        "harm_care": "评分",
+        "fairness": "评分",
+        "ingroup_loyalty": "评分",
+        "authority": "评分",
+        "purity": "评分"
+    },
+    "decision_patterns": ["决策模式总结"],
+    "key_moments": [
+        {
+            "scene": "场景号",
+            "choice": "关键选择",
+            "significance": "重要性说明"
+        }
+    ],
+    "character_arc": "角色成长轨迹描述",
+    "recommendations": "基于分析的建议"
+}
+"""
+
+
+# ==================== 用户提示词模板 ====================
+# 模板在模块加载时定义一次，调用时只用 str.format 填入变化的字段。
+
+_SCENE_USER_TMPL = """## 当前故事状态
+{context}
+
+{choice_section}
+## 场景编号
+{scene_number}
+"""
+
+_PREVIOUS_CHOICE_TMPL = """## 用户上一个选择
+选项: {option_text}
+后果: {consequence}
+"""
+
+_SCENE_PATCH_TMPL = """以下场景是针对一个相似的选择生成的，用户实际做出的选择略有不同。
+请只改写受选择影响的部分，使其与实际选择一致。
+
+## 用户实际选择
+{option_text}
+
+## 原立即后果
+{consequence}
+
+## 原选项
+{choices_json}
+
+请返回 JSON：
+{{
+    "immediate_consequence": "与实际选择相符的立即后果（150-200字）",
+    "choices_text": ["改写后的选项（数量与原选项一致）"]
+}}
+"""
+
+_CHOICE_USER_TMPL = """## 场景
+{scene}
+
+## 用户选择
+{text}
+
+## 选择动机 (预设)
+{motivation}
+
+## 可能后果 (预设提示)
+{potential_consequence}
+
+## 心理维度
+{psychological_dimension}
+"""
+
+_NPC_DIALOGUE_TMPL = """你是 {npc_name}，以下是你的信息：
+
+**角色**: {role}
+**性格**: {personality}
+**与主角关系**: {relationship}
+
+**当前情境**:
+{context}
+
+请生成符合角色性格的对话（100-150字）。对话要：
+1. 符合角色性格
+2. 推进剧情
+3. 有感情色彩
+4. 细节丰富（动作、表情等）
+
+直接返回对话内容，不要JSON格式。
+"""
+
+_ANALYSIS_USER_TMPL = """## 故事信息
+类型: {genre}
+场景数: {scene_count}
+选择数: {choice_count}
+
+## 选择分析汇总
+{analysis_summary}
+"""
+
+_CHOICE_QUICK_TMPL = """用户做出了以下选择，请生成简短的后果描述。
+
+## 选择
+{text}
+
+请返回 JSON（仅包含后果，不需要分析）：
+{{
+    "immediate_consequence": "后果描述（50-80字）",
+    "tension_change": "+1 或 -1 或 0"
+}}
+"""
+
+_CHOICE_ANALYSIS_TMPL = """分析用户的选择，提取心理特征。
+
+## 选择
+{text}
+
+## 预设动机
+{motivation}
+
+## 预设后果
+{potential_consequence}
+
+## 心理维度
+{psychological_dimension}
+
+请结合上述**预设的动机和后果提示**，分析用户做出此选择的深层心理原因。
+
+请返回 JSON：
+{{
+    "psychological_analysis": {{
+        "trait_revealed": "揭示的特征",
+        "value_reflected": "反映的价值观",
+        "moral_stance": "道德立场",
+        "decision_style": "决策风格",
+        "confidence": 4
+    }}
+}}
+"""
+
+
+# ==================== LLM 输出结构 ====================
+# 支持 JSON 模式的服务商直接按这些结构解析；字段都有默认值，
+# 模型漏掉字段时不会整体解析失败。
+
+class _LLMOutput(BaseModel):
+    """LLM JSON 输出基类（保留未声明的字段）"""
+    model_config = ConfigDict(extra="allow")
+
+
+class StorySetting(_LLMOutput):
+    title: str = "未命名"
+    setting: Dict[str, Any] = {}
+    protagonist: Dict[str, Any] = {}
+    initial_scene: Dict[str, Any] = {}
+    key_npcs: List[Dict[str, Any]] = []
+    central_conflict: Any = ""
+    potential_themes: List[Any] = []
+
+
+class NextScene(_LLMOutput):
+    scene_number: Any = None
+    title: str = "下一章节"
+    immediate_consequence: Any = ""
+    description: Any = ""
+    environment_details: Any = ""
+    character_emotions: Any = ""
+    npc_reactions: Dict[str, Any] = {}
+    world_state_changes: Dict[str, Any] = {}
+    key_moment: Any = ""
+    choices: List[Dict[str, Any]] = []
+    npcs_present: List[Any] = []
+    story_triples: List[Any] = []
+    tension_change: Any = 0
+
+
+class ScenePatch(_LLMOutput):
+    immediate_consequence: Any
+    choices_text: List[Any] = []
+
+
+class ChoiceOutcome(_LLMOutput):
+    immediate_consequence: Any = ""
+    long_term_impact: Any = ""
+    npc_reactions: Dict[str, Any] = {}
+    world_state_changes: Dict[str, Any] = {}
+    psychological_analysis: Dict[str, Any] = {}
+
+
+class QuickConsequence(_LLMOutput):
+    immediate_consequence: Any = "你的选择产生了影响..."
+    tension_change: Any = "0"
+
+
+class ChoiceAnalysis(_LLMOutput):
+    psychological_analysis: Dict[str, Any] = {}
+
+
+class StoryAnalysis(_LLMOutput):
+    overall_personality: Dict[str, Any] = {}
+    core_values: List[Any] = []
+    moral_foundations: Dict[str, Any] = {}
+    decision_patterns: List[Any] = []
+    key_moments: List[Dict[str, Any]] = []
+    character_arc: Any = ""
+    recommendations: Any = ""
+
 
 class StoryGenre:
     """故事类型定义"""
@@ -37,49 +348,256 @@ class StoryGenre:
 
     @classmethod
     def all_genres(cls):
-        return [
-            cls.SCIFI, cls.FANTASY, cls.MYSTERY, cls.MODERN,
-            cls.HISTORICAL, cls.SURVIVAL, cls.ROMANCE, cls.THRILLER, cls.ADVENTURE
+        return _ALL_GENRES
+
+
+_ALL_GENRES: tuple = (
+    StoryGenre.SCIFI, StoryGenre.FANTASY, StoryGenre.MYSTERY, StoryGenre.MODERN,
+    StoryGenre.HISTORICAL, StoryGenre.SURVIVAL, StoryGenre.ROMANCE,
+    StoryGenre.THRILLER, StoryGenre.ADVENTURE
+)
+
+
+class StoryKG:
+    """
+    故事时序知识图谱（MEM）
+
+    以 <subject, action, object, index> 四元组记录剧情事实，index 为场景编号。
+    构建提示词时只检索与当前人物相关的四元组，输入长度随相关实体数增长，
+    而不是随场景数 × 选择数增长。
+    """
+
+    def __init__(self, quads: Optional[List[Dict[str, Any]]] = None):
+        self.quads = quads if quads is not None else []
+
+    def add(self, subject: str, action: str, obj: str, index: int):
+        """添加一条四元组"""
+        if not subject or not action:
+            return
+        self.quads.append({
+            "subject": str(subject),
+            "action": str(action),
+            "object": str(obj or ""),
+            "index": index
+        })
+
+    def add_triples(self, triples: List[Any], index: int):
+        """批量添加 LLM 抽取的三元组（dict 或 [s, a, o] 列表）"""
+        for triple in triples or []:
+            if isinstance(triple, dict):
+                self.add(triple.get("subject"), triple.get("action"), triple.get("object"), index)
+            elif isinstance(triple, (list, tuple)) and len(triple) >= 3:
+                self.add(triple[0], triple[1], triple[2], index)
+
+    def query(self, entities: List[str], k: int = 10) -> List[Dict[str, Any]]:
+        """返回与任一实体相关的最近 k 条四元组（按时间顺序）"""
+        names = [e for e in entities if e]
+        hits = [
+            q for q in self.quads
+            if any(name in q["subject"] or name in q["object"] for name in names)
         ]
+        return hits[-k:]
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return self.quads
 
 
 class StoryState:
-    """故事状态"""
+    """
+    故事状态
+
+    持久化字段统一保存在 self._d 中并通过属性访问，to_dict 直接返回该字典，
+    保存时无需重新组装。dirty、kg 等运行时属性不写入 _d。
+    """
+
+    # 运行时属性使用 __slots__，实例没有 __dict__
+    __slots__ = ("_d", "kg", "dirty", "_ctx_cache", "_npcs_joined", "_context_header")
+
+    _FIELDS = (
+        "story_id", "genre", "setting", "protagonist", "current_scene", "scenes",
+        "scene_summaries", "choices_made", "npcs", "world_state", "relationships",
+        "kg", "timestamp_ns", "scenes_count", "choices_count"
+    )
+
+    # 保留完整内容的场景数，更早的场景（开场除外）只保留摘要，
+    # 使每次保存的 JSON 大小有上限
+    MAX_FULL_SCENES = 20
+    # 世界观与主角背景的最大长度（写入时截断）
+    WORLD_MAX_CHARS = 300
+    BACKGROUND_MAX_CHARS = 150
+
     def __init__(self):
-        self.story_id = f"story_{datetime.now().timestamp()}"
-        self.genre = ""
-        self.setting = {}
-        self.protagonist = {}
-        self.current_scene = 0
-        self.scenes = []
-        self.choices_made = []
-        self.npcs = {}
-        self.world_state = {}  # 世界状态变量
-        self.relationships = {}  # 人物关系
-        self.timestamp = datetime.now().isoformat()
+        object.__setattr__(self, "_d", {
+            "story_id": f"story_{time.time_ns()}",
+            "genre": "",
+            "setting": {},
+            "protagonist": {},
+            "current_scene": 0,
+            "scenes": [],
+            "scene_summaries": [],  # 移出 scenes 的早期场景：{scene_number, title, triples}
+            "choices_made": [],
+            "npcs": {},
+            "world_state": {},  # 世界状态变量
+            "relationships": {},  # 人物关系
+            "kg": [],
+            "timestamp_ns": time.time_ns(),  # 整数纳秒时间戳，展示时再格式化
+            # 列表页直接在数据库端读取的计数，无需加载完整状态
+            "scenes_count": 0,
+            "choices_count": 0
+        })
+        self.kg = StoryKG(self._d["kg"])  # 剧情事实记忆，与 _d["kg"] 共用列表
+        self.dirty = False  # 自上次保存后是否有改动（不持久化）
+        self._ctx_cache = None  # (状态指纹, 上下文文本)，不持久化
+        self._npcs_joined = ""  # NPC 名字列表（随 npcs 赋值更新），不持久化
+        self._context_header = None  # 上下文中不变的开头部分，不持久化
+
+    def __getattr__(self, name: str):
+        # 只在常规查找失败时调用；_d 尚未设置时（如复制过程中）直接报错
+        try:
+            d = object.__getattribute__(self, "_d")
+        except AttributeError:
+            raise AttributeError(name) from None
+        if name not in d:
+            raise AttributeError(name)
+        return d[name]
+
+    def __setattr__(self, name: str, value: Any):
+        if name == "kg":
+            # 知识图谱的四元组列表就是持久化的 kg 字段
+            self._d["kg"] = value.quads
+            object.__setattr__(self, name, value)
+        elif name in self._FIELDS or name in self._d:
+            self._d[name] = value
+            if name == "npcs":
+                object.__setattr__(self, "_npcs_joined", ", ".join(value))
+            elif name in ("genre", "setting", "protagonist"):
+                object.__setattr__(self, "_context_header", None)
+        else:
+            object.__setattr__(self, name, value)
+
+    def _cap_context_fields(self):
+        """在写入时截断进入上下文的长文本，构建上下文时无需再切片"""
+        world = self.setting.get("world", "")
+        if len(world) > self.WORLD_MAX_CHARS:
+            self.setting = {**self.setting, "world": world[:self.WORLD_MAX_CHARS]}
+        background = self.protagonist.get("background", "")
+        if len(background) > self.BACKGROUND_MAX_CHARS:
+            self.protagonist = {
+                **self.protagonist,
+                "background": background[:self.BACKGROUND_MAX_CHARS]
+            }
+
+    def __getstate__(self):
+        # 复制/序列化时只需持久化字段，运行时属性在 __setstate__ 中重建
+        return self._d
+
+    def __setstate__(self, d: Dict[str, Any]):
+        object.__setattr__(self, "_d", d)
+        self.kg = StoryKG(d["kg"])
+        self.dirty = False
+        self._ctx_cache = None
+        self._context_header = None
+        self.npcs = d["npcs"]
+
+    @property
+    def timestamp(self) -> str:
+        """ISO 格式的创建时间（只在展示或导出时格式化）"""
+        return datetime.fromtimestamp(self.timestamp_ns / 1e9).isoformat()
 
     def to_dict(self) -> Dict[str, Any]:
-        return {
-            "story_id": self.story_id,
-            "genre": self.genre,
-            "setting": self.setting,
-            "protagonist": self.protagonist,
-            "current_scene": self.current_scene,
-            "scenes": self.scenes,
-            "choices_made": self.choices_made,
-            "npcs": self.npcs,
-            "world_state": self.world_state,
-            "relationships": self.relationships,
-            "timestamp": self.timestamp
-        }
+        """返回持久化字段字典（不复制，调用方不应修改）"""
+        return self._d
 
     @classmethod
     def from_dict(cls, data: Dict[str, Any]):
         state = cls()
-        for key, value in data.items():
-            setattr(state, key, value)
+        state._d.update(data)
+        # 旧版状态保存的是 ISO 字符串时间戳
+        legacy_ts = state._d.pop("timestamp", None)
+        if legacy_ts and "timestamp_ns" not in data:
+            try:
+                state.timestamp_ns = int(datetime.fromisoformat(legacy_ts).timestamp() * 1e9)
+            except (TypeError, ValueError):
+                pass
+        state.kg = StoryKG(state._d["kg"])
+        state.scenes_count = state.scene_count()
+        state.choices_count = len(state.choices_made)
+        state.npcs = state._d["npcs"]
+        state._cap_context_fields()
         return state
 
+    @classmethod
+    def from_setting(cls, setting_dict: Dict[str, Any]) -> "StoryState":
+        """根据故事设定（StoryTemplate.source_data）初始化开场状态"""
+        state = cls()
+        state.genre = setting_dict["genre"]
+        state.setting = setting_dict["setting"]
+        state.protagonist = setting_dict["protagonist"]
+        state._cap_context_fields()
+
+        # 初始场景
+        state.scenes_count = 1
+        state.scenes.append({
+            "scene_number": 0,
+            "title": setting_dict["title"],
+            "description": setting_dict["initial_scene"].get("description", ""),
+            "environment": setting_dict["initial_scene"].get("environment", ""),
+            "mood": setting_dict["initial_scene"].get("mood", ""),
+            "ts_ns": time.time_ns()
+        })
+
+        # NPC
+        state.npcs = {
+            npc_data.get("name", ""): npc_data
+            for npc_data in setting_dict.get("key_npcs", [])
+        }
+
+        # 世界状态
+        state.world_state = {
+            "central_conflict": setting_dict.get("central_conflict", ""),
+            "themes": setting_dict.get("potential_themes", []),
+            "tension_level": 1
+        }
+        return state
+
+    def record_scene(self, scene: Dict[str, Any], triples: Optional[List[Any]] = None):
+        """记录已确定的场景及其剧情事实"""
+        self.scenes.append(scene)
+        self.scenes_count += 1
+        self.kg.add_triples(triples, scene.get("scene_number", self.current_scene))
+
+        # 超出上限时把最早的非开场场景压缩为摘要（开场场景保存着故事标题）
+        while len(self.scenes) > self.MAX_FULL_SCENES:
+            old = self.scenes.pop(1)
+            number = old.get("scene_number")
+            self.scene_summaries.append({
+                "scene_number": number,
+                "title": old.get("title", ""),
+                "triples": [
+                    [q["subject"], q["action"], q["object"]]
+                    for q in self.kg.quads if q["index"] == number
+                ]
+            })
+        self.dirty = True
+        self._ctx_cache = None
+
+    def scene_count(self) -> int:
+        """场景总数（包括只保留摘要的早期场景）"""
+        return len(self.scenes) + len(self.scene_summaries)
+
+    def record_choice(self, choice_record: Dict[str, Any]):
+        """记录用户选择，并写入剧情事实"""
+        self.choices_made.append(choice_record)
+        self.choices_count = len(self.choices_made)
+        self.kg.add(
+            self.protagonist.get("name") or "主角",
+            "选择",
+            choice_record.get("choice", {}).get("text", ""),
+            choice_record.get("scene_number", self.current_scene)
+        )
+        self.dirty = True
+        self._ctx_cache = None
+
 
 class IAMIStoryAgent(IAMIBaseAgent):
     """
@@ -93,10 +611,24 @@ class IAMIStoryAgent(IAMIBaseAgent):
     5. 生成故事报告
     """
 
+    # 加载缓存保留的故事数
+    LOAD_CACHE_SIZE = 32
+
     def __init__(self, user_id: str = "default", indexer=None):
         super().__init__(user_id=user_id, indexer=indexer)
-        # self.stories_dir is no longer needed for primary storage, but keeping for backward compat if needed?
-        # Let's fully switch to DB.
+        # 并行 LLM 调用上限（预生成场景时使用，避免触发服务商限流）
+        self._llm_concurrency = int(os.getenv("LLM_CONCURRENCY", "4"))
+        # 故事设定的系统提示词（固定内容，可被服务端前缀缓存复用）
+        self._setting_prompt_system = (_PROMPTS_DIR / "story_setting_system.txt").read_text(encoding="utf-8")
+        # 结构相似提示词（场景推进、快速后果）的响应缓存
+        self._gen_cache = GenCache()
+        # 每个代理独立的随机数生成器，不共享模块级全局随机状态
+        self._rng = random.Random()
+        # 后台分析任务（保留引用，避免任务被垃圾回收）
+        self._bg_tasks: set = set()
+        # 故事保存在数据库中（UserStory），不再使用 stories_dir
+        # 最近加载/保存的故事状态（LRU），避免重复查询和解析 current_state
+        self._load_cache: "OrderedDict[str, StoryState]" = OrderedDict()
 
 
     async def generate_story_setting(
@@ -115,158 +647,85 @@ class IAMIStoryAgent(IAMIBaseAgent):
             StoryState 对象
         """
         # 随机选择类型
-        if not genre:
-            genre = random.choice(StoryGenre.all_genres())
+        genre = genre or self._rng.choice(_ALL_GENRES)
 
-        # 构建提示词
-        prompt = f"""你是一个创意无限的故事设计师。请创造一个**全新的、原创的**{genre}类型故事。
+        # 固定的说明和 JSON 结构放在系统提示词中，用户消息只包含变化的参数
+        prompt = f"genre={genre}\ntheme={theme or 'any'}"
 
-## 要求
-1. **原创性**：不要使用已知的小说、电影、游戏剧情
-2. **细节丰富**：场景描写要细致入微，有画面感
-3. **人物立体**：主角和 NPC 要有鲜明的性格
-4. **冲突明确**：要有核心冲突和矛盾
-5. **选择空间**：要有多种可能的发展方向
-
-{f'## 主题：{theme}' if theme else ''}
+        story_data, response = await self.invoke_llm_structured(
+            prompt,
+            StorySetting,
+            call_type="story_generate_setting",
+            system_prompt=self._setting_prompt_system
+        )
 
-请生成以下内容（返回 JSON 格式）：
-
-{{
-    "genre": "{genre}",
-    "title": "故事标题",
-    "setting": {{
-        "world": "世界观描述（200-300字）",
-        "time_period": "时间背景",
-        "location": "初始地点",
-        "atmosphere": "氛围描述"
-    }},
-    "protagonist": {{
-        "name": "主角名字",
-        "background": "主角背景（100-150字）",
-        "current_situation": "当前处境",
-        "goal": "主角目标",
-        "personality_hint": "性格暗示"
-    }},
-    "initial_scene": {{
-        "description": "开场场景描写（300-400字，细致入微）",
-        "environment": "环境细节",
-        "mood": "情绪氛围",
-        "hook": "吸引点/悬念"
-    }},
-    "key_npcs": [
-        {{
-            "name": "NPC名字",
-            "role": "角色定位",
-            "personality": "性格特点",
-            "relationship": "与主角的关系"
-        }}
-    ],
-    "central_conflict": "核心冲突",
-    "potential_themes": ["可能探索的主题1", "主题2", "主题3"]
-}}
-"""
-
-        response = await self.invoke_llm(prompt, call_type="story_generate_setting")
-
-        try:
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
-
-            story_data = json.loads(content)
-
-            # 创建故事状态
-            # 查找或创建 StoryTemplate
-            # 将生成的设定保存为 StoryTemplate
-            setting_data = {
-                "genre": genre,
-                "title": story_data.get("title", "未命名"),
-                "setting": story_data.get("setting", {}),
-                "protagonist": story_data.get("protagonist", {}),
-                "initial_scene": story_data.get("initial_scene", {}),
-                "key_npcs": story_data.get("key_npcs", []),
-                "central_conflict": story_data.get("central_conflict", ""),
-                "potential_themes": story_data.get("potential_themes", [])
-            }
-
-            @sync_to_async
-            def save_template_and_story(user_id_str, setting_dict):
-                # 解析 ID
-                try:
-                    uid = int(user_id_str.replace("user_", ""))
-                    user = User.objects.get(id=uid)
-                except (ValueError, User.DoesNotExist) as e:
-                    # Fallback for default/test user
-                    logger.warning(f"User lookup failed for {user_id_str}: {e}")
-                    user = User.objects.get(username="renqing") if User.objects.filter(username="renqing").exists() else User.objects.first()
-
-                # 创建模板
-                template = StoryTemplate.objects.create(
-                    title=setting_dict["title"],
-                    genre=setting_dict["genre"],
-                    description=setting_dict["setting"].get("world", "")[:200],
-                    source_data=setting_dict,
-                    created_by=user,
-                    is_public=False # 默认私有
-                )
-                
-                # 创建用户故事
-                state = StoryState()
-                state.story_id = f"db_{template.id}_{datetime.now().timestamp()}"
-                state.genre = setting_dict["genre"]
-                state.setting = setting_dict["setting"]
-                state.protagonist = setting_dict["protagonist"]
-                
-                # 初始场景
-                initial_scene = {
-                    "scene_number": 0,
-                    "title": setting_dict["title"],
-                    "description": setting_dict["initial_scene"].get("description", ""),
-                    "environment": setting_dict["initial_scene"].get("environment", ""),
-                    "mood": setting_dict["initial_scene"].get("mood", ""),
-                    "timestamp": datetime.now().isoformat()
-                }
-                state.scenes.append(initial_scene)
-                
-                # NPC
-                for npc_data in setting_dict.get("key_npcs", []):
-                    state.npcs[npc_data.get("name", "")] = npc_data
-                    
-                # World State
-                state.world_state = {
-                    "central_conflict": setting_dict.get("central_conflict", ""),
-                    "themes": setting_dict.get("potential_themes", []),
-                    "tension_level": 1
-                }
-
-                # 保存到 UserStory
-                user_story = UserStory.objects.create(
-                    user=user,
-                    template=template,
-                    current_state=state.to_dict(),
-                    is_active=True
-                )
-                
-                # 更新 ID 以匹配 DB
-                state.story_id = str(user_story.id)
-                return state
-
-            return await save_template_and_story(self.user_id, setting_data)
-
-        except json.JSONDecodeError as e:
+        if story_data is None:
             # 回退方案
             state = StoryState()
             state.genre = genre
             state.setting = {"world": response.content}
             return state
 
+        # 创建故事状态
+        # 查找或创建 StoryTemplate
+        # 将生成的设定保存为 StoryTemplate
+        setting_data = {
+            "genre": genre,
+            "title": story_data["title"],
+            "setting": story_data["setting"],
+            "protagonist": story_data["protagonist"],
+            "initial_scene": story_data["initial_scene"],
+            "key_npcs": story_data["key_npcs"],
+            "central_conflict": story_data["central_conflict"],
+            "potential_themes": story_data["potential_themes"]
+        }
+
+        @sync_to_async
+        @transaction.atomic
+        def save_template_and_story(user_id_str, setting_dict):
+            # 解析 ID
+            try:
+                uid = int(user_id_str.replace("user_", ""))
+                user = User.objects.get(id=uid)
+            except (ValueError, User.DoesNotExist) as e:
+                # Fallback for default/test user
+                logger.warning(f"User lookup failed for {user_id_str}: {e}")
+                user = User.objects.get(username="renqing") if User.objects.filter(username="renqing").exists() else User.objects.first()
+
+            # 创建模板
+            template = StoryTemplate.objects.create(
+                title=setting_dict["title"],
+                genre=setting_dict["genre"],
+                description=setting_dict["setting"].get("world", "")[:200],
+                source_data=setting_dict,
+                created_by=user,
+                is_public=False # 默认私有
+            )
+
+            # 创建用户故事
+            state = StoryState.from_setting(setting_dict)
+            state.story_id = f"db_{template.id}_{time.time_ns()}"
+
+            # 保存到 UserStory
+            user_story = UserStory.objects.create(
+                user=user,
+                template=template,
+                current_state=state.to_dict(),
+                is_active=True
+            )
+
+            # 更新 ID 以匹配 DB
+            state.story_id = str(user_story.id)
+            return state
+
+        return await save_template_and_story(self.user_id, setting_data)
+
     async def generate_next_scene(
         self,
         state: StoryState,
-        previous_choice: Optional[Dict[str, Any]] = None
+        previous_choice: Optional[Dict[str, Any]] = None,
+        prebuilt_context: Optional[str] = None,
+        on_token: Optional[Callable[[str], None]] = None
     ) -> Dict[str, Any]:
         """
         根据当前状态生成下一个场景
@@ -274,130 +733,300 @@ class IAMIStoryAgent(IAMIBaseAgent):
         Args:
             state: 当前故事状态
             previous_choice: 上一个选择（如果有）
+            prebuilt_context: 预先构建的故事上下文（可选，批量预生成时复用）
+            on_token: 场景描写的流式回调（可选）。提供时改为流式生成，
+                     描写片段到达即回调，不使用响应缓存
 
         Returns:
             场景数据（包含描述和选项）
         """
-        # 构建上下文
-        context = self._build_story_context(state)
-
-        prompt = f"""你是故事的推进者。基于当前故事状态和用户的选择，生成下一个场景。
+        if on_token is not None:
+            scene_data = None
+            async for event, payload in self.generate_next_scene_stream(state, previous_choice):
+                if event == "description":
+                    on_token(payload)
+                else:
+                    scene_data = payload
+            return scene_data
 
-## 当前故事状态
-{context}
+        # 构建上下文
+        context = prebuilt_context or self._build_story_context(state)
+        prompt = self._build_scene_prompt(state, context, previous_choice)
+
+        # 同一故事位置的场景只因选择文本不同而不同，优先复用缓存
+        template_key = self._scene_template_key(state)
+        choice_text = previous_choice.get("option_text", "") if previous_choice else ""
+        scene_data = None
+
+        hit = self._gen_cache.lookup("story_generate_scene", template_key, choice_text)
+        if hit:
+            cached_scene, exact = hit
+            scene_data = cached_scene if exact else await self._patch_cached_scene(
+                cached_scene, previous_choice
+            )
+
+        if scene_data is None:
+            scene_data, response = await self.invoke_llm_structured(
+                prompt,
+                NextScene,
+                call_type="story_generate_scene",
+                system_prompt=self._story_system_prompt(_SCENE_SYSTEM_PROMPT, state)
+            )
+
+            if scene_data is None:
+                return {
+                    "scene_number": state.current_scene + 1,
+                    "title": "下一章节",
+                    "description": response.content,
+                    "choices": []
+                }
+            if scene_data["scene_number"] is None:
+                scene_data["scene_number"] = state.current_scene + 1
 
-{f'''## 用户上一个选择
-选项: {previous_choice.get("option_text", "")}
-后果: {previous_choice.get("consequence", "")}
-''' if previous_choice else ''}
+        self._gen_cache.store("story_generate_scene", template_key, choice_text, scene_data)
+        self._apply_tension_change(state, scene_data)
 
-## 要求
-1. **延续性**：场景要自然承接上文
-2. **细节**：场景描写要细致入微（环境、氛围、人物动作、对话）
-3. **推进**：剧情要有实质性进展
-4. **选择**：提供 3-4 个有意义的选项
-5. **心理测试**：每个选项应反映不同的价值观/性格特征
+        return scene_data
 
-返回 JSON 格式：
-{{
-    "scene_number": {state.current_scene + 1},
-    "title": "场景标题",
-    "immediate_consequence": "对上一个选择的立即后果描写（150-200字，细致感人），如果你是开场第一章，这里可以为空字符串",
-    "description": "新的场景描写（400-500字，包含环境、人物、对话、动作等）",
-    "environment_details": "环境细节",
-    "character_emotions": "角色情绪",
-    "npc_reactions": {{
-        "NPC名字": "基于上一个选择的反应描述"
-    }},
-    "world_state_changes": {{
-        "tension_level": "更新后的数值(1-10)",
-        "其他变量": "数值或状态变化"
-    }},
-    "key_moment": "关键时刻/冲突点",
-    "choices": [
-        {{
-            "id": 1,
-            "text": "选项描述（第一人称）",
-            "motivation": "这个选择反映的动机",
-            "psychological_dimension": "对应的心理学维度（如：Openness, Benevolence, Harm/Care）",
-            "potential_consequence": "可能的后果提示（模糊）"
-        }}
-    ],
-    "npcs_present": ["在场的 NPC 名字"],
-    "tension_change": "+1 或 -1 或 0（紧张度变化）"
-}}
-"""
+    async def generate_next_scene_stream(
+        self,
+        state: StoryState,
+        previous_choice: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        流式生成下一个场景
 
-        response = await self.invoke_llm(prompt, call_type="story_generate_scene")
+        模型先输出 <DESC>场景描写</DESC>，再输出其余字段的 JSON。
+        描写部分边生成边返回，JSON 部分在结束后统一解析。
+        预生成场景时请使用 generate_next_scene（部分输出没有意义）。
 
-        try:
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
+        Args:
+            state: 当前故事状态
+            previous_choice: 上一个选择（如果有）
 
-            scene_data = json.loads(content)
+        Yields:
+            ("description", 文本片段)，最后一项为 ("scene", 场景数据)
+        """
+        context = self._build_story_context(state)
+        prompt = self._build_scene_prompt(state, context, previous_choice)
+        messages = [
+            SystemMessage(content=self._story_system_prompt(_SCENE_STREAM_SYSTEM_PROMPT, state)),
+            HumanMessage(content=prompt)
+        ]
 
-            # 更新世界状态
+        open_tag, close_tag = "<DESC>", "</DESC>"
+        buffer = ""
+        description = ""
+        in_desc = False
+        desc_done = False
+        full_response = None
+
+        async for chunk in self.llm.astream(messages):
+            full_response = chunk if full_response is None else full_response + chunk
+            buffer += chunk.content
+            if desc_done:
+                continue
+
+            if not in_desc:
+                start = buffer.find(open_tag)
+                if start == -1:
+                    continue
+                buffer = buffer[start + len(open_tag):]
+                in_desc = True
+
+            end = buffer.find(close_tag)
+            if end != -1:
+                text, buffer = buffer[:end], buffer[end + len(close_tag):]
+                desc_done = True
+            else:
+                # 保留可能是半个结束标签的尾部
+                keep = len(close_tag) - 1
+                text, buffer = buffer[:-keep], buffer[-keep:]
+
+            if text:
+                description += text
+                yield "description", text
+
+        if full_response is not None:
             try:
-                tension_change = int(scene_data.get("tension_change", 0))
-            except (ValueError, TypeError) as e:
-                # 如果无法转换为整数，尝试提取数字或默认为 0
-                logger.warning(f"Failed to parse tension_change: {e}")
-                val = str(scene_data.get("tension_change", "0"))
-                match = re.search(r'[-+]?\d+', val)
-                tension_change = int(match.group()) if match else 0
-
-            state.world_state["tension_level"] = max(1, min(10,
-                state.world_state.get("tension_level", 5) + tension_change
-            ))
-
-            return scene_data
+                await self._queue_usage_record(full_response, "story_generate_scene")
+            except Exception as e:
+                logger.warning(f"Token usage recording failed: {e}")
 
-        except json.JSONDecodeError:
-            return {
+        scene_data = self._parse_json_output(buffer, NextScene, "story_generate_scene")
+        if scene_data is None:
+            scene_data = {
                 "scene_number": state.current_scene + 1,
                 "title": "下一章节",
-                "description": response.content,
+                "description": description or buffer,
                 "choices": []
             }
+            yield "scene", scene_data
+            return
+
+        if description:
+            scene_data["description"] = description
+        elif scene_data["description"]:
+            # 模型没有遵循 <DESC> 协议，描写在 JSON 里
+            yield "description", scene_data["description"]
+        if scene_data["scene_number"] is None:
+            scene_data["scene_number"] = state.current_scene + 1
+
+        self._apply_tension_change(state, scene_data)
+        yield "scene", scene_data
+
+    @staticmethod
+    def _build_scene_prompt(
+        state: StoryState,
+        context: str,
+        previous_choice: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """构建场景推进的用户提示词（随状态变化的部分）"""
+        choice_section = _PREVIOUS_CHOICE_TMPL.format(
+            option_text=previous_choice.get("option_text", ""),
+            consequence=previous_choice.get("consequence", "")
+        ) if previous_choice else ""
+        return _SCENE_USER_TMPL.format(
+            context=context,
+            choice_section=choice_section,
+            scene_number=state.current_scene + 1
+        )
+
+    @staticmethod
+    def _apply_tension_change(state: StoryState, scene_data: Dict[str, Any]):
+        """根据场景的 tension_change 更新世界状态的紧张度"""
+        try:
+            tension_change = int(scene_data.get("tension_change", 0))
+        except (ValueError, TypeError) as e:
+            # 如果无法转换为整数，尝试提取数字或默认为 0
+            logger.warning(f"Failed to parse tension_change: {e}")
+            val = str(scene_data.get("tension_change", "0"))
+            match = _TENSION_RE.search(val)
+            tension_change = int(match.group()) if match else 0
+
+        state.world_state["tension_level"] = max(1, min(10,
+            state.world_state.get("tension_level", 5) + tension_change
+        ))
+        state.dirty = True
+
+    @staticmethod
+    def _scene_template_key(state: StoryState) -> tuple:
+        """场景提示词的模板键：故事位置、紧张度与在场 NPC"""
+        return (
+            state.story_id,
+            state.current_scene,
+            len(state.choices_made),
+            str(state.world_state.get("tension_level", 5)),
+            tuple(sorted(state.npcs))
+        )
+
+    async def _patch_cached_scene(
+        self,
+        cached_scene: Dict[str, Any],
+        previous_choice: Optional[Dict[str, Any]]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        近似命中时只改写与选择相关的字段，其余内容沿用缓存场景；
+        属于原分支的剧情三元组、NPC 反应与世界状态变化会被清空
+
+        Returns:
+            改写后的场景；失败时返回 None（由调用方完整生成）
+        """
+        choices = cached_scene.get("choices", [])
+        prompt = _SCENE_PATCH_TMPL.format(
+            option_text=previous_choice.get("option_text", "") if previous_choice else "",
+            consequence=cached_scene.get("immediate_consequence", ""),
+            choices_json=json.dumps([c.get("text", "") for c in choices], ensure_ascii=False)
+        )
+        patch, _ = await self.invoke_llm_structured(
+            prompt, ScenePatch, call_type="story_scene_patch"
+        )
+        if patch is None:
+            return None
+
+        cached_scene["immediate_consequence"] = patch["immediate_consequence"]
+        for choice, text in zip(choices, patch.get("choices_text") or []):
+            if text:
+                choice["text"] = text
+        # 这些字段描述的是缓存场景所在分支的后果，补丁不会改写，沿用会把别的分支写进状态
+        cached_scene["story_triples"] = []
+        cached_scene["npc_reactions"] = {}
+        cached_scene["world_state_changes"] = {}
+        return cached_scene
 
     def _build_story_context(self, state: StoryState) -> str:
-        """构建故事上下文摘要"""
-        context_parts = []
+        """构建故事上下文摘要（状态未变化时复用上次的结果）"""
+        key = (
+            len(state.scenes),
+            len(state.choices_made),
+            len(state.kg.quads),
+            len(state.npcs),
+            state.world_state.get("tension_level")
+        )
+        if state._ctx_cache and state._ctx_cache[0] == key:
+            return state._ctx_cache[1]
+
+        context = self._render_story_context(state)
+        state._ctx_cache = (key, context)
+        return context
+
+    @staticmethod
+    def _story_header(state: StoryState) -> str:
+        """故事中不变的部分（类型、世界观、主角），渲染一次后复用"""
+        if state._context_header is None:
+            state._context_header = "\n".join((
+                f"**类型**: {state.genre}",
+                f"**世界观**: {state.setting.get('world', '')}",
+                f"\n**主角**: {state.protagonist.get('name', '')}",
+                f"背景: {state.protagonist.get('background', '')}"
+            ))
+        return state._context_header
 
-        # 故事设定
-        context_parts.append(f"**类型**: {state.genre}")
-        context_parts.append(f"**世界观**: {state.setting.get('world', '')[:200]}...")
+    def _story_system_prompt(self, base_prompt: str, state: StoryState) -> str:
+        """
+        固定指令 + 故事设定组成的系统提示词
 
-        # 主角
-        context_parts.append(f"\n**主角**: {state.protagonist.get('name', '')}")
-        context_parts.append(f"背景: {state.protagonist.get('background', '')[:100]}...")
+        同一故事内逐字节不变，服务端前缀缓存可以跳过这部分的预填充；
+        用户消息只携带每轮变化的剧情状态。
+        """
+        return f"{base_prompt}\n## 故事设定\n{self._story_header(state)}\n"
 
-        # 最近的场景
-        if state.scenes:
-            recent_scenes = state.scenes[-3:]  # 最近3个场景
-            context_parts.append(f"\n**最近场景**:")
-            for scene in recent_scenes:
-                context_parts.append(f"- 场景{scene['scene_number']}: {scene['title']}")
+    def _render_story_context(self, state: StoryState) -> str:
+        """渲染每轮变化的故事上下文（不变的设定部分在系统提示词中）"""
+        context_parts = []
 
-        # 最近的选择
-        if state.choices_made:
-            recent_choices = state.choices_made[-5:]  # 最近5个选择
-            context_parts.append(f"\n**最近选择**:")
-            for choice in recent_choices:
-                context_parts.append(f"- {choice.get('option_text', '')[:50]}...")
+        # 与主角和 NPC 相关的剧情事实（时序知识图谱）
+        entities = [state.protagonist.get('name', '')] + list(state.npcs.keys())
+        facts = state.kg.query(entities, k=10)
+        if facts:
+            context_parts.append("\n**相关剧情事实**:")
+            for fact in facts:
+                context_parts.append(
+                    f"- [场景{fact['index']}] {fact['subject']} {fact['action']} {fact['object']}"
+                )
+        else:
+            # 旧故事没有知识图谱，回退到最近的场景和选择
+            if state.scenes:
+                recent_scenes = state.scenes[-3:]  # 最近3个场景
+                context_parts.append("\n**最近场景**:")
+                for scene in recent_scenes:
+                    context_parts.append(f"- 场景{scene['scene_number']}: {scene['title']}")
+
+            if state.choices_made:
+                recent_choices = state.choices_made[-5:]  # 最近5个选择
+                context_parts.append("\n**最近选择**:")
+                for choice in recent_choices:
+                    context_parts.append(f"- {choice.get('option_text', '')[:50]}...")
 
         # NPC
-        if state.npcs:
-            context_parts.append(f"\n**关键角色**: {', '.join(state.npcs.keys())}")
+        if state._npcs_joined:
+            context_parts.append(f"\n**关键角色**: {state._npcs_joined}")
 
         # 世界状态
         context_parts.append(f"\n**紧张度**: {state.world_state.get('tension_level', 5)}/10")
         context_parts.append(f"**核心冲突**: {state.world_state.get('central_conflict', '')}")
 
-        return "\n".join(context_parts)
+        return "\n".join(context_parts).lstrip("\n")
 
     async def process_choice(
         self,
@@ -415,76 +1044,42 @@ class IAMIStoryAgent(IAMIBaseAgent):
             选择后果和分析
         """
         # 生成选择后果
-        prompt = f"""用户在以下场景做出了选择。请生成后果和心理分析。
-
-## 场景
-{state.scenes[-1].get('description', '')[:300]}
-
-## 用户选择
-{choice.get('text', '')}
-
-## 选择动机 (预设)
-{choice.get('motivation', '')}
-
-## 可能后果 (预设提示)
-{choice.get('potential_consequence', '')}
-
-## 心理维度
-{choice.get('psychological_dimension', '')}
-
-请结合上述**预设的动机和后果提示**，分析用户做出此选择的深层心理原因。
-
-请返回 JSON：
-{{
-    "immediate_consequence": "立即后果（100-150字，具体描写）",
-    "long_term_impact": "长期影响（提示）",
-    "npc_reactions": {{
-        "NPC名字": "反应描述"
-    }},
-    "world_state_changes": {{
-        "变量名": "变化"
-    }},
-    "psychological_analysis": {{
-        "trait_revealed": "揭示的特征",
-        "value_reflected": "反映的价值观",
-        "moral_stance": "道德立场",
-        "decision_style": "决策风格",
-        "confidence": 4
-    }}
-}}
-"""
-
-        response = await self.invoke_llm(prompt, call_type="story_process_choice")
-
-        try:
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-
-            result = json.loads(content)
-
-            # 记录选择
-            choice_record = {
-                "scene_number": state.current_scene,
-                "choice": choice,
-                "consequence": result.get("immediate_consequence", ""),
-                "analysis": result.get("psychological_analysis", {}),
-                "timestamp": datetime.now().isoformat()
+        prompt = _CHOICE_USER_TMPL.format(
+            scene=state.scenes[-1].get('description', '')[:300],
+            text=choice.get('text', ''),
+            motivation=choice.get('motivation', ''),
+            potential_consequence=choice.get('potential_consequence', ''),
+            psychological_dimension=choice.get('psychological_dimension', '')
+        )
+
+        result, response = await self.invoke_llm_structured(
+            prompt,
+            ChoiceOutcome,
+            call_type="story_process_choice",
+            system_prompt=self._story_system_prompt(_CHOICE_SYSTEM_PROMPT, state)
+        )
+
+        if result is None:
+            return {
+                "immediate_consequence": response.content,
+                "psychological_analysis": {}
             }
 
-            state.choices_made.append(choice_record)
+        # 记录选择
+        choice_record = {
+            "scene_number": state.current_scene,
+            "choice": choice,
+            "consequence": result["immediate_consequence"],
+            "analysis": result["psychological_analysis"],
+            "ts_ns": time.time_ns()
+        }
 
-            # 更新世界状态
-            world_changes = result.get("world_state_changes", {})
-            state.world_state.update(world_changes)
+        state.record_choice(choice_record)
 
-            return result
+        # 更新世界状态
+        state.world_state.update(result["world_state_changes"])
 
-        except json.JSONDecodeError:
-            return {
-                "immediate_consequence": response.content,
-                "psychological_analysis": {}
-            }
+        return result
 
     async def generate_npc_dialogue(
         self,
@@ -505,23 +1100,13 @@ class IAMIStoryAgent(IAMIBaseAgent):
         """
         npc = state.npcs.get(npc_name, {})
 
-        prompt = f"""你是 {npc_name}，以下是你的信息：
-
-**角色**: {npc.get('role', '')}
-**性格**: {npc.get('personality', '')}
-**与主角关系**: {npc.get('relationship', '')}
-
-**当前情境**:
-{context}
-
-请生成符合角色性格的对话（100-150字）。对话要：
-1. 符合角色性格
-2. 推进剧情
-3. 有感情色彩
-4. 细节丰富（动作、表情等）
-
-直接返回对话内容，不要JSON格式。
-"""
+        prompt = _NPC_DIALOGUE_TMPL.format(
+            npc_name=npc_name,
+            role=npc.get('role', ''),
+            personality=npc.get('personality', ''),
+            relationship=npc.get('relationship', ''),
+            context=context
+        )
 
         response = await self.invoke_llm(prompt, call_type="story_npc_dialogue")
         return response.content
@@ -539,92 +1124,142 @@ class IAMIStoryAgent(IAMIBaseAgent):
         Returns:
             综合分析报告
         """
-        # 收集所有选择的分析
-        all_analyses = [
-            choice.get("analysis", {})
-            for choice in state.choices_made
+        # 补全尚未完成后台分析的选择（多个小请求并发发送）
+        pending = [
+            i for i, record in enumerate(state.choices_made)
+            if not record.get("analysis")
         ]
-
-        prompt = f"""基于用户在整个故事中的选择，生成综合人格分析。
-
-## 故事信息
-类型: {state.genre}
-场景数: {len(state.scenes)}
-选择数: {len(state.choices_made)}
-
-## 所有选择及分析
-{json.dumps(all_analyses, ensure_ascii=False, indent=2)}
-
-请生成综合分析（返回 JSON）：
-{{
-    "overall_personality": {{
-        "openness": "评分和描述",
-        "conscientiousness": "评分和描述",
-        "extraversion": "评分和描述",
-        "agreeableness": "评分和描述",
-        "neuroticism": "评分和描述"
-    }},
-    "core_values": ["识别出的核心价值观"],
-    "moral_foundations": {{
-        "harm_care": "评分",
-        "fairness": "评分",
-        "ingroup_loyalty": "评分",
-        "authority": "评分",
-        "purity": "评分"
-    }},
-    "decision_patterns": ["决策模式总结"],
-    "key_moments": [
-        {{
-            "scene": "场景号",
-            "choice": "关键选择",
-            "significance": "重要性说明"
-        }}
-    ],
-    "character_arc": "角色成长轨迹描述",
-    "recommendations": "基于分析的建议"
-}}
-"""
-
-        response = await self.invoke_llm(prompt, call_type="story_analysis")
-
-        try:
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-
-            analysis = json.loads(content)
-            analysis["story_id"] = state.story_id
-            analysis["generated_at"] = datetime.now().isoformat()
-
-            return analysis
-
-        except json.JSONDecodeError:
+        if pending:
+            results = await self._abatch_json(
+                [self._build_choice_analysis_prompt(state.choices_made[i].get("choice", {}))
+                 for i in pending],
+                ChoiceAnalysis,
+                call_type="story_choice_analysis"
+            )
+            for i, result in zip(pending, results):
+                if result:
+                    state.choices_made[i]["analysis"] = result["psychological_analysis"]
+                    state.dirty = True
+
+        # 聚合所有选择的分析，而不是把完整历史塞进提示词
+        analysis_summary = self._summarize_analyses(state)
+
+        prompt = _ANALYSIS_USER_TMPL.format(
+            genre=state.genre,
+            scene_count=state.scene_count(),
+            choice_count=len(state.choices_made),
+            analysis_summary=analysis_summary
+        )
+
+        analysis, response = await self.invoke_llm_structured(
+            prompt,
+            StoryAnalysis,
+            call_type="story_analysis",
+            system_prompt=_ANALYSIS_SYSTEM_PROMPT
+        )
+
+        # 输出被截断导致缺少核心字段时重试一次
+        if analysis is not None and not analysis["overall_personality"]:
+            retry, retry_response = await self.invoke_llm_structured(
+                prompt,
+                StoryAnalysis,
+                call_type="story_analysis",
+                system_prompt=_ANALYSIS_SYSTEM_PROMPT
+            )
+            if retry is not None and retry["overall_personality"]:
+                analysis, response = retry, retry_response
+
+        if analysis is None:
             return {
                 "raw_analysis": response.content,
                 "story_id": state.story_id,
                 "generated_at": datetime.now().isoformat()
             }
 
+        analysis["story_id"] = state.story_id
+        analysis["generated_at"] = datetime.now().isoformat()
+
+        return analysis
+
+    def _summarize_analyses(self, state: StoryState) -> str:
+        """按维度统计各选择的心理分析结果，并列出各场景的选择"""
+        dimensions = {
+            "trait_revealed": "揭示的特征",
+            "value_reflected": "反映的价值观",
+            "moral_stance": "道德立场",
+            "decision_style": "决策风格"
+        }
+        counts = {key: {} for key in dimensions}
+        confidences = []
+
+        for choice in state.choices_made:
+            analysis = choice.get("analysis") or {}
+            for key in dimensions:
+                label = analysis.get(key)
+                if label:
+                    counts[key][label] = counts[key].get(label, 0) + 1
+            if isinstance(analysis.get("confidence"), (int, float)):
+                confidences.append(analysis["confidence"])
+
+        lines = []
+        for key, title in dimensions.items():
+            if counts[key]:
+                ranked = sorted(counts[key].items(), key=lambda x: x[1], reverse=True)
+                lines.append(f"- {title}: " + "；".join(f"{label} ×{n}" for label, n in ranked))
+        if confidences:
+            lines.append(f"- 平均置信度: {sum(confidences) / len(confidences):.1f}")
+
+        if state.choices_made:
+            lines.append("\n各场景选择:")
+            for choice in state.choices_made:
+                text = choice.get("choice", {}).get("text", "")
+                lines.append(f"- 场景{choice.get('scene_number', '?')}: {text[:60]}")
+
+        return "\n".join(lines) if lines else "暂无选择分析"
+
     async def save_story(self, state: StoryState) -> bool:
-        """保存故事到数据库，返回是否成功"""
+        """保存故事到数据库，返回是否成功（无改动时直接返回）"""
+        if not state.dirty:
+            return True
+
         @sync_to_async
         def _save(sid, state_dict):
             try:
-                # 尝试通过 ID 查找
+                # 单条 UPDATE，无需先 SELECT
                 if sid.isdigit():
-                    us = UserStory.objects.get(id=int(sid))
-                    us.current_state = state_dict
-                    us.save()
-                    return True
+                    return UserStory.objects.filter(id=int(sid)).update(
+                        current_state=state_dict,
+                        last_played_at=timezone.now()
+                    ) > 0
             except Exception as e:
                 print(f"保存故事失败 (ID: {sid}): {e}")
                 return False
             return False
-        
-        return await _save(state.story_id, state.to_dict())
+
+        state.dirty = False
+        saved = await _save(state.story_id, state.to_dict())
+        if saved:
+            self._cache_story(state)
+        else:
+            state.dirty = True
+        return saved
+
+    def _cache_story(self, state: StoryState):
+        """把故事状态放入加载缓存（不复制，状态对象由代理持有）"""
+        key = str(state.story_id)
+        self._load_cache[key] = state
+        self._load_cache.move_to_end(key)
+        while len(self._load_cache) > self.LOAD_CACHE_SIZE:
+            self._load_cache.popitem(last=False)
 
     async def load_story(self, story_id: str) -> Optional[StoryState]:
-        """加载故事"""
+        """加载故事（优先使用缓存；有未保存改动的状态会重新从数据库加载）"""
+        key = str(story_id)
+        cached = self._load_cache.get(key)
+        if cached is not None and not cached.dirty:
+            self._load_cache.move_to_end(key)
+            return cached
+
         @sync_to_async
         def _load(sid):
             try:
@@ -635,7 +1270,10 @@ class IAMIStoryAgent(IAMIBaseAgent):
                 pass
             return None
 
-        return await _load(story_id)
+        state = await _load(story_id)
+        if state is not None and str(state.story_id) == key:
+            self._cache_story(state)
+        return state
 
     async def list_stories(self) -> List[Dict[str, Any]]:
         """列出所有故事"""
@@ -643,20 +1281,39 @@ class IAMIStoryAgent(IAMIBaseAgent):
         def _list(user_id_str):
             try:
                 uid = int(user_id_str.replace("user_", ""))
-                user = User.objects.get(id=uid)
-                stories = UserStory.objects.filter(user=user).select_related('template')
-                
+                # 只取摘要字段（JSON 键在数据库端提取），不加载完整故事状态
+                rows = UserStory.objects.filter(user_id=uid).order_by("-last_played_at").values(
+                    "id",
+                    "last_played_at",
+                    "current_state__genre",
+                    "current_state__scenes_count",
+                    "current_state__choices_count"
+                )
+
                 results = []
-                for s in stories:
-                    data = s.current_state
+                legacy_ids = []
+                for row in rows:
                     results.append({
-                        "story_id": str(s.id),
-                        "genre": data.get("genre", "Unknown"),
-                        "timestamp": s.last_played_at.isoformat(),
-                        "scenes_count": len(data.get("scenes", [])),
-                        "choices_count": len(data.get("choices_made", []))
+                        "story_id": str(row["id"]),
+                        "genre": row["current_state__genre"] or "Unknown",
+                        "timestamp": row["last_played_at"].isoformat(),
+                        "scenes_count": row["current_state__scenes_count"],
+                        "choices_count": row["current_state__choices_count"]
                     })
-                return sorted(results, key=lambda x: x.get("timestamp", ""), reverse=True)
+                    if row["current_state__scenes_count"] is None:
+                        legacy_ids.append(row["id"])
+
+                # 旧故事没有计数字段，回退到读取完整状态
+                if legacy_ids:
+                    legacy = dict(
+                        UserStory.objects.filter(id__in=legacy_ids).values_list("id", "current_state")
+                    )
+                    for item in results:
+                        data = legacy.get(int(item["story_id"]))
+                        if data is not None:
+                            item["scenes_count"] = len(data.get("scenes", [])) + len(data.get("scene_summaries", []))
+                            item["choices_count"] = len(data.get("choices_made", []))
+                return results
             except Exception:
                 return []
 
@@ -683,44 +1340,19 @@ class IAMIStoryAgent(IAMIBaseAgent):
     async def create_story_from_template(self, template_id: int) -> StoryState:
         """从模版创建新故事"""
         @sync_to_async
+        @transaction.atomic
         def _create(tid, user_id_str):
             try:
                 template = StoryTemplate.objects.get(id=tid)
                 uid = int(user_id_str.replace("user_", ""))
                 user = User.objects.get(id=uid)
                 
-                # 增加游玩计数
-                template.play_count += 1
-                template.save()
-                
-                setting_dict = template.source_data
-                
+                # 增加游玩计数（单条 UPDATE，数据库端自增）
+                StoryTemplate.objects.filter(id=tid).update(play_count=F('play_count') + 1)
+
                 # 初始化 StoryState
-                state = StoryState()
-                state.genre = setting_dict["genre"]
-                state.setting = setting_dict["setting"]
-                state.protagonist = setting_dict["protagonist"]
-                
-                # 初始场景
-                initial_scene = {
-                    "scene_number": 0,
-                    "title": setting_dict["title"],
-                    "description": setting_dict["initial_scene"].get("description", ""),
-                    "environment": setting_dict["initial_scene"].get("environment", ""),
-                    "mood": setting_dict["initial_scene"].get("mood", ""),
-                    "timestamp": datetime.now().isoformat()
-                }
-                state.scenes.append(initial_scene)
-                
-                for npc_data in setting_dict.get("key_npcs", []):
-                    state.npcs[npc_data.get("name", "")] = npc_data
-                    
-                state.world_state = {
-                    "central_conflict": setting_dict.get("central_conflict", ""),
-                    "themes": setting_dict.get("potential_themes", []),
-                    "tension_level": 1
-                }
-                
+                state = StoryState.from_setting(template.source_data)
+
                 # 创建 UserStory
                 us = UserStory.objects.create(
                     user=user,
@@ -750,8 +1382,11 @@ class IAMIStoryAgent(IAMIBaseAgent):
         Returns:
             {choice_id: scene_data} 字典
         """
-        import asyncio
-        
+        # 所有选择共享同一份上下文，只构建一次
+        context = self._build_story_context(state)
+        # 信号量在当前事件循环内创建（页面会在不同线程/事件循环中调用）
+        semaphore = asyncio.Semaphore(self._llm_concurrency)
+
         async def generate_for_choice(choice):
             # 模拟选择，生成对应场景
             simulated_choice = {
@@ -759,7 +1394,10 @@ class IAMIStoryAgent(IAMIBaseAgent):
                 "consequence": f"基于选择: {choice.get('text', '')[:50]}...",
                 "motivation": choice.get("motivation", "")
             }
-            scene = await self.generate_next_scene(state, simulated_choice)
+            async with semaphore:
+                scene = await self.generate_next_scene(
+                    state, simulated_choice, prebuilt_context=context
+                )
             return (choice.get("id"), scene)
         
         # 并行生成所有选择的场景
@@ -790,27 +1428,26 @@ class IAMIStoryAgent(IAMIBaseAgent):
             基本后果信息
         """
         # 生成简短的后果描述
-        prompt = f"""用户做出了以下选择，请生成简短的后果描述。
-
-## 选择
-{choice.get('text', '')}
-
-请返回 JSON（仅包含后果，不需要分析）：
-{{
-    "immediate_consequence": "后果描述（50-80字）",
-    "tension_change": "+1 或 -1 或 0"
-}}
-"""
-        response = await self.invoke_llm(prompt, call_type="story_choice_quick")
-        
-        try:
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            result = json.loads(content)
-        except (json.JSONDecodeError, KeyError, TypeError) as e:
-            logger.warning(f"Failed to parse choice response: {e}")
-            result = {"immediate_consequence": "你的选择产生了影响...", "tension_change": "0"}
+        prompt = _CHOICE_QUICK_TMPL.format(text=choice.get('text', ''))
+        # 后果描述很短，近似命中时改写并不比重新生成便宜，只做精确复用
+        template_key = (state.story_id, state.current_scene)
+        hit = self._gen_cache.lookup(
+            "story_choice_quick", template_key, choice.get('text', ''), fuzzy=False
+        )
+
+        if hit:
+            result = hit[0]
+        else:
+            result, _ = await self.invoke_llm_structured(
+                prompt, QuickConsequence, call_type="story_choice_quick"
+            )
+
+            if result is None:
+                result = QuickConsequence().model_dump()
+            else:
+                self._gen_cache.store(
+                    "story_choice_quick", template_key, choice.get('text', ''), result
+                )
         
         # 快速记录选择（无深度分析）
         choice_record = {
@@ -818,12 +1455,53 @@ class IAMIStoryAgent(IAMIBaseAgent):
             "choice": choice,
             "consequence": result.get("immediate_consequence", ""),
             "analysis": {},  # 稍后后台填充
-            "timestamp": datetime.now().isoformat()
+            "ts_ns": time.time_ns()
         }
-        state.choices_made.append(choice_record)
+        state.record_choice(choice_record)
         
         return result
 
+    @staticmethod
+    def _build_choice_analysis_prompt(choice: Dict[str, Any]) -> str:
+        """构建单个选择的心理分析提示词"""
+        return _CHOICE_ANALYSIS_TMPL.format(
+            text=choice.get('text', ''),
+            motivation=choice.get('motivation', ''),
+            potential_consequence=choice.get('potential_consequence', ''),
+            psychological_dimension=choice.get('psychological_dimension', '')
+        )
+
+    async def _abatch_json(
+        self,
+        prompts: List[str],
+        schema: Type[BaseModel],
+        call_type: str = "unknown"
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        批量调用 LLM 并解析 JSON（llm.abatch 并发发送）
+
+        Returns:
+            与 prompts 一一对应的解析结果；调用或解析失败的位置为 None
+        """
+        responses = await self.llm.abatch(
+            prompts,
+            config={"max_concurrency": self._llm_concurrency},
+            return_exceptions=True
+        )
+
+        results = []
+        for response in responses:
+            if isinstance(response, Exception):
+                logger.warning(f"Batched LLM call failed for call_type '{call_type}': {response}")
+                results.append(None)
+                continue
+            try:
+                await self._queue_usage_record(response, call_type)
+            except Exception as e:
+                logger.warning(f"Token usage recording failed: {e}")
+            results.append(self._parse_json_output(response.content, schema, call_type))
+        return results
+
     async def process_choice_analysis_background(
         self,
         state: StoryState,
@@ -842,46 +1520,87 @@ class IAMIStoryAgent(IAMIBaseAgent):
         choice_record = state.choices_made[choice_index]
         choice = choice_record.get("choice", {})
         
-        prompt = f"""分析用户的选择，提取心理特征。
+        prompt = self._build_choice_analysis_prompt(choice)
+        result, _ = await self.invoke_llm_structured(
+            prompt, ChoiceAnalysis, call_type="story_choice_analysis"
+        )
+        if result is None:
+            return
 
-## 选择
-{choice.get('text', '')}
+        try:
+            # 更新选择记录
+            analysis = result["psychological_analysis"]
+            state.choices_made[choice_index]["analysis"] = analysis
 
-## 预设动机
-{choice.get('motivation', '')}
+            # 只写回这一条分析；数据库不支持局部更新时保存整个状态
+            if not await self._save_choice_analysis(state.story_id, choice_index, analysis):
+                state.dirty = True
+                await self.save_story(state)
+        except (KeyError, TypeError, IndexError) as e:
+            logger.warning(f"Failed to save choice analysis: {e}")
 
-## 预设后果
-{choice.get('potential_consequence', '')}
+    def schedule_background_analysis(self, state: StoryState, choice_index: int) -> asyncio.Task:
+        """
+        在当前事件循环中后台执行选择分析，不阻塞调用方
 
-## 心理维度
-{choice.get('psychological_dimension', '')}
+        需要在长期运行的事件循环中调用；asyncio.run 返回时会取消未完成的任务。
 
-请结合上述**预设的动机和后果提示**，分析用户做出此选择的深层心理原因。
+        Args:
+            state: 故事状态
+            choice_index: 要分析的选择索引
 
-请返回 JSON：
-{{
-    "psychological_analysis": {{
-        "trait_revealed": "揭示的特征",
-        "value_reflected": "反映的价值观",
-        "moral_stance": "道德立场",
-        "decision_style": "决策风格",
-        "confidence": 4
-    }}
-}}
-"""
-        response = await self.invoke_llm(prompt, call_type="story_choice_analysis")
-        
-        try:
-            content = response.content
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            result = json.loads(content)
+        Returns:
+            后台任务
+        """
+        task = asyncio.create_task(self.process_choice_analysis_background(state, choice_index))
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._on_bg_task_done)
+        return task
+
+    def _on_bg_task_done(self, task: asyncio.Task):
+        """后台任务结束：移除引用并记录异常"""
+        self._bg_tasks.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            logger.error(f"Background choice analysis failed: {exc}", exc_info=exc)
 
-            # 更新选择记录
-            state.choices_made[choice_index]["analysis"] = result.get("psychological_analysis", {})
+    async def _save_choice_analysis(
+        self,
+        story_id: str,
+        choice_index: int,
+        analysis: Dict[str, Any]
+    ) -> bool:
+        """
+        用 jsonb_set 在数据库端更新单条选择分析（仅 PostgreSQL）
+
+        Returns:
+            是否已写入；False 表示需要回退到整体保存
+        """
+        @sync_to_async
+        def _save(sid):
+            if connection.vendor != "postgresql" or not sid.isdigit():
+                return False
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"UPDATE {UserStory._meta.db_table} "
+                        "SET current_state = jsonb_set(current_state, %s::text[], %s::jsonb) "
+                        "WHERE id = %s "
+                        # 下标不存在时 jsonb_set 不报错也不修改，需显式排除以便回退到整体保存
+                        "AND jsonb_array_length(current_state->'choices_made') > %s",
+                        [
+                            ["choices_made", str(choice_index), "analysis"],
+                            json.dumps(analysis, ensure_ascii=False),
+                            int(sid),
+                            choice_index
+                        ]
+                    )
+                    return cursor.rowcount > 0
+            except Exception as e:
+                logger.warning(f"Partial analysis update failed (ID: {sid}): {e}")
+                return False
 
-            # 保存更新
-            await self.save_story(state)
-        except (json.JSONDecodeError, KeyError, TypeError, IndexError) as e:
-            logger.warning(f"Failed to parse/save choice analysis: {e}")
+        return await _save(story_id)
 
@@ -0,0 +1,128 @@
+"""
+故事生成缓存 (GenCache)
+
+故事模式的提示词结构固定，只有少数槽位不同（选择文本、紧张度、在场 NPC 等）。
+缓存按 (call_type, 模板键) 分组保存历史响应：
+- 精确命中：槽位文本完全相同，直接复用响应
+- 近似命中：槽位文本的 MinHash 相似度超过阈值，由调用方复用响应并只改写差异字段
+"""
+
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+
+def _shingles(text: str, n: int = 2) -> set:
+    """字符 n-gram（中文文本不依赖分词）"""
+    text = "".join(text.split())
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _minhash(text: str, num_perm: int = 32) -> Tuple[int, ...]:
+    """计算文本的 MinHash 签名"""
+    shingles = _shingles(text)
+    if not shingles:
+        return ()
+
+    signature = []
+    for seed in range(num_perm):
+        salt = seed.to_bytes(2, "little")
+        signature.append(min(
+            int.from_bytes(
+                hashlib.blake2b(s.encode("utf-8"), digest_size=8, salt=salt).digest(),
+                "little"
+            )
+            for s in shingles
+        ))
+    return tuple(signature)
+
+
+def _similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """两个 MinHash 签名的估计 Jaccard 相似度"""
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class GenCache:
+    """结构相似提示词的响应缓存"""
+
+    def __init__(self, maxsize: int = 256, per_template: int = 8, threshold: float = 0.6):
+        """
+        Args:
+            maxsize: 最多缓存的模板键数量（LRU 淘汰）
+            per_template: 每个模板键保留的响应数量
+            threshold: 近似命中的最低相似度
+        """
+        self.maxsize = maxsize
+        self.per_template = per_template
+        self.threshold = threshold
+        self._entries: "OrderedDict[Tuple[str, Hashable], List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(
+        self,
+        call_type: str,
+        template_key: Hashable,
+        slot_text: str,
+        fuzzy: bool = True
+    ) -> Optional[Tuple[Dict[str, Any], bool]]:
+        """
+        查找缓存
+
+        Returns:
+            (响应副本, 是否精确命中)；未命中返回 None
+        """
+        key = (call_type, template_key)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                return None
+            self._entries.move_to_end(key)
+
+            for entry in entries:
+                if entry["slot_text"] == slot_text:
+                    return copy.deepcopy(entry["response"]), True
+
+            if not fuzzy:
+                return None
+
+            signature = _minhash(slot_text)
+            best = max(entries, key=lambda e: _similarity(signature, e["signature"]))
+            if _similarity(signature, best["signature"]) >= self.threshold:
+                return copy.deepcopy(best["response"]), False
+
+        return None
+
+    def store(
+        self,
+        call_type: str,
+        template_key: Hashable,
+        slot_text: str,
+        response: Dict[str, Any]
+    ):
+        """保存响应"""
+        key = (call_type, template_key)
+        entry = {
+            "slot_text": slot_text,
+            "signature": _minhash(slot_text),
+            "response": copy.deepcopy(response)
+        }
+        with self._lock:
+            entries = self._entries.setdefault(key, [])
+            entries[:] = [e for e in entries if e["slot_text"] != slot_text]
+            entries.append(entry)
+            del entries[:-self.per_template]
+
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
@@ -4,8 +4,10 @@ IAMI GraphRAG CLI - 命令行工具
 """
 import os
 import sys
+import atexit
 import asyncio
 import click
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from rich.console import Console
 from rich.table import Table
@@ -14,11 +16,31 @@ from rich.progress import Progress
 # 添加项目路径
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from graphrag.indexer import IAMIDataLoader, IAMIGraphIndexer, IndexConfig
+from graphrag.indexer import IAMIDataLoader, IAMIGraphIndexer, IndexConfig, install_uvloop
 from graphrag.visualizer import IAMIGraphVisualizer
 
 console = Console()
 
+# 同一 CLI 进程内复用事件循环，让 LLM 客户端的连接池在多次调用间保持
+_loop = None
+
+
+def _run(coro):
+    """在共享事件循环上运行协程"""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop.run_until_complete(coro)
+
+
+def _close_loop():
+    if _loop is not None and not _loop.is_closed():
+        _loop.close()
+
+
+atexit.register(_close_loop)
+
 
 @click.group()
 @click.version_option(version="1.0.0")
@@ -29,7 +51,8 @@ def cli():
 
 @cli.command()
 @click.option('--force', is_flag=True, help='强制重建索引')
-def build(force):
+@click.option('--concurrency', type=int, default=None, help='并发插入的批次数（默认使用 IndexConfig.max_concurrency）')
+def build(force, concurrency):
     """构建知识图谱索引"""
     console.print("[bold blue]Building IAMI Knowledge Graph...[/bold blue]\n")
 
@@ -57,13 +80,19 @@ def build(force):
 
         console.print(f"Loaded [bold]{len(documents)}[/bold] documents\n")
 
-        # 索引数据
+        # 索引数据（进度按完成的文档推进剩余的 50%）
         progress.update(task, description="[cyan]Indexing documents...")
+        step = 50 / max(1, len(documents))
 
         async def do_index():
-            return await indexer.index_documents(documents)
-
-        results = asyncio.run(do_index())
+            return await indexer.index_documents(
+                documents,
+                concurrency=concurrency,
+                on_progress=lambda: progress.advance(task, step),
+                force=force
+            )
+
+        results = _run(do_index())
         progress.update(task, completed=100)
 
     # 显示结果
@@ -73,6 +102,7 @@ def build(force):
 
     table.add_row("Total Documents", str(results['total']))
     table.add_row("Success", str(results['success']))
+    table.add_row("Unchanged (skipped)", str(results['skipped']))
     table.add_row("Failed", str(results['failed']))
 
     console.print(table)
@@ -108,7 +138,7 @@ def query(query, mode, top_k):
         return await indexer.query(query, mode=mode, top_k=top_k)
 
     with console.status(f"[bold green]Searching (mode: {mode})..."):
-        result = asyncio.run(do_query())
+        result = _run(do_query())
 
     if result['success']:
         console.print("\n[bold green]Result:[/bold green]\n")
@@ -134,7 +164,7 @@ def stats():
 
     table.add_row("Working Directory", stats['working_dir'])
     table.add_row("Exists", "Yes" if stats['exists'] else "No")
-    table.add_row("Files Count", str(len(stats['files'])))
+    table.add_row("Files Count", str(stats['file_count']))
 
     console.print(table)
 
@@ -142,6 +172,8 @@ def stats():
         console.print("\n[bold]Files:[/bold]")
         for f in stats['files']:
             console.print(f"  - {f}")
+        if stats['file_count'] > len(stats['files']):
+            console.print(f"  ... and {stats['file_count'] - len(stats['files'])} more")
 
 
 @cli.command()
@@ -151,19 +183,20 @@ def visualize(relationships, timeline):
     """生成可视化"""
     viz = IAMIGraphVisualizer()
 
-    if relationships:
-        try:
-            output = viz.visualize_relationships()
-            console.print(f"[green]✓[/green] Relationships: {output}")
-        except Exception as e:
-            console.print(f"[red]✗[/red] Relationships failed: {e}")
+    # 两种图互不依赖（pyvis / plotly 各自生成 HTML），并行生成
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {}
+        if relationships:
+            futures[executor.submit(viz.visualize_relationships)] = "Relationships"
+        if timeline:
+            futures[executor.submit(viz.visualize_timeline)] = "Timeline"
 
-    if timeline:
-        try:
-            output = viz.visualize_timeline()
-            console.print(f"[green]✓[/green] Timeline: {output}")
-        except Exception as e:
-            console.print(f"[red]✗[/red] Timeline failed: {e}")
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                console.print(f"[green]✓[/green] {name}: {future.result()}")
+            except Exception as e:
+                console.print(f"[red]✗[/red] {name} failed: {e}")
 
 
 @cli.command()
@@ -177,12 +210,11 @@ def watch():
 
     # 初始索引
     console.print("Initial indexing...")
-    documents = watcher.loader.load_all_data()
-
     async def do_initial_index():
-        return await watcher.indexer.index_documents(documents)
+        # 边读取边索引，不需要先把全部文档读入内存
+        return await watcher.indexer.index_iter(watcher.loader.iter_all_data())
 
-    results = asyncio.run(do_initial_index())
+    results = _run(do_initial_index())
     console.print(f"Indexed {results['success']} documents\n")
 
     # 启动监控
@@ -193,4 +225,5 @@ def watch():
 
 
 if __name__ == "__main__":
+    install_uvloop()
     cli()
@@ -1,10 +1,12 @@
 """IAMI GraphRAG Indexer"""
 from .data_loader import IAMIDataLoader
-from .graph_indexer import IAMIGraphIndexer, IAMIGraphIndexerSync, IndexConfig
+from .graph_indexer import IAMIGraphIndexer, IAMIGraphIndexerSync, IndexConfig, install_uvloop, run_sync
 
 __all__ = [
     "IAMIDataLoader",
     "IAMIGraphIndexer",
     "IAMIGraphIndexerSync",
-    "IndexConfig"
+    "IndexConfig",
+    "install_uvloop",
+    "run_sync"
 ]
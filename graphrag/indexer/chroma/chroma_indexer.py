@@ -6,14 +6,117 @@ and unstructured content. Works alongside LightRAG for hybrid retrieval.
 """
 
 import os
+import re
 import json
+import hashlib
+import time
+import asyncio
+import functools
+import itertools
+from bisect import bisect_left, bisect_right
 from typing import List, Dict, Any, Optional
 from datetime import datetime
+import numpy as np
 import chromadb
 from chromadb.config import Settings
 from langchain_chroma import Chroma
 from langchain_openai import OpenAIEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from graphrag.indexer.embed_cache import CachedEmbeddings
+
+
+# HNSW index parameters applied when the collection is first created.
+# Existing collections keep the parameters they were built with.
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 100,
+    "hnsw:num_threads": os.cpu_count() or 1,
+}
+
+
+# Batch limits. Chroma reports its own limit when the client supports it;
+# the constant is the fallback. Embedding requests are capped both by input
+# count and by an approximate token budget (one token per character is a
+# conservative upper bound for CJK text).
+MAX_CHROMA_BATCH = 166
+MAX_EMBED_INPUTS = 2048
+MAX_EMBED_TOKENS = 290_000
+
+
+def _embed_shards(texts: List[str]) -> List[List[str]]:
+    """Split texts into embedding requests within the input and token limits."""
+    shards, current, tokens = [], [], 0
+    for text in texts:
+        if current and (len(current) >= MAX_EMBED_INPUTS or tokens + len(text) > MAX_EMBED_TOKENS):
+            shards.append(current)
+            current, tokens = [], 0
+        current.append(text)
+        tokens += len(text)
+    if current:
+        shards.append(current)
+    return shards
+
+
+@functools.lru_cache(maxsize=8)
+def _get_embeddings(model: str, api_base: str, api_key: Optional[str]) -> OpenAIEmbeddings:
+    """Shared OpenAIEmbeddings client per (model, base URL, key)."""
+    kwargs = {"openai_api_key": api_key} if api_key else {}
+    return OpenAIEmbeddings(model=model, openai_api_base=api_base, **kwargs)
+
+
+# Monotonic document IDs: process start time plus a counter, so IDs never
+# collide under concurrent inserts
+_START_NS = time.time_ns()
+_ID_COUNTER = itertools.count()
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}_{_START_NS}_{next(_ID_COUNTER)}"
+
+
+# Chunk break candidates: paragraph/line breaks and CJK/Latin sentence ends
+_SEP_RE = re.compile(r"\n\n|\n|[。！？.!?]")
+
+
+def split_text(text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> List[str]:
+    """
+    Split text into chunks of at most chunk_size characters.
+
+    Break candidates are found in a single regex pass; each chunk ends at the
+    last candidate that fits, and the next chunk starts at the first candidate
+    inside the overlap window. Text with no candidate in range is hard-sliced.
+    """
+    n = len(text)
+    if n <= chunk_size:
+        stripped = text.strip()
+        return [stripped] if stripped else []
+
+    breaks = [m.end() for m in _SEP_RE.finditer(text)]
+    chunks = []
+    start = prev_end = 0
+    while start < n:
+        limit = start + chunk_size
+        if limit >= n:
+            end = n
+        else:
+            # Each chunk must extend past the previous one
+            i = bisect_right(breaks, limit) - 1
+            end = breaks[i] if i >= 0 and breaks[i] > prev_end else limit
+        prev_end = end
+
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= n:
+            break
+
+        # Start the next chunk at a sentence boundary inside the overlap
+        j = bisect_left(breaks, max(end - chunk_overlap, start + 1))
+        start = breaks[j] if j < len(breaks) and breaks[j] < end else end
+
+    return chunks
 
 
 class ChromaDBIndexer:
@@ -55,85 +158,210 @@ class ChromaDBIndexer:
             )
         )
 
-        # Initialize embeddings
-        self.embeddings = OpenAIEmbeddings(
-            model=embedding_model,
-            openai_api_base=os.getenv("OPENAI_API_BASE", "https://api.deepseek.com/v1"),
+        # Initialize embeddings (content-hash cache in front of the API)
+        self.embeddings = CachedEmbeddings(
+            _get_embeddings(
+                embedding_model,
+                os.getenv("OPENAI_API_BASE", "https://api.deepseek.com/v1"),
+                os.getenv("OPENAI_API_KEY")
+            ),
+            cache_path=os.path.join(persist_directory, "embed_cache.sqlite"),
+            model=embedding_model
+        )
+
+        get_max_batch_size = getattr(self.client, "get_max_batch_size", None)
+        self.max_batch_size = get_max_batch_size() if get_max_batch_size else MAX_CHROMA_BATCH
+
+        # Create the collection explicitly so it gets the tuned HNSW parameters;
+        # also used directly for bulk inserts with precomputed embeddings
+        self.collection = self.client.get_or_create_collection(
+            name=collection_name,
+            metadata=HNSW_METADATA
         )
 
         # Initialize LangChain Chroma wrapper
         self.vectorstore = Chroma(
             client=self.client,
             collection_name=collection_name,
-            embedding_function=self.embeddings
+            embedding_function=self.embeddings,
+            collection_metadata=HNSW_METADATA
         )
 
-        # Initialize text splitter
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", "。", "！", "？", ".", "!", "?", " ", ""]
-        )
+        # Text splitter settings
+        self.chunk_size = 1000
+        self.chunk_overlap = 200
 
     async def add_conversation(
         self,
         content: str,
         metadata: Optional[Dict[str, Any]] = None,
-        conversation_id: Optional[str] = None
+        conversation_id: Optional[str] = None,
+        force: bool = False
     ) -> str:
         """
         Add a conversation to the vector store.
 
+        A conversation whose content hash matches the copy already stored
+        under the same ID is skipped, so rebuilds do not re-embed it.
+
         Args:
             content: Conversation content
             metadata: Optional metadata (timestamp, participants, etc.)
             conversation_id: Optional conversation ID
+            force: Re-add even if the stored content is unchanged
 
         Returns:
             Document ID
         """
-        if metadata is None:
-            metadata = {}
+        ids = await self.add_conversations(
+            [{"content": content, "metadata": metadata, "id": conversation_id}],
+            force=force
+        )
+        return ids[0]
 
-        # Add timestamp if not present
-        if "timestamp" not in metadata:
-            metadata["timestamp"] = datetime.now().isoformat()
+    async def add_conversations(
+        self,
+        conversations: List[Dict[str, Any]],
+        force: bool = False
+    ) -> List[str]:
+        """
+        Add many conversations with one batched embed-and-insert.
 
-        # Add document type
-        metadata["doc_type"] = "conversation"
+        Args:
+            conversations: Dicts with "content" and optional "metadata" and "id"
+            force: Re-add conversations whose stored content is unchanged
 
-        # Generate ID if not provided
-        if conversation_id is None:
-            conversation_id = f"conv_{datetime.now().timestamp()}"
+        Returns:
+            One conversation ID per input, in order
+        """
+        hashes = [
+            hashlib.blake2b(conv.get("content", "").encode("utf-8"), digest_size=16).hexdigest()
+            for conv in conversations
+        ]
+
+        # One lookup for every known ID (single-chunk and first-chunk forms)
+        unchanged = set()
+        stale = {}  # conversation ID -> row IDs of its stored version
+        known = {conv["id"]: h for conv, h in zip(conversations, hashes) if conv.get("id") is not None}
+        if known:
+            lookup = list(known) + [f"{conv_id}_chunk_0" for conv_id in known]
+            stored = self.collection.get(ids=lookup, include=["metadatas"])
+            for stored_id, meta in zip(stored["ids"], stored.get("metadatas") or []):
+                meta = meta or {}
+                conv_id = stored_id[:-len("_chunk_0")] if stored_id not in known else stored_id
+                if not force and meta.get("content_hash") == known.get(conv_id):
+                    unchanged.add(conv_id)
+                elif stored_id == conv_id:
+                    stale.setdefault(conv_id, []).append(conv_id)
+                else:
+                    # Every chunk of the old version, whatever the new chunk count
+                    stale.setdefault(conv_id, []).extend(
+                        f"{conv_id}_chunk_{i}" for i in range(meta.get("total_chunks", 1))
+                    )
+
+        # Changed conversations are re-inserted from scratch; drop the old rows
+        # so a shorter or re-chunked version leaves nothing stale behind
+        stale_ids = [
+            row_id
+            for conv_id, row_ids in stale.items() if conv_id not in unchanged
+            for row_id in row_ids
+        ]
+        if stale_ids:
+            self.collection.delete(ids=stale_ids)
+
+        conversation_ids, texts, metadatas, ids = [], [], [], []
+        for conv, content_hash in zip(conversations, hashes):
+            conversation_id = conv.get("id")
+            if conversation_id is not None and conversation_id in unchanged:
+                conversation_ids.append(conversation_id)
+                continue
+
+            content = conv.get("content", "")
+            metadata = dict(conv.get("metadata") or {})
+            metadata["content_hash"] = content_hash
+
+            # Add timestamp if not present
+            if "timestamp" not in metadata:
+                metadata["timestamp"] = datetime.now().isoformat()
+
+            # Add document type
+            metadata["doc_type"] = "conversation"
+
+            # Generate ID if not provided
+            if conversation_id is None:
+                conversation_id = _new_id("conv")
+            conversation_ids.append(conversation_id)
+
+            # Split text if too long
+            chunks = split_text(content, self.chunk_size, self.chunk_overlap)
+
+            if len(chunks) == 1:
+                # Single chunk - stored whole under the conversation ID
+                texts.append(content)
+                metadatas.append(metadata)
+                ids.append(conversation_id)
+            else:
+                total = len(chunks)
+                texts.extend(chunks)
+                metadatas.extend(
+                    {**metadata, "chunk_index": i, "total_chunks": total}
+                    for i in range(total)
+                )
+                ids.extend(f"{conversation_id}_chunk_{i}" for i in range(total))
 
-        # Split text if too long
-        chunks = self.text_splitter.split_text(content)
+        # Embed all chunks of all conversations in one batch and bulk insert
+        await self.add_many(texts=texts, metadatas=metadatas, ids=ids)
+        return conversation_ids
 
-        if len(chunks) == 1:
-            # Single chunk - add directly
-            self.vectorstore.add_texts(
-                texts=[content],
-                metadatas=[metadata],
-                ids=[conversation_id]
-            )
-            return conversation_id
+    async def add_many(
+        self,
+        texts: List[str],
+        metadatas: List[Dict[str, Any]],
+        ids: List[str],
+        batch_size: Optional[int] = None
+    ) -> List[str]:
+        """
+        Bulk-insert documents, bypassing the LangChain wrapper.
+
+        Texts are split into embedding requests within the provider's input
+        and token limits and embedded concurrently, then written to the
+        collection in slices no larger than Chroma's maximum batch size.
+
+        Args:
+            texts: Document texts
+            metadatas: One metadata dict per text
+            ids: One ID per text
+            batch_size: Maximum documents per collection.upsert call
+                (defaults to the client's maximum batch size)
+
+        Returns:
+            The inserted IDs
+        """
+        if not texts:
+            return []
+
+        # float32 matrices straight from the embedding cache; slices are passed
+        # to Chroma without converting back to Python lists
+        shards = _embed_shards(texts)
+        if len(shards) == 1:
+            vectors = await self.embeddings.aembed_matrix(texts)
         else:
-            # Multiple chunks - add with chunk IDs
-            chunk_ids = []
-            for i, chunk in enumerate(chunks):
-                chunk_id = f"{conversation_id}_chunk_{i}"
-                chunk_metadata = metadata.copy()
-                chunk_metadata["chunk_index"] = i
-                chunk_metadata["total_chunks"] = len(chunks)
-
-                self.vectorstore.add_texts(
-                    texts=[chunk],
-                    metadatas=[chunk_metadata],
-                    ids=[chunk_id]
-                )
-                chunk_ids.append(chunk_id)
+            vectors = np.concatenate(await asyncio.gather(
+                *(self.embeddings.aembed_matrix(shard) for shard in shards)
+            ))
+
+        batch_size = min(batch_size or self.max_batch_size, self.max_batch_size)
+        for start in range(0, len(texts), batch_size):
+            end = start + batch_size
+            # upsert so re-added IDs replace their stale text and vectors
+            self.collection.upsert(
+                documents=texts[start:end],
+                embeddings=vectors[start:end],
+                metadatas=metadatas[start:end],
+                ids=ids[start:end]
+            )
 
-            return conversation_id
+        return ids
 
     async def add_memory_snapshot(
         self,
@@ -152,29 +380,73 @@ class ChromaDBIndexer:
             metadata: Additional metadata
 
         Returns:
-            Document ID
+            Document ID (the existing ID if identical content was already added)
         """
-        if metadata is None:
-            metadata = {}
-
-        if timestamp is None:
-            timestamp = datetime.now().isoformat()
-
-        metadata.update({
-            "doc_type": "memory_snapshot",
+        ids = await self.add_memory_snapshots([{
             "memory_type": memory_type,
-            "timestamp": timestamp
-        })
+            "content": content,
+            "timestamp": timestamp,
+            "metadata": metadata
+        }])
+        return ids[0]
+
+    async def add_memory_snapshots(self, snapshots: List[Dict[str, Any]]) -> List[str]:
+        """
+        Add many memory snapshots with one batched embed-and-insert.
 
-        doc_id = f"snapshot_{memory_type}_{timestamp}"
+        Args:
+            snapshots: Dicts with "memory_type", "content" and optional
+                "timestamp" and "metadata"
 
-        self.vectorstore.add_texts(
-            texts=[content],
-            metadatas=[metadata],
-            ids=[doc_id]
+        Returns:
+            One document ID per input, in order (the existing ID for content
+            that was already added)
+        """
+        if not snapshots:
+            return []
+
+        hashes = [
+            hashlib.blake2b(snap.get("content", "").encode("utf-8"), digest_size=16).hexdigest()
+            for snap in snapshots
+        ]
+
+        # Identical snapshot content is already embedded - reuse it
+        existing = {}
+        stored = self.collection.get(
+            where={"content_hash": {"$in": list(dict.fromkeys(hashes))}},
+            include=["metadatas"]
         )
+        for stored_id, meta in zip(stored["ids"], stored.get("metadatas") or []):
+            meta = meta or {}
+            existing.setdefault((meta.get("memory_type"), meta.get("content_hash")), stored_id)
+
+        doc_ids, texts, metadatas, ids = [], [], [], []
+        for snap, content_hash in zip(snapshots, hashes):
+            memory_type = snap["memory_type"]
+            key = (memory_type, content_hash)
+            if key in existing:
+                doc_ids.append(existing[key])
+                continue
+
+            timestamp = snap.get("timestamp") or datetime.now().isoformat()
+            metadata = dict(snap.get("metadata") or {})
+            metadata.update({
+                "doc_type": "memory_snapshot",
+                "memory_type": memory_type,
+                "timestamp": timestamp,
+                "content_hash": content_hash
+            })
 
-        return doc_id
+            # Hash suffix keeps snapshots taken in the same second distinct
+            doc_id = f"snapshot_{memory_type}_{timestamp}_{content_hash[:8]}"
+            existing[key] = doc_id
+            doc_ids.append(doc_id)
+            texts.append(snap.get("content", ""))
+            metadatas.append(metadata)
+            ids.append(doc_id)
+
+        await self.add_many(texts=texts, metadatas=metadatas, ids=ids)
+        return doc_ids
 
     async def search(
         self,
@@ -230,14 +502,19 @@ class ChromaDBIndexer:
         Returns:
             List of documents with content, metadata, and similarity scores
         """
+        # The query embedding and HNSW search are blocking; run them in a
+        # thread so concurrent LightRAG queries are not stalled
         if filter_dict:
-            results = self.vectorstore.similarity_search_with_score(
+            results = await asyncio.to_thread(
+                self.vectorstore.similarity_search_with_score,
                 query,
                 k=k,
                 filter=filter_dict
             )
         else:
-            results = self.vectorstore.similarity_search_with_score(query, k=k)
+            results = await asyncio.to_thread(
+                self.vectorstore.similarity_search_with_score, query, k=k
+            )
 
         formatted_results = []
         for doc, score in results:
@@ -275,11 +552,16 @@ class ChromaDBIndexer:
         """
         try:
             self.client.delete_collection(name=self.collection_name)
-            # Recreate the vectorstore
+            # Recreate the collection and vectorstore
+            self.collection = self.client.get_or_create_collection(
+                name=self.collection_name,
+                metadata=HNSW_METADATA
+            )
             self.vectorstore = Chroma(
                 client=self.client,
                 collection_name=self.collection_name,
-                embedding_function=self.embeddings
+                embedding_function=self.embeddings,
+                collection_metadata=HNSW_METADATA
             )
             return True
         except Exception as e:
@@ -3,243 +3,231 @@ IAMI Data Loader - 加载和预处理记忆数据
 """
 import json
 import glob
+import mmap
 import os
+import time
 from pathlib import Path
-from typing import Dict, List, Any
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 
 class IAMIDataLoader:
     """加载 IAMI 记忆系统的所有数据"""
 
+    # 数据源分派表：(子目录, ((后缀或文件名, 加载方法名), ...))
+    # 以 "." 开头的按后缀匹配，否则按完整文件名匹配；同一目录只扫描一次，
+    # 文档按表中顺序产出
+    _SOURCES = (
+        # 长期记忆（性格、价值观、思维模式等）
+        ("long_term", ((".json", "_load_long_term_file"),)),
+        # 短期记忆
+        ("short_term", ((".json", "_load_short_term_file"),)),
+        # 人际关系网络 JSON 和人物档案 Markdown
+        ("relationships", ((".json", "_load_relationship_file"), (".md", "_load_person_profile"))),
+        # 生态环境系统
+        ("environment", ((".json", "_load_environment_file"),)),
+        # 思想演变时间轴（快照 JSON 和演变记录 Markdown）
+        ("timeline", (("snapshots.json", "_load_snapshots_file"), ("evolution.md", "_load_evolution_file"))),
+        # 对话历史
+        ("conversations", ((".md", "_load_conversation_file"),)),
+    )
+    # 模板文件不作为文档
+    _SKIP_FILES = frozenset({"_template.md"})
+    # 超过该大小的 Markdown 文件用 mmap 读取
+    MMAP_THRESHOLD = 1 << 20
+
     def __init__(self, base_path: str = "./memory"):
         self.base_path = Path(base_path)
 
     def load_all_data(self) -> List[Dict[str, Any]]:
         """加载所有数据源"""
-        documents = []
-
-        # 加载长期记忆
-        documents.extend(self._load_long_term_memory())
-
-        # 加载短期记忆
-        documents.extend(self._load_short_term_memory())
-
-        # 加载人际关系
-        documents.extend(self._load_relationships())
-
-        # 加载环境系统
-        documents.extend(self._load_environment())
-
-        # 加载时间轴
-        documents.extend(self._load_timeline())
-
-        # 加载对话历史
-        documents.extend(self._load_conversations())
-
-        return documents
-
-    def _load_long_term_memory(self) -> List[Dict[str, Any]]:
-        """加载长期记忆（性格、价值观、思维模式等）"""
-        docs = []
-        long_term_path = self.base_path / "long_term"
-
-        if not long_term_path.exists():
-            return docs
-
-        for json_file in long_term_path.glob("*.json"):
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                docs.append({
-                    "id": f"long_term_{json_file.stem}",
-                    "source": str(json_file),
-                    "type": "long_term_memory",
-                    "category": json_file.stem,
-                    "content": json.dumps(data, ensure_ascii=False, indent=2),
-                    "metadata": data,
-                    "timestamp": data.get("last_updated", datetime.now().isoformat())
-                })
-            except Exception as e:
-                print(f"Error loading {json_file}: {e}")
-
-        return docs
-
-    def _load_short_term_memory(self) -> List[Dict[str, Any]]:
-        """加载短期记忆"""
-        docs = []
-        short_term_path = self.base_path / "short_term"
-
-        if not short_term_path.exists():
-            return docs
-
-        for json_file in short_term_path.glob("*.json"):
+        return list(self.iter_all_data())
+
+    def iter_all_data(self, prefetch: int = 32) -> Iterator[Dict[str, Any]]:
+        """
+        逐个产出所有数据源的文档（保持原有顺序）
+
+        文件在线程池中并发读取，但最多只预读 prefetch 个文件，
+        流式索引时不需要一次性把所有文件内容读入内存。
+        """
+        jobs = self._collect_jobs()
+        if not jobs:
+            return
+
+        max_workers = min(32, (os.cpu_count() or 1) * 4, len(jobs))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            for job in jobs:
+                pending.append(executor.submit(self._run_job, job))
+                if len(pending) >= prefetch:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    @staticmethod
+    def _run_job(job: Tuple[Callable[[Path, float], List[Dict[str, Any]]], Path, float]) -> List[Dict[str, Any]]:
+        """读取单个文件，出错时记录并跳过"""
+        load, path, mtime = job
+        try:
+            return load(path, mtime)
+        except Exception as e:
+            print(f"Error loading {path}: {e}")
+            return []
+
+    def _collect_jobs(self) -> List[Tuple[Callable, Path, float]]:
+        """按分派表扫描各数据目录，生成 (加载方法, 路径, mtime) 列表"""
+        jobs = []
+        skip = self._SKIP_FILES
+        for subdir, rules in self._SOURCES:
+            buckets = [[] for _ in rules]
             try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                docs.append({
-                    "id": f"short_term_{json_file.stem}",
-                    "source": str(json_file),
-                    "type": "short_term_memory",
-                    "content": json.dumps(data, ensure_ascii=False, indent=2),
-                    "metadata": data,
-                    "timestamp": data.get("timestamp", datetime.now().isoformat())
-                })
-            except Exception as e:
-                print(f"Error loading {json_file}: {e}")
-
-        return docs
-
-    def _load_relationships(self) -> List[Dict[str, Any]]:
-        """加载人际关系网络"""
-        docs = []
-        rel_path = self.base_path / "relationships"
-
-        if not rel_path.exists():
-            return docs
-
-        # 加载关系网络 JSON
-        for json_file in rel_path.glob("*.json"):
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                docs.append({
-                    "id": f"relationship_{json_file.stem}",
-                    "source": str(json_file),
-                    "type": "relationship_network",
-                    "content": json.dumps(data, ensure_ascii=False, indent=2),
-                    "metadata": data,
-                    "timestamp": data.get("last_updated", datetime.now().isoformat())
-                })
-            except Exception as e:
-                print(f"Error loading {json_file}: {e}")
-
-        # 加载人物档案 Markdown
-        for md_file in rel_path.glob("*.md"):
-            if md_file.name == "_template.md":
+                # os.scandir 在列目录时就带回了文件类型，每个文件只需一次 stat
+                with os.scandir(self.base_path / subdir) as it:
+                    for entry in it:
+                        name = entry.name
+                        if name in skip or not entry.is_file():
+                            continue
+                        for bucket, (pattern, _) in zip(buckets, rules):
+                            if name.endswith(pattern) if pattern[0] == "." else name == pattern:
+                                bucket.append((Path(entry.path), entry.stat().st_mtime))
+                                break
+            except FileNotFoundError:
                 continue
-            try:
-                with open(md_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-
-                docs.append({
-                    "id": f"person_{md_file.stem}",
-                    "source": str(md_file),
-                    "type": "person_profile",
-                    "person_name": md_file.stem,
-                    "content": content,
-                    "metadata": {"name": md_file.stem},
-                    "timestamp": datetime.fromtimestamp(md_file.stat().st_mtime).isoformat()
-                })
-            except Exception as e:
-                print(f"Error loading {md_file}: {e}")
-
-        return docs
-
-    def _load_environment(self) -> List[Dict[str, Any]]:
-        """加载生态环境系统"""
-        docs = []
-        env_path = self.base_path / "environment"
-
-        if not env_path.exists():
-            return docs
-
-        for json_file in env_path.glob("*.json"):
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                docs.append({
-                    "id": f"environment_{json_file.stem}",
-                    "source": str(json_file),
-                    "type": "environment_system",
-                    "category": json_file.stem,
-                    "content": json.dumps(data, ensure_ascii=False, indent=2),
-                    "metadata": data,
-                    "timestamp": data.get("last_updated", datetime.now().isoformat())
-                })
-            except Exception as e:
-                print(f"Error loading {json_file}: {e}")
-
-        return docs
-
-    def _load_timeline(self) -> List[Dict[str, Any]]:
-        """加载思想演变时间轴"""
-        docs = []
-        timeline_path = self.base_path / "timeline"
-
-        if not timeline_path.exists():
-            return docs
-
-        # 加载快照 JSON
-        snapshots_file = timeline_path / "snapshots.json"
-        if snapshots_file.exists():
-            try:
-                with open(snapshots_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                # 为每个快照创建单独的文档
-                snapshots = data.get("snapshots", []) if isinstance(data, dict) else data
-                for i, snapshot in enumerate(snapshots):
-                    docs.append({
-                        "id": f"snapshot_{i}_{snapshot.get('timestamp', '')}",
-                        "source": str(snapshots_file),
-                        "type": "timeline_snapshot",
-                        "content": json.dumps(snapshot, ensure_ascii=False, indent=2),
-                        "metadata": snapshot,
-                        "timestamp": snapshot.get("timestamp", datetime.now().isoformat())
-                    })
-            except Exception as e:
-                print(f"Error loading {snapshots_file}: {e}")
-
-        # 加载演变记录 Markdown
-        evolution_file = timeline_path / "evolution.md"
-        if evolution_file.exists():
-            try:
-                with open(evolution_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-
-                docs.append({
-                    "id": "timeline_evolution",
-                    "source": str(evolution_file),
-                    "type": "timeline_evolution",
-                    "content": content,
-                    "metadata": {},
-                    "timestamp": datetime.fromtimestamp(evolution_file.stat().st_mtime).isoformat()
-                })
-            except Exception as e:
-                print(f"Error loading {evolution_file}: {e}")
-
-        return docs
-
-    def _load_conversations(self) -> List[Dict[str, Any]]:
-        """加载对话历史"""
-        docs = []
-        conv_path = self.base_path / "conversations"
-
-        if not conv_path.exists():
-            return docs
-
-        for md_file in conv_path.glob("*.md"):
-            try:
-                with open(md_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-
-                docs.append({
-                    "id": f"conversation_{md_file.stem}",
-                    "source": str(md_file),
-                    "type": "conversation",
-                    "content": content,
-                    "metadata": {},
-                    "timestamp": datetime.fromtimestamp(md_file.stat().st_mtime).isoformat()
-                })
-            except Exception as e:
-                print(f"Error loading {md_file}: {e}")
-
-        return docs
+
+            for bucket, (_, loader_name) in zip(buckets, rules):
+                load = getattr(self, loader_name)
+                jobs.extend((load, path, mtime) for path, mtime in bucket)
+        return jobs
+
+    @staticmethod
+    def _iso_mtime(mtime: float) -> str:
+        """mtime 转为 ISO 格式本地时间（秒精度），不创建 datetime 对象"""
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(mtime))
+
+    @staticmethod
+    def _read_json(path: Path) -> Tuple[str, Any]:
+        """读取 JSON 文件，返回 (原始文本, 解析结果)；原始文本直接用作文档内容"""
+        raw = path.read_bytes()
+        data = orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+        return raw.decode('utf-8'), data
+
+    @staticmethod
+    def _read_text(path: Path) -> str:
+        """读取文本文件；大于 MMAP_THRESHOLD 的文件通过 mmap 直接解码，不经过中间 bytes"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > IAMIDataLoader.MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return str(mm, 'utf-8')
+            return f.read().decode('utf-8')
+
+    def _load_long_term_file(self, json_file: Path, mtime: float) -> List[Dict[str, Any]]:
+        raw, data = self._read_json(json_file)
+        mtime_iso = self._iso_mtime(mtime)
+        return [{
+            "id": f"long_term_{json_file.stem}",
+            "source": str(json_file),
+            "type": "long_term_memory",
+            "category": json_file.stem,
+            "content": raw,
+            "metadata": data,
+            "timestamp": data.get("last_updated") or mtime_iso
+        }]
+
+    def _load_short_term_file(self, json_file: Path, mtime: float) -> List[Dict[str, Any]]:
+        raw, data = self._read_json(json_file)
+        mtime_iso = self._iso_mtime(mtime)
+        return [{
+            "id": f"short_term_{json_file.stem}",
+            "source": str(json_file),
+            "type": "short_term_memory",
+            "content": raw,
+            "metadata": data,
+            "timestamp": data.get("timestamp") or mtime_iso
+        }]
+
+    def _load_relationship_file(self, json_file: Path, mtime: float) -> List[Dict[str, Any]]:
+        raw, data = self._read_json(json_file)
+        mtime_iso = self._iso_mtime(mtime)
+        return [{
+            "id": f"relationship_{json_file.stem}",
+            "source": str(json_file),
+            "type": "relationship_network",
+            "content": raw,
+            "metadata": data,
+            "timestamp": data.get("last_updated") or mtime_iso
+        }]
+
+    def _load_person_profile(self, md_file: Path, mtime: float) -> List[Dict[str, Any]]:
+        content = self._read_text(md_file)
+        return [{
+            "id": f"person_{md_file.stem}",
+            "source": str(md_file),
+            "type": "person_profile",
+            "person_name": md_file.stem,
+            "content": content,
+            "metadata": {"name": md_file.stem},
+            "timestamp": self._iso_mtime(mtime)
+        }]
+
+    def _load_environment_file(self, json_file: Path, mtime: float) -> List[Dict[str, Any]]:
+        raw, data = self._read_json(json_file)
+        mtime_iso = self._iso_mtime(mtime)
+        return [{
+            "id": f"environment_{json_file.stem}",
+            "source": str(json_file),
+            "type": "environment_system",
+            "category": json_file.stem,
+            "content": raw,
+            "metadata": data,
+            "timestamp": data.get("last_updated") or mtime_iso
+        }]
+
+    def _load_snapshots_file(self, snapshots_file: Path, mtime: float) -> List[Dict[str, Any]]:
+        _, data = self._read_json(snapshots_file)
+        mtime_iso = self._iso_mtime(mtime)
+
+        # 为每个快照创建单独的文档
+        snapshots = data.get("snapshots", []) if isinstance(data, dict) else data
+        return [
+            {
+                "id": f"snapshot_{i}_{snapshot.get('timestamp', '')}",
+                "source": str(snapshots_file),
+                "type": "timeline_snapshot",
+                "content": json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")),
+                "metadata": snapshot,
+                "timestamp": snapshot.get("timestamp") or mtime_iso
+            }
+            for i, snapshot in enumerate(snapshots)
+        ]
+
+    def _load_evolution_file(self, evolution_file: Path, mtime: float) -> List[Dict[str, Any]]:
+        content = self._read_text(evolution_file)
+        return [{
+            "id": "timeline_evolution",
+            "source": str(evolution_file),
+            "type": "timeline_evolution",
+            "content": content,
+            "metadata": {},
+            "timestamp": self._iso_mtime(mtime)
+        }]
+
+    def _load_conversation_file(self, md_file: Path, mtime: float) -> List[Dict[str, Any]]:
+        content = self._read_text(md_file)
+        return [{
+            "id": f"conversation_{md_file.stem}",
+            "source": str(md_file),
+            "type": "conversation",
+            "content": content,
+            "metadata": {},
+            "timestamp": self._iso_mtime(mtime)
+        }]
 
 
 if __name__ == "__main__":
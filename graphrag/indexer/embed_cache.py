@@ -0,0 +1,200 @@
+"""
+Persistent embedding cache
+
+Embeddings are keyed by a SHA-256 of (model, text) and stored in SQLite as
+float32 blobs, so unchanged content is never sent to the embedding API twice.
+"""
+
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from typing import Awaitable, Callable, Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingCache:
+    """SQLite-backed map from content hash to embedding vector."""
+
+    def __init__(self, cache_path: str, model: str = ""):
+        """
+        Args:
+            cache_path: Path of the SQLite database file
+            model: Embedding model name (part of the key, so switching models
+                   never returns stale vectors)
+        """
+        self.cache_path = cache_path
+        self.model = model
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(hash TEXT PRIMARY KEY, dim INT, vec BLOB)"
+        )
+        self._conn.commit()
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Return the cached float32 vectors for the given keys (misses are omitted)."""
+        if not keys:
+            return {}
+
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT hash, vec FROM embeddings WHERE hash IN ({placeholders})",
+                    batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        """Store float32 vectors by key."""
+        if not items:
+            return
+
+        rows = [
+            (key, vec.shape[0], vec.tobytes())
+            for key, vec in items.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, dim, vec) VALUES (?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _as_rows(vectors) -> np.ndarray:
+    """Convert a batch of embeddings to a 2D float32 array."""
+    return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+
+
+def _split_misses(cache: EmbeddingCache, texts: List[str]):
+    """Look up texts; return (keys, cached vectors, unique miss keys, miss texts)."""
+    keys = [cache.key(text) for text in texts]
+    cached = cache.get_many(list(dict.fromkeys(keys)))
+
+    miss_keys, miss_texts = [], []
+    seen = set()
+    for key, text in zip(keys, texts):
+        if key not in cached and key not in seen:
+            seen.add(key)
+            miss_keys.append(key)
+            miss_texts.append(text)
+    return keys, cached, miss_keys, miss_texts
+
+
+class CachedEmbeddings(Embeddings):
+    """LangChain Embeddings adapter that consults an EmbeddingCache first."""
+
+    def __init__(self, embeddings: Embeddings, cache_path: str, model: str = ""):
+        """
+        Args:
+            embeddings: Underlying embeddings (e.g. OpenAIEmbeddings)
+            cache_path: Path of the SQLite cache file
+            model: Embedding model name used in the cache key
+        """
+        self.embeddings = embeddings
+        self.cache = EmbeddingCache(cache_path, model=model)
+
+    def embed_matrix(self, texts: List[str]) -> np.ndarray:
+        """Embed texts into a (len(texts), dim) float32 array."""
+        keys, cached, miss_keys, miss_texts = _split_misses(self.cache, texts)
+        if miss_texts:
+            # Only the misses go to the API, in one batched call
+            fresh = dict(zip(miss_keys, _as_rows(self.embeddings.embed_documents(miss_texts))))
+            self.cache.put_many(fresh)
+            cached.update(fresh)
+        return np.stack([cached[key] for key in keys])
+
+    async def aembed_matrix(self, texts: List[str]) -> np.ndarray:
+        """Async variant of embed_matrix."""
+        keys, cached, miss_keys, miss_texts = _split_misses(self.cache, texts)
+        if miss_texts:
+            fresh = dict(zip(miss_keys, _as_rows(await self.embeddings.aembed_documents(miss_texts))))
+            self.cache.put_many(fresh)
+            cached.update(fresh)
+        return np.stack([cached[key] for key in keys])
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # The LangChain interface expects plain lists
+        return self.embed_matrix(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return (await self.aembed_matrix(texts)).tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+def cached_embedding_func(
+    func: Callable[[List[str]], Awaitable[List[List[float]]]],
+    cache_path: str,
+    model: str = ""
+) -> Callable[[List[str]], Awaitable[np.ndarray]]:
+    """
+    Wrap an async ``texts -> vectors`` function (LightRAG's embedding_func)
+    so cached vectors are reused and only misses are embedded. Duplicate
+    texts within a batch are sent once and fanned back out to every
+    position, and a text already being embedded by a concurrent call is
+    awaited rather than requested again (LightRAG embeds the same entity
+    names from several insert batches at once). The wrapper returns a
+    (len(texts), dim) float32 array.
+    """
+    cache = EmbeddingCache(cache_path, model=model)
+    # key -> future for misses currently being embedded
+    pending: Dict[str, asyncio.Future] = {}
+
+    async def wrapper(texts: List[str]) -> np.ndarray:
+        keys, cached, miss_keys, miss_texts = _split_misses(cache, texts)
+
+        waits = {key: pending[key] for key in miss_keys if key in pending}
+        own_keys = [key for key in miss_keys if key not in waits]
+        own_texts = [text for key, text in zip(miss_keys, miss_texts) if key not in waits]
+
+        if own_keys:
+            loop = asyncio.get_running_loop()
+            futures = {key: loop.create_future() for key in own_keys}
+            pending.update(futures)
+            try:
+                fresh = dict(zip(own_keys, _as_rows(await func(own_texts))))
+                cache.put_many(fresh)
+                cached.update(fresh)
+                for key, future in futures.items():
+                    if not future.done():
+                        future.set_result(fresh[key])
+            except BaseException as e:
+                for future in futures.values():
+                    if not future.done():
+                        future.set_exception(e)
+                        # Mark as retrieved so unobserved failures are not logged
+                        future.exception()
+                raise
+            finally:
+                for key in own_keys:
+                    pending.pop(key, None)
+
+        for key, future in waits.items():
+            # shield: a cancelled waiter must not cancel the owner's future
+            cached[key] = await asyncio.shield(future)
+
+        return np.stack([cached[key] for key in keys])
+
+    return wrapper
@@ -2,39 +2,290 @@
 IAMI Graph Indexer - 使用 LightRAG 构建知识图谱
 """
 import os
+import sys
 import json
+import time
+import atexit
+import random
+import hashlib
+import functools
+import threading
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, List, Dict, Any, Optional, Tuple
 from dataclasses import dataclass
 import asyncio
 
 try:
     from lightrag import LightRAG, QueryParam
+    from lightrag.base import DocStatus
+    from lightrag.utils import compute_mdhash_id
     LIGHTRAG_AVAILABLE = True
 except ImportError:
     LIGHTRAG_AVAILABLE = False
     print("Warning: LightRAG not installed. Install with: pip install lightrag")
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持需要 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 from graphrag.llm_providers import LLMProviderFactory, LLMProviderConfig
+from graphrag.indexer.embed_cache import cached_embedding_func
+
+
+@functools.lru_cache(maxsize=None)
+def _get_async_client(api_key: str, base_url: str):
+    """
+    获取共享的 AsyncOpenAI 客户端
+
+    同一 (api_key, base_url) 在进程内只创建一个客户端，LLM 与 embedding
+    调用共用其连接池，重复创建索引器时也不会重新握手。
+    """
+    import httpx
+    from openai import AsyncOpenAI
+
+    # 显式传入 transport 时 AsyncClient 会忽略自身的 limits/http2，必须设置在 transport 上
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        transport=httpx.AsyncHTTPTransport(
+            retries=2,
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+        )
+    )
+    # 429 / 5xx 的重试由 _call_with_backoff 负责，SDK 自身不再重试，避免重复退避
+    return AsyncOpenAI(
+        api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0
+    )
+
+
+class _RateLimiter:
+    """
+    令牌桶限流：每 period 秒最多 rate 次请求，允许 rate 次的突发
+
+    令牌不足时预支并休眠到令牌补足，读取与更新之间没有 await，
+    因此不需要锁，也不绑定某个事件循环。
+    """
+
+    def __init__(self, rate: int, period: float = 60.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.period)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens * self.period / self.rate)
+
+
+def _retry_delay(error: Exception, attempt: int, base_delay: float) -> float:
+    """优先使用服务端的 Retry-After，否则指数退避加随机抖动"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return base_delay * (2 ** attempt) * (1 + random.random() * 0.25)
+
+
+async def _call_with_backoff(
+    call: Callable[[], Any],
+    limiter: Optional[_RateLimiter],
+    max_retries: int,
+    base_delay: float
+):
+    """限流后调用 API，遇到限流、超时、连接错误或 5xx 时退避重试"""
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+
+    # APITimeoutError 是 APIConnectionError 的子类
+    retryable = (RateLimitError, APIConnectionError, InternalServerError)
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            return await call()
+        except retryable as e:
+            if attempt >= max_retries:
+                raise
+            await asyncio.sleep(_retry_delay(e, attempt, base_delay))
+
+
+def install_uvloop() -> bool:
+    """
+    可用时把 uvloop（Windows 上为 winloop）设为事件循环策略
+
+    只应由入口脚本（CLI、MCP 服务）在创建事件循环之前调用，
+    作为库被导入时不改变宿主程序的事件循环。
+
+    Returns:
+        是否已启用
+    """
+    try:
+        if sys.platform == "win32":
+            import winloop as uvloop
+        else:
+            import uvloop
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
 
 
-@dataclass
+class _LoopThread:
+    """
+    在后台守护线程中常驻运行的事件循环
+
+    同步包装器把协程提交到这里执行，多次调用共用同一个循环，
+    AsyncOpenAI 的 keep-alive 连接因此不会在调用之间被丢弃。
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="iami-indexer-loop", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, coro):
+        """提交协程，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """提交协程并阻塞等待结果"""
+        return self.submit(coro).result()
+
+    def stop(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+_LOOP: Optional[_LoopThread] = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _get_loop_thread() -> _LoopThread:
+    """惰性创建进程内共享的后台事件循环"""
+    global _LOOP
+    if _LOOP is None:
+        with _LOOP_LOCK:
+            if _LOOP is None:
+                _LOOP = _LoopThread()
+    return _LOOP
+
+
+def run_sync(coro):
+    """
+    在进程内共享的后台事件循环中运行协程，阻塞等待并返回结果
+
+    供同步包装器使用：所有调用共用同一个循环，HTTP keep-alive 连接在调用之间保持。
+    """
+    return _get_loop_thread().run(coro)
+
+
+# 进程内共享的 LightRAG 实例，键为 (工作目录, LLM 模型, embedding 模型, base_url, api_key,
+# 每分钟请求上限, 最大重试次数, 退避初始等待)；后三项被闭包进 LLM/embedding 函数，必须参与区分。
+# 值为 (LightRAG 实例, 哈希记录, 哈希记录的锁)：共用实例的索引器也共用哈希记录，
+# 否则各自保存 prepared.json 时会互相覆盖
+_LIGHTRAG_CACHE: Dict[Tuple[Any, ...], Tuple[Any, Dict[str, str], threading.Lock]] = {}
+_LIGHTRAG_LOCK = threading.Lock()
+
+
+def _atomic_write(path: Path, obj: Any):
+    """
+    原子写入 JSON：先写临时文件再 os.replace，崩溃时不会留下半个文件
+
+    有 orjson 时用其编码（比标准库快数倍）。
+    """
+    data = orjson.dumps(obj) if ORJSON_AVAILABLE else json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def _prepare_document_text(doc: Dict[str, Any]) -> str:
+    """准备文档文本用于索引（模块级函数，可在进程池中执行）"""
+    # 文档类型、ID、时间戳、分类、人物名称（仅人物档案），然后是分隔线和内容；
+    # 一次拼接，输出与逐行 join 完全一致，已有的哈希记录仍然有效
+    return (
+        f"[文档类型: {doc.get('type', 'unknown')}]\n"
+        f"[文档ID: {doc.get('id', 'unknown')}]\n"
+        + (f"[时间: {doc['timestamp']}]\n" if 'timestamp' in doc else "")
+        + (f"[分类: {doc['category']}]\n" if 'category' in doc else "")
+        + (f"[人物: {doc['person_name']}]\n"
+           if doc.get('type') == 'person_profile' and 'person_name' in doc else "")
+        + "\n---\n\n"
+        + doc.get('content', '')
+    )
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _prepare_batch(docs: List[Dict[str, Any]]) -> List[Tuple[Optional[str], Optional[str], Optional[str]]]:
+    """批量准备文档文本并计算哈希，返回每个文档的 (文本, 哈希, 错误信息)"""
+    prepared = []
+    for doc in docs:
+        try:
+            text = _prepare_document_text(doc)
+            prepared.append((text, _text_hash(text), None))
+        except Exception as e:
+            prepared.append((None, None, str(e)))
+    return prepared
+
+
+@dataclass(frozen=True)
 class IndexConfig:
-    """索引配置"""
+    """索引配置（不可变，可安全地在多个索引器之间共享；修改请用 dataclasses.replace）"""
     working_dir: str = "./graphrag/storage/index"
     llm_model: str = None  # 从LLMProviderConfig获取
     embedding_model: str = None  # 从LLMProviderConfig获取
     api_base: str = None  # 从LLMProviderConfig获取
     api_key: Optional[str] = None  # 从LLMProviderConfig获取
     llm_config: Optional[LLMProviderConfig] = None  # 完整的LLM配置
+    max_concurrency: int = 16  # 索引时同时进行的插入批次数（混合索引器中为同时处理的文档数）
+    batch_size: int = 100  # 每次 ainsert 传入的文档数
+    requests_per_minute: int = 0  # LLM 与 embedding 请求合计的每分钟上限，0 表示不限速
+    max_retries: int = 5  # 限流、超时或服务端错误时的最大重试次数
+    base_delay: float = 1.0  # 指数退避的初始等待秒数（服务端给出 Retry-After 时以其为准）
+    prep_processes: int = 0  # >0 时用该数量的进程准备文档文本（文档很大时才划算），0 表示在线程池中准备
 
 
 class IAMIGraphIndexer:
     """IAMI 知识图谱索引器"""
 
+    # 批量索引过程中保存哈希记录的最短间隔（秒），结束时总会保存一次
+    PREPARED_FLUSH_INTERVAL = 30.0
+
     def __init__(self, config: IndexConfig):
         self.config = config
         self.rag = None
+        # 已索引文档的 文档ID -> 准备后文本的 sha1，未变化的文档跳过 ainsert；
+        # 记录与其锁在 _init_lightrag 中随 LightRAG 实例一起取得
+        self._prepared_file = Path(config.working_dir) / "prepared.json"
+        self._prepared_cache: Dict[str, str] = {}
+        self._prepared_lock: Optional[threading.Lock] = None
+        # 哈希记录的写入：有未保存的修改时才写，索引过程中最多每 PREPARED_FLUSH_INTERVAL 秒写一次
+        self._prepared_dirty = False
+        self._prepared_flushed = time.monotonic()
+        # get_stats 的缓存：((目录 mtime_ns, limit), 统计结果)
+        self._stats_cache: Optional[Tuple[Tuple[int, int], Dict[str, Any]]] = None
 
         if not LIGHTRAG_AVAILABLE:
             raise ImportError("LightRAG is required. Install with: pip install lightrag")
@@ -45,6 +296,77 @@ class IAMIGraphIndexer:
         # 初始化 LightRAG
         self._init_lightrag()
 
+    def _load_prepared_cache(self) -> Dict[str, str]:
+        """读取已索引文档的哈希记录"""
+        try:
+            raw = self._prepared_file.read_bytes()
+            return orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"Warning: ignoring unreadable {self._prepared_file}: {e}")
+            return {}
+
+    def _save_prepared_cache(self):
+        """保存已索引文档的哈希记录（在锁内取快照，后写入的一定不比先写入的旧）"""
+        with self._prepared_lock:
+            _atomic_write(self._prepared_file, dict(self._prepared_cache))
+
+    async def _flush_prepared_cache(self, force: bool = False):
+        """
+        在线程中保存哈希记录，不阻塞事件循环
+
+        Args:
+            force: 为 False 时，距上次保存不足 PREPARED_FLUSH_INTERVAL 秒则跳过
+        """
+        if not self._prepared_dirty:
+            return
+        now = time.monotonic()
+        if not force and now - self._prepared_flushed < self.PREPARED_FLUSH_INTERVAL:
+            return
+
+        self._prepared_dirty = False
+        self._prepared_flushed = now
+        try:
+            await asyncio.to_thread(self._save_prepared_cache)
+        except OSError as e:
+            self._prepared_dirty = True
+            print(f"Warning: failed to write {self._prepared_file}: {e}")
+
+    @staticmethod
+    def _text_hash(text: str) -> str:
+        return _text_hash(text)
+
+    @staticmethod
+    def _lightrag_doc_id(text: str) -> str:
+        """文档在 LightRAG doc_status 中的 ID（与 LightRAG 默认的内容哈希 ID 规则一致）"""
+        return compute_mdhash_id(text, prefix="doc-")
+
+    async def _doc_errors(self, doc_ids: List[str]) -> Dict[str, Optional[str]]:
+        """
+        查询 LightRAG doc_status，返回 doc_ids 中未处理成功的文档及原因
+
+        LightRAG 的实体抽取失败只记录在 doc_status 中而不抛异常，且存储可能被
+        清空而 prepared.json 仍在，所以哈希记录必须以 doc_status 为准。
+        已处理成功（PROCESSED）的 ID 不出现在返回值中。
+        """
+        statuses = await self.rag.aget_docs_by_ids(list(doc_ids))
+        errors = {}
+        for doc_id in doc_ids:
+            status = statuses.get(doc_id)
+            if status is None:
+                errors[doc_id] = "not found in LightRAG doc_status"
+                continue
+            # 部分存储后端返回原始 dict 而不是 DocProcessingStatus
+            if isinstance(status, dict):
+                value, error_msg = status.get("status"), status.get("error_msg")
+            else:
+                value, error_msg = status.status, getattr(status, "error_msg", None)
+            value = getattr(value, "value", value)
+            if value != DocStatus.PROCESSED.value:
+                errors[doc_id] = error_msg or f"LightRAG status: {value}"
+        return errors
+
     def _init_lightrag(self):
         """初始化 LightRAG 实例"""
 
@@ -59,15 +381,50 @@ class IAMIGraphIndexer:
         os.environ["OPENAI_API_KEY"] = llm_config.api_key
         os.environ["OPENAI_BASE_URL"] = llm_config.base_url
 
+        embedding_model = llm_config.embedding_model or "text-embedding-3-small"
+
+        # 同一工作目录和模型配置在进程内只创建一个 LightRAG 实例
+        # （如 MCP 服务中的 IAMIGraphIndexer 与 HybridIndexer 共用）
+        key = (
+            os.path.abspath(self.config.working_dir),
+            llm_config.model,
+            embedding_model,
+            llm_config.base_url,
+            llm_config.api_key,
+            self.config.requests_per_minute,
+            self.config.max_retries,
+            self.config.base_delay,
+        )
+        with _LIGHTRAG_LOCK:
+            entry = _LIGHTRAG_CACHE.get(key)
+            if entry is None:
+                entry = (
+                    self._create_lightrag(llm_config, embedding_model),
+                    self._load_prepared_cache(),
+                    threading.Lock()
+                )
+                _LIGHTRAG_CACHE[key] = entry
+        self.rag, self._prepared_cache, self._prepared_lock = entry
+
+    def _create_lightrag(self, llm_config: LLMProviderConfig, embedding_model: str):
+        """创建新的 LightRAG 实例"""
+
         # 创建 LLM 和 embedding 函数 (新版 LightRAG 需要)
         from lightrag.utils import EmbeddingFunc
-        from openai import AsyncOpenAI
-        
-        # 创建 OpenAI 客户端
-        async_client = AsyncOpenAI(
-            api_key=llm_config.api_key,
-            base_url=llm_config.base_url
+
+        # 共享的 OpenAI 客户端（带连接池）
+        async_client = _get_async_client(llm_config.api_key, llm_config.base_url)
+
+        # 同一 LightRAG 实例的 LLM 与 embedding 请求共用一个限流器
+        limiter = (
+            _RateLimiter(self.config.requests_per_minute)
+            if self.config.requests_per_minute > 0 else None
         )
+
+        def call_api(call):
+            return _call_with_backoff(
+                call, limiter, self.config.max_retries, self.config.base_delay
+            )
         
         # 创建 LLM 函数
         async def llm_model_func(
@@ -80,21 +437,29 @@ class IAMIGraphIndexer:
             messages.extend(history_messages)
             messages.append({"role": "user", "content": prompt})
             
-            response = await async_client.chat.completions.create(
+            response = await call_api(lambda: async_client.chat.completions.create(
                 model=llm_config.model,
                 messages=messages,
                 **kwargs
-            )
+            ))
             return response.choices[0].message.content
         
         # 创建 embedding 函数
         async def embedding_func(texts: list[str]) -> list[list[float]]:
             """使用 OpenAI 兼容 API 的 embedding 函数"""
-            response = await async_client.embeddings.create(
-                model=llm_config.embedding_model or "text-embedding-3-small",
+            response = await call_api(lambda: async_client.embeddings.create(
+                model=embedding_model,
                 input=texts
-            )
+            ))
             return [item.embedding for item in response.data]
+
+        # 按内容哈希缓存向量，未变化的文本重新索引时不再调用 API；
+        # 同一批中的重复文本（如反复出现的实体名）只请求一次
+        embedding_func = cached_embedding_func(
+            embedding_func,
+            cache_path=os.path.join(self.config.working_dir, "embed_cache.sqlite"),
+            model=embedding_model
+        )
         
         # 包装为 EmbeddingFunc (LightRAG 需要这个包装器)
         embedding_func_wrapper = EmbeddingFunc(
@@ -104,69 +469,193 @@ class IAMIGraphIndexer:
         )
 
         # 初始化 LightRAG (新版 API)
-        self.rag = LightRAG(
+        return LightRAG(
             working_dir=self.config.working_dir,
             llm_model_name=llm_config.model,
             llm_model_func=llm_model_func,  # 需要提供 LLM 函数
             embedding_func=embedding_func_wrapper,
         )
 
-    async def index_documents(self, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """索引文档列表"""
+    async def index_documents(
+        self,
+        documents: List[Dict[str, Any]],
+        concurrency: Optional[int] = None,
+        on_progress: Optional[Callable[[], None]] = None,
+        force: bool = False
+    ) -> Dict[str, Any]:
+        """
+        索引文档列表
+
+        Args:
+            documents: 文档列表
+            concurrency: 同时进行的插入数（嵌入和实体抽取请求并发发送），
+                默认使用 config.max_concurrency
+            on_progress: 每处理完一个文档调用一次（可选）
+            force: 忽略已索引记录，重新插入所有文档
+        """
+        return await self.index_iter(
+            documents, concurrency=concurrency, on_progress=on_progress, force=force
+        )
+
+    async def index_iter(
+        self,
+        documents: Iterable[Dict[str, Any]],
+        concurrency: Optional[int] = None,
+        on_progress: Optional[Callable[[], None]] = None,
+        force: bool = False
+    ) -> Dict[str, Any]:
+        """
+        流式索引文档
+
+        固定数量的 worker 从 documents 中每次取最多 config.batch_size 个文档，
+        以列表形式一次 ainsert，走 LightRAG 的批量插入路径；整批失败时逐个
+        重试以定位出错的文档。同一时刻只有正在处理的批次驻留内存，适合配合
+        IAMIDataLoader.iter_all_data 使用。非列表的可迭代对象在线程池中取下
+        一个文档，避免文件读取阻塞事件循环。准备后文本与上次索引时相同的文档
+        且 LightRAG doc_status 中已处理成功的文档直接跳过（计入 skipped）。
+        插入后同样以 doc_status 为准，抽取失败的文档计入 failed。
+
+        Args:
+            documents: 文档的可迭代对象（列表或生成器）
+            concurrency: 同时进行的插入批次数，默认使用 config.max_concurrency
+            on_progress: 每处理完一个文档调用一次（可选）
+            force: 忽略已索引记录，重新插入所有文档
+        """
         if not self.rag:
             raise RuntimeError("LightRAG not initialized")
 
         results = {
-            "total": len(documents),
+            "total": 0,
             "success": 0,
+            "skipped": 0,
             "failed": 0,
             "errors": []
         }
+        workers = max(1, concurrency or self.config.max_concurrency)
+        batch_size = max(1, self.config.batch_size)
+        iterator = iter(documents)
+        in_memory = isinstance(documents, (list, tuple))
+        next_lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+
+        async def next_doc() -> Optional[Dict[str, Any]]:
+            if in_memory:
+                return next(iterator, None)
+            # 生成器不是线程安全的，一次只允许一个 worker 取文档
+            async with next_lock:
+                return await loop.run_in_executor(None, next, iterator, None)
+
+        def record_error(doc: Dict[str, Any], e: Exception):
+            results["failed"] += 1
+            results["errors"].append({
+                "doc_id": doc.get("id"),
+                "error": str(e)
+            })
+            print(f"Error indexing document {doc.get('id')}: {e}")
+
+        def progress(n: int = 1):
+            if on_progress:
+                for _ in range(n):
+                    on_progress()
+
+        async def next_batch() -> Optional[List[Tuple[Dict[str, Any], str, str, str]]]:
+            """取下一批需要插入的 (文档, 准备后文本, 哈希, LightRAG 文档ID)；没有更多文档时返回 None"""
+            docs = []
+            while len(docs) < batch_size:
+                doc = await next_doc()
+                if doc is None:
+                    break
+                docs.append(doc)
+
+            if not docs:
+                return None
+            results["total"] += len(docs)
+
+            # 文本准备与哈希在执行器中完成，不占用事件循环
+            prepared = await loop.run_in_executor(prep_executor, _prepare_batch, docs)
+
+            candidates = []
+            for doc, (text, text_hash, error) in zip(docs, prepared):
+                if error is not None:
+                    record_error(doc, Exception(error))
+                    progress()
+                    continue
+                candidates.append((doc, text, text_hash, self._lightrag_doc_id(text)))
+
+            # 哈希未变化的文档还要确认 LightRAG 中确实已处理成功才跳过
+            unchanged = set() if force else {
+                lr_id for doc, _, text_hash, lr_id in candidates
+                if self._prepared_cache.get(str(doc.get("id", ""))) == text_hash
+            }
+            not_processed = await self._doc_errors(unchanged) if unchanged else {}
+
+            batch = []
+            for doc, text, text_hash, lr_id in candidates:
+                if lr_id in unchanged and lr_id not in not_processed:
+                    results["skipped"] += 1
+                    progress()
+                    continue
+                batch.append((doc, text, text_hash, lr_id))
+            return batch
+
+        async def insert(batch: List[Tuple[Dict[str, Any], str, str, str]]):
+            """插入一批文档，并按 doc_status 记录每个文档的结果"""
+            # 内容相同的文档在 LightRAG 中是同一个 ID，只插入一次
+            texts = {lr_id: text for _, text, _, lr_id in batch}
+            await self.rag.ainsert(list(texts.values()), ids=list(texts))
+            errors = await self._doc_errors(list(texts))
+            for doc, _, text_hash, lr_id in batch:
+                if lr_id in errors:
+                    record_error(doc, Exception(errors[lr_id]))
+                else:
+                    record_success(doc, text_hash)
+
+        def record_success(doc: Dict[str, Any], text_hash: str):
+            self._prepared_cache[str(doc.get("id", ""))] = text_hash
+            self._prepared_dirty = True
+            results["success"] += 1
+
+        async def worker():
+            while True:
+                batch = await next_batch()
+                if batch is None:
+                    return
+                if not batch:
+                    continue
+
+                try:
+                    # 整批插入到 LightRAG
+                    await insert(batch)
+                except Exception:
+                    # 整批失败时逐个插入，找出出错的文档
+                    for item in batch:
+                        try:
+                            await insert([item])
+                        except Exception as e:
+                            record_error(item[0], e)
+                progress(len(batch))
+
+                # 定期保存进度，中途崩溃时已插入的文档下次不必重做
+                await self._flush_prepared_cache()
+
+        # 进程池需要序列化文档和文本，只有文档很大时才值得开启；默认用线程池
+        prep_executor = (
+            ProcessPoolExecutor(max_workers=self.config.prep_processes)
+            if self.config.prep_processes > 0 else None
+        )
+        try:
+            await asyncio.gather(*(worker() for _ in range(workers)))
+        finally:
+            if prep_executor is not None:
+                prep_executor.shutdown(wait=False, cancel_futures=True)
 
-        for doc in documents:
-            try:
-                # 准备文档文本
-                text = self._prepare_document_text(doc)
-
-                # 插入到 LightRAG
-                await self.rag.ainsert(text)
-
-                results["success"] += 1
-            except Exception as e:
-                results["failed"] += 1
-                results["errors"].append({
-                    "doc_id": doc.get("id"),
-                    "error": str(e)
-                })
-                print(f"Error indexing document {doc.get('id')}: {e}")
+        await self._flush_prepared_cache(force=True)
 
         return results
 
     def _prepare_document_text(self, doc: Dict[str, Any]) -> str:
         """准备文档文本用于索引"""
-        parts = []
-
-        # 添加文档类型和ID
-        parts.append(f"[文档类型: {doc.get('type', 'unknown')}]")
-        parts.append(f"[文档ID: {doc.get('id', 'unknown')}]")
-
-        # 添加时间戳
-        if 'timestamp' in doc:
-            parts.append(f"[时间: {doc['timestamp']}]")
-
-        # 添加分类
-        if 'category' in doc:
-            parts.append(f"[分类: {doc['category']}]")
-
-        # 添加人物名称（如果是人物档案）
-        if doc.get('type') == 'person_profile' and 'person_name' in doc:
-            parts.append(f"[人物: {doc['person_name']}]")
-
-        # 添加内容
-        parts.append("\n---\n")
-        parts.append(doc.get('content', ''))
-
-        return "\n".join(parts)
+        return _prepare_document_text(doc)
 
     async def query(
         self,
@@ -202,46 +691,93 @@ class IAMIGraphIndexer:
         """更新单个文档"""
         try:
             text = self._prepare_document_text(doc)
-            await self.rag.ainsert(text)
+            doc_id = str(doc.get("id", ""))
+            text_hash = self._text_hash(text)
+            lr_id = self._lightrag_doc_id(text)
+            if self._prepared_cache.get(doc_id) == text_hash and not await self._doc_errors([lr_id]):
+                return True
+
+            await self.rag.ainsert(text, ids=[lr_id])
+            errors = await self._doc_errors([lr_id])
+            if errors:
+                print(f"Error updating document {doc.get('id')}: {errors[lr_id]}")
+                return False
+            self._prepared_cache[doc_id] = text_hash
+            self._prepared_dirty = True
+            await self._flush_prepared_cache(force=True)
             return True
         except Exception as e:
             print(f"Error updating document {doc.get('id')}: {e}")
             return False
 
-    def get_stats(self) -> Dict[str, Any]:
-        """获取索引统计信息"""
+    def get_stats(self, limit: int = 50) -> Dict[str, Any]:
+        """
+        获取索引统计信息
+
+        用 os.scandir 一次遍历工作目录，只统计文件数并返回前 limit 个文件名；
+        结果按目录 mtime 缓存，目录内容未变化时不再扫描。
+
+        Args:
+            limit: files 中最多列出的文件名数量
+        """
         working_dir = Path(self.config.working_dir)
 
+        try:
+            mtime_ns = os.stat(working_dir).st_mtime_ns
+        except FileNotFoundError:
+            return {
+                "working_dir": str(working_dir),
+                "exists": False,
+                "file_count": 0,
+                "files": []
+            }
+
+        cached = self._stats_cache
+        if cached is not None and cached[0] == (mtime_ns, limit):
+            return dict(cached[1])
+
+        count = 0
+        files = []
+        with os.scandir(working_dir) as it:
+            for entry in it:
+                count += 1
+                if count <= limit:
+                    files.append(entry.name)
+
         stats = {
             "working_dir": str(working_dir),
-            "exists": working_dir.exists(),
-            "files": []
+            "exists": True,
+            "file_count": count,
+            "files": files
         }
-
-        if working_dir.exists():
-            stats["files"] = [f.name for f in working_dir.iterdir()]
-
-        return stats
+        self._stats_cache = ((mtime_ns, limit), stats)
+        return dict(stats)
 
 
 # 同步包装器
 class IAMIGraphIndexerSync:
-    """同步版本的索引器"""
+    """同步版本的索引器（所有调用提交到共享的后台事件循环，保留 HTTP 连接池）"""
 
     def __init__(self, config: IndexConfig):
         self.indexer = IAMIGraphIndexer(config)
 
+    def _run(self, coro):
+        return run_sync(coro)
+
     def index_documents(self, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
-        return asyncio.run(self.indexer.index_documents(documents))
+        return self._run(self.indexer.index_documents(documents))
 
     def query(self, query: str, mode: str = "hybrid", top_k: int = 5) -> Dict[str, Any]:
-        return asyncio.run(self.indexer.query(query, mode, top_k))
+        return self._run(self.indexer.query(query, mode, top_k))
 
     def update_document(self, doc: Dict[str, Any]) -> bool:
-        return asyncio.run(self.indexer.update_document(doc))
+        return self._run(self.indexer.update_document(doc))
+
+    def get_stats(self, limit: int = 50) -> Dict[str, Any]:
+        return self.indexer.get_stats(limit)
 
-    def get_stats(self) -> Dict[str, Any]:
-        return self.indexer.get_stats()
+    def close(self):
+        """兼容旧接口；共享事件循环在进程退出时停止"""
 
 
 if __name__ == "__main__":
@@ -7,15 +7,31 @@ This module provides intelligent routing between:
 """
 
 import os
+import dataclasses
+import functools
 from typing import List, Dict, Any, Optional
 from pathlib import Path
 import asyncio
 
-from .graph_indexer import IAMIGraphIndexer, IndexConfig
+from .graph_indexer import IAMIGraphIndexer, IndexConfig, run_sync
 from .chroma import ChromaDBIndexer
 from graphrag.llm_providers import LLMProviderFactory, LLMProviderConfig
 
 
+@functools.lru_cache(maxsize=None)
+def _default_config(user_id: str, llm_provider: Optional[str]) -> IndexConfig:
+    """
+    Per-user LightRAG config built from the environment once per process.
+
+    IndexConfig is frozen, so the cached instance can be shared safely.
+    """
+    # 使用统一的LLM配置系统
+    return IndexConfig(
+        working_dir=str(Path(f"data/users/{user_id}") / "graphrag/storage/index"),
+        llm_config=LLMProviderFactory.from_env(llm_provider)
+    )
+
+
 class HybridIndexer:
     """
     Hybrid indexer that intelligently routes documents between
@@ -28,7 +44,7 @@ class HybridIndexer:
     """
 
     # Document types that should use LightRAG
-    LIGHTRAG_TYPES = {
+    LIGHTRAG_TYPES = frozenset({
         "personality",
         "values",
         "thinking_patterns",
@@ -39,14 +55,20 @@ class HybridIndexer:
         "ecological_system",
         "social_identity",
         "timeline_snapshot"
-    }
+    })
 
     # Document types that should use ChromaDB
-    CHROMADB_TYPES = {
+    CHROMADB_TYPES = frozenset({
         "conversation",
         "short_term_memory",
         "notes"
-    }
+    })
+
+    # doc_type -> (use LightRAG, use ChromaDB); unknown types go to both
+    _ROUTING = (
+        {t: (True, False) for t in LIGHTRAG_TYPES}
+        | {t: (False, True) for t in CHROMADB_TYPES}
+    )
 
     def __init__(
         self,
@@ -67,6 +89,9 @@ class HybridIndexer:
             llm_provider: LLM provider name
         """
         self.user_id = user_id
+
+        # Incremented on every ingest; lets query caches detect stale answers
+        self.version = 0
         
         # Set user-specific paths if not provided
         base_user_dir = Path(f"data/users/{user_id}")
@@ -79,15 +104,12 @@ class HybridIndexer:
 
         # Initialize LightRAG
         if lightrag_config is None:
-            # 使用统一的LLM配置系统
-            llm_config = LLMProviderFactory.from_env(llm_provider)
-            lightrag_config = IndexConfig(
-                working_dir=str(base_user_dir / "graphrag/storage/index"),
-                llm_config=llm_config
-            )
+            lightrag_config = _default_config(user_id, llm_provider)
         elif lightrag_config.llm_config is None:
-            # 如果提供了IndexConfig但没有llm_config，则创建
-            lightrag_config.llm_config = LLMProviderFactory.from_env(llm_provider)
+            # 如果提供了IndexConfig但没有llm_config，则创建（IndexConfig 不可变，复制一份）
+            lightrag_config = dataclasses.replace(
+                lightrag_config, llm_config=LLMProviderFactory.from_env(llm_provider)
+            )
 
         self.lightrag_indexer = IAMIGraphIndexer(lightrag_config)
 
@@ -116,72 +138,99 @@ class HybridIndexer:
             "errors": []
         }
 
-        # Route to LightRAG
-        if doc_type in self.LIGHTRAG_TYPES:
-            try:
-                await self.lightrag_indexer.update_document(doc)
-                result["lightrag"] = True
-            except Exception as e:
-                result["errors"].append(f"LightRAG error: {str(e)}")
+        use_lightrag, use_chromadb = self._ROUTING.get(doc_type, (True, True))
+        routes = []
+        tasks = []
 
-        # Route to ChromaDB
-        if doc_type in self.CHROMADB_TYPES:
-            try:
-                metadata = doc.get("metadata", {})
-                metadata["doc_type"] = doc_type
-
-                if "timestamp" in doc:
-                    metadata["timestamp"] = doc["timestamp"]
-
-                if doc_type == "conversation":
-                    await self.chroma_indexer.add_conversation(
-                        content=doc.get("content", ""),
-                        metadata=metadata,
-                        conversation_id=doc.get("id")
-                    )
-                else:
-                    # Generic document
-                    await self.chroma_indexer.add_memory_snapshot(
-                        memory_type=doc_type,
-                        content=doc.get("content", ""),
-                        timestamp=doc.get("timestamp"),
-                        metadata=metadata
-                    )
-
-                result["chromadb"] = True
-            except Exception as e:
-                result["errors"].append(f"ChromaDB error: {str(e)}")
+        if use_lightrag:
+            routes.append(("lightrag", "LightRAG"))
+            tasks.append(self.lightrag_indexer.update_document(doc))
 
-        # For unknown types or important documents, index in both
-        if doc_type not in self.LIGHTRAG_TYPES and doc_type not in self.CHROMADB_TYPES:
-            # Index in both for better coverage
-            try:
-                await self.lightrag_indexer.update_document(doc)
-                result["lightrag"] = True
-            except Exception as e:
-                result["errors"].append(f"LightRAG error: {str(e)}")
+        if use_chromadb:
+            routes.append(("chromadb", "ChromaDB"))
+            tasks.append(self._index_chroma(doc, doc_type))
+
+        # Both backends are independent I/O, so dispatch them together
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        for (key, label), outcome in zip(routes, outcomes):
+            if isinstance(outcome, Exception):
+                result["errors"].append(f"{label} error: {str(outcome)}")
+            else:
+                result[key] = True
+
+        self.version += 1
+        return result
+
+    @staticmethod
+    def _chroma_metadata(doc: Dict[str, Any], doc_type: str) -> Dict[str, Any]:
+        metadata = doc.get("metadata", {})
+        metadata["doc_type"] = doc_type
+
+        if "timestamp" in doc:
+            metadata["timestamp"] = doc["timestamp"]
+        return metadata
+
+    async def _index_chroma(self, doc: Dict[str, Any], doc_type: str):
+        """Write a document to ChromaDB (conversations are chunked, others stored as snapshots)."""
+        metadata = self._chroma_metadata(doc, doc_type)
+
+        if doc_type == "conversation":
+            await self.chroma_indexer.add_conversation(
+                content=doc.get("content", ""),
+                metadata=metadata,
+                conversation_id=doc.get("id")
+            )
+        else:
+            # Generic document
+            await self.chroma_indexer.add_memory_snapshot(
+                memory_type=doc_type,
+                content=doc.get("content", ""),
+                timestamp=doc.get("timestamp"),
+                metadata=metadata
+            )
 
+    @staticmethod
+    async def _add_with_fallback(add_batch, items: List[Dict[str, Any]], docs: List[Dict[str, Any]]):
+        """
+        Insert items with one batched call, retrying each item alone if the
+        batch fails so one bad document (e.g. nested metadata Chroma rejects)
+        only fails itself.
+
+        Returns:
+            (documents that were indexed, error messages)
+        """
+        try:
+            await add_batch(items)
+            return list(docs), []
+        except Exception:
+            pass
+
+        indexed, errors = [], []
+        for item, doc in zip(items, docs):
             try:
-                metadata = doc.get("metadata", {})
-                metadata["doc_type"] = doc_type
-                await self.chroma_indexer.add_memory_snapshot(
-                    memory_type=doc_type,
-                    content=doc.get("content", ""),
-                    timestamp=doc.get("timestamp"),
-                    metadata=metadata
-                )
-                result["chromadb"] = True
+                await add_batch([item])
+                indexed.append(doc)
             except Exception as e:
-                result["errors"].append(f"ChromaDB error: {str(e)}")
-
-        return result
+                errors.append(f"ChromaDB error: {doc.get('id')}: {str(e)}")
+        return indexed, errors
 
-    async def index_documents(self, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+    async def index_documents(
+        self,
+        documents: List[Dict[str, Any]],
+        max_concurrency: Optional[int] = None
+    ) -> Dict[str, Any]:
         """
         Index multiple documents.
 
+        Documents are partitioned by destination first; LightRAG gets one
+        batched index_documents call and ChromaDB one bulk insert each for
+        conversations and snapshots, all three running concurrently. A failed
+        ChromaDB batch is retried one document at a time.
+
         Args:
             documents: List of documents
+            max_concurrency: Maximum number of concurrent LightRAG insert
+                batches (defaults to the LightRAG config's max_concurrency)
 
         Returns:
             Summary of indexing results
@@ -195,21 +244,74 @@ class HybridIndexer:
             "errors": []
         }
 
+        # Partition by destination; unknown types go to both stores
+        lightrag_docs, chroma_convs, chroma_snapshots = [], [], []
+        conv_docs, snapshot_docs = [], []
         for doc in documents:
-            result = await self.index_document(doc)
+            doc_type = doc.get("type", "unknown")
+            use_lightrag, use_chromadb = self._ROUTING.get(doc_type, (True, True))
+
+            if use_lightrag:
+                lightrag_docs.append(doc)
+
+            if not use_chromadb:
+                continue
+            if doc_type == "conversation":
+                conv_docs.append(doc)
+                chroma_convs.append({
+                    "content": doc.get("content", ""),
+                    "metadata": self._chroma_metadata(doc, doc_type),
+                    "id": doc.get("id")
+                })
+            else:
+                snapshot_docs.append(doc)
+                chroma_snapshots.append({
+                    "memory_type": doc_type,
+                    "content": doc.get("content", ""),
+                    "timestamp": doc.get("timestamp"),
+                    "metadata": self._chroma_metadata(doc, doc_type)
+                })
+
+        lightrag_result, conv_result, snapshot_result = await asyncio.gather(
+            self.lightrag_indexer.index_documents(lightrag_docs, concurrency=max_concurrency),
+            self._add_with_fallback(self.chroma_indexer.add_conversations, chroma_convs, conv_docs),
+            self._add_with_fallback(self.chroma_indexer.add_memory_snapshots, chroma_snapshots, snapshot_docs),
+            return_exceptions=True
+        )
+
+        # Map batch outcomes back onto individual documents
+        indexed = {}
+        if isinstance(lightrag_result, BaseException):
+            results["errors"].append(f"LightRAG error: {str(lightrag_result)}")
+        else:
+            failed_ids = {error["doc_id"] for error in lightrag_result["errors"]}
+            for error in lightrag_result["errors"]:
+                results["errors"].append(f"LightRAG error: {error['doc_id']}: {error['error']}")
+            for doc in lightrag_docs:
+                if doc.get("id") not in failed_ids:
+                    indexed.setdefault(id(doc), set()).add("lightrag")
+
+        for outcome in (conv_result, snapshot_result):
+            if isinstance(outcome, BaseException):
+                results["errors"].append(f"ChromaDB error: {str(outcome)}")
+                continue
+            chroma_indexed, chroma_errors = outcome
+            results["errors"].extend(chroma_errors)
+            for doc in chroma_indexed:
+                indexed.setdefault(id(doc), set()).add("chromadb")
 
-            if result["lightrag"] and result["chromadb"]:
+        for doc in documents:
+            stores = indexed.get(id(doc), ())
+            if len(stores) == 2:
                 results["both_count"] += 1
-            elif result["lightrag"]:
+            elif "lightrag" in stores:
                 results["lightrag_count"] += 1
-            elif result["chromadb"]:
+            elif "chromadb" in stores:
                 results["chromadb_count"] += 1
             else:
                 results["failed"] += 1
 
-            if result["errors"]:
-                results["errors"].extend(result["errors"])
-
+        self.version += 1
         return results
 
     async def query(
@@ -240,28 +342,29 @@ class HybridIndexer:
             "errors": []
         }
 
-        # Query LightRAG
+        # Both backends are independent; run them concurrently
+        tasks = {}
         if use_lightrag:
-            try:
-                lightrag_result = await self.lightrag_indexer.query(
-                    query=query,
-                    mode=lightrag_mode,
-                    top_k=chromadb_k
-                )
-                results["lightrag_result"] = lightrag_result
-            except Exception as e:
-                results["errors"].append(f"LightRAG query error: {str(e)}")
-
-        # Query ChromaDB
+            tasks["lightrag"] = self.lightrag_indexer.query(
+                query=query,
+                mode=lightrag_mode,
+                top_k=chromadb_k
+            )
         if use_chromadb:
-            try:
-                chromadb_results = await self.chroma_indexer.search_with_score(
-                    query=query,
-                    k=chromadb_k
-                )
-                results["chromadb_results"] = chromadb_results
-            except Exception as e:
-                results["errors"].append(f"ChromaDB query error: {str(e)}")
+            tasks["chromadb"] = self.chroma_indexer.search_with_score(
+                query=query,
+                k=chromadb_k
+            )
+
+        done = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for key, outcome in zip(tasks, done):
+            label = "LightRAG" if key == "lightrag" else "ChromaDB"
+            if isinstance(outcome, Exception):
+                results["errors"].append(f"{label} query error: {str(outcome)}")
+            elif key == "lightrag":
+                results["lightrag_result"] = outcome
+            else:
+                results["chromadb_results"] = outcome
 
         return results
 
@@ -312,6 +415,36 @@ class HybridIndexer:
         """
         return await self.lightrag_indexer.query(query=query, mode=mode)
 
+    async def rebuild_lightrag(
+        self,
+        documents: List[Dict[str, Any]],
+        force: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Re-index documents into LightRAG only.
+
+        Args:
+            documents: Documents to index
+            force: Re-insert documents even if already indexed
+
+        Returns:
+            LightRAG indexing results
+        """
+        results = await self.lightrag_indexer.index_documents(documents, force=force)
+        self.version += 1
+        return results
+
+    async def reset_chromadb(self) -> bool:
+        """
+        Drop and recreate the ChromaDB collection.
+
+        Returns:
+            True if the collection was reset
+        """
+        success = await self.chroma_indexer.reset_collection()
+        self.version += 1
+        return success
+
     def get_stats(self) -> Dict[str, Any]:
         """
         Get statistics from both indexers.
@@ -343,11 +476,15 @@ class HybridIndexerSync:
             chroma_collection=chroma_collection
         )
 
+    def _run(self, coro):
+        # Reuse one background loop so HTTP connections survive between calls
+        return run_sync(coro)
+
     def index_document(self, doc: Dict[str, Any]) -> Dict[str, Any]:
-        return asyncio.run(self.indexer.index_document(doc))
+        return self._run(self.indexer.index_document(doc))
 
     def index_documents(self, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
-        return asyncio.run(self.indexer.index_documents(documents))
+        return self._run(self.indexer.index_documents(documents))
 
     def query(
         self,
@@ -357,7 +494,7 @@ class HybridIndexerSync:
         lightrag_mode: str = "hybrid",
         chromadb_k: int = 5
     ) -> Dict[str, Any]:
-        return asyncio.run(
+        return self._run(
             self.indexer.query(query, use_lightrag, use_chromadb, lightrag_mode, chromadb_k)
         )
 
@@ -367,14 +504,14 @@ class HybridIndexerSync:
         k: int = 5,
         time_filter: Optional[str] = None
     ) -> List[Dict[str, Any]]:
-        return asyncio.run(self.indexer.query_conversations(query, k, time_filter))
+        return self._run(self.indexer.query_conversations(query, k, time_filter))
 
     def query_structured_memory(
         self,
         query: str,
         mode: str = "hybrid"
     ) -> Dict[str, Any]:
-        return asyncio.run(self.indexer.query_structured_memory(query, mode))
+        return self._run(self.indexer.query_structured_memory(query, mode))
 
     def get_stats(self) -> Dict[str, Any]:
         return self.indexer.get_stats()
@@ -398,20 +535,15 @@ def create_hybrid_indexer(
     Returns:
         HybridIndexer instance
     """
-    base_user_dir = Path(f"data/users/{user_id}")
-    
-    if working_dir is None:
-        working_dir = str(base_user_dir / "graphrag/storage/index")
-        
     if chroma_dir is None:
-        chroma_dir = str(base_user_dir / "memory/vector_store")
+        chroma_dir = str(Path(f"data/users/{user_id}") / "memory/vector_store")
 
-    # 使用统一的LLM配置系统
-    llm_config = LLMProviderFactory.from_env(llm_provider)
-    config = IndexConfig(
-        working_dir=working_dir,
-        llm_config=llm_config
-    )
+    if working_dir is None:
+        config = _default_config(user_id, llm_provider)
+    else:
+        config = dataclasses.replace(
+            _default_config(user_id, llm_provider), working_dir=working_dir
+        )
 
     return HybridIndexer(
         user_id=user_id,
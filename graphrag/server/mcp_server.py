@@ -7,6 +7,7 @@ import os
 import sys
 import json
 import asyncio
+import functools
 from typing import Any, Dict, List
 from pathlib import Path
 
@@ -23,12 +24,149 @@ except ImportError:
     MCP_AVAILABLE = False
     print("Warning: MCP not available. Install with: pip install mcp")
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 from graphrag.indexer.data_loader import IAMIDataLoader
-from graphrag.indexer.graph_indexer import IAMIGraphIndexer, IndexConfig
+from graphrag.indexer.graph_indexer import IAMIGraphIndexer, IndexConfig, install_uvloop
 from graphrag.indexer.hybrid_indexer import HybridIndexer
 from graphrag.agents import AdaptiveRAGAgent
 
 
+def _read_json_sync(path: Path) -> Any:
+    """同步读取并解析 JSON 文件"""
+    raw = path.read_bytes()
+    return orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+
+
+# ChromaDB 位置在导入时从环境变量读取一次
+CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "./memory/vector_store")
+CHROMA_COLLECTION = os.getenv("CHROMA_COLLECTION", "iami_conversations")
+
+
+# 以 MCP 资源形式暴露的 JSON 文件：URI -> (路径, 名称)
+NETWORK_FILE = Path("memory/relationships/network.json")
+SNAPSHOTS_FILE = Path("memory/timeline/snapshots.json")
+PROFILE_FILE = Path("analysis/profile.json")
+_RESOURCES = {
+    "iami://relationships": (NETWORK_FILE, "人际关系网络"),
+    "iami://timeline": (SNAPSHOTS_FILE, "思想演变时间轴"),
+    "iami://profile": (PROFILE_FILE, "综合人物画像"),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _default_config() -> IndexConfig:
+    """从环境变量构建的索引配置，进程内只构建一次（IndexConfig 不可变，可共享）"""
+    return IndexConfig(
+        working_dir=os.getenv("GRAPHRAG_INDEX_DIR", "./graphrag/storage/index"),
+        llm_model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
+        embedding_model=os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"),
+        api_base=os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1"),
+        api_key=os.getenv("DEEPSEEK_API_KEY")
+    )
+
+
+def _pretty(data: Any) -> str:
+    """缩进格式的 JSON 文本；有 orjson 时用其 C 实现编码（输出本身就是 UTF-8，无需 ensure_ascii）"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_cached(path: str, mtime_ns: int) -> Any:
+    """按 (路径, mtime_ns) 缓存解析结果，文件被修改后 mtime 变化即自动失效（调用方不得修改返回值）"""
+    return _read_json_sync(Path(path))
+
+
+@functools.lru_cache(maxsize=8)
+def _pretty_cached(path: str, mtime_ns: int) -> str:
+    """缓存格式化后的 JSON 文本，未修改的文件不必每次重新序列化"""
+    return _pretty(_load_cached(path, mtime_ns))
+
+
+def _build_person_index(data: Any) -> Dict[str, Dict[str, Any]]:
+    """
+    遍历关系网络，按人物名收集相关条目：{人物名: {JSON 路径: 条目}}
+
+    列表中的字符串视为人名；带 name 的字典视为人物条目；
+    带 source/target（或 from/to）的字典视为关系边，同时记到两端人物名下。
+    """
+    index: Dict[str, Dict[str, Any]] = {}
+
+    def add(name, path, entry):
+        if isinstance(name, str) and name:
+            index.setdefault(name, {})[path] = entry
+
+    def walk(node, path):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                walk(value, f"{path}.{key}" if path else key)
+        elif isinstance(node, list):
+            for i, item in enumerate(node):
+                item_path = f"{path}[{i}]"
+                if isinstance(item, str):
+                    add(item, item_path, item)
+                elif isinstance(item, dict):
+                    add(item.get("name"), item_path, item)
+                    for end in ("source", "target", "from", "to"):
+                        add(item.get(end), item_path, item)
+                    walk(item, item_path)
+
+    walk(data, "")
+    return index
+
+
+@functools.lru_cache(maxsize=8)
+def _person_index_cached(path: str, mtime_ns: int) -> Dict[str, Dict[str, Any]]:
+    """缓存关系网络的人物索引，与解析结果使用同一个 (路径, mtime_ns) 键"""
+    return _build_person_index(_load_cached(path, mtime_ns))
+
+
+def _summarize(data: Any) -> str:
+    """只看顶层字段生成简短摘要：列表给出项数，对象给出字段数，标量截断显示"""
+    if isinstance(data, list):
+        return f"- 共 {len(data)} 项\n"
+
+    if not isinstance(data, dict):
+        return f"- {str(data)[:80]}\n"
+
+    lines = []
+    meta = data.get("_meta")
+    if isinstance(meta, dict) and meta.get("description"):
+        lines.append(f"{meta['description']}\n")
+    for key, value in data.items():
+        if key == "_meta":
+            continue
+        if isinstance(value, list):
+            lines.append(f"- {key}: {len(value)} 项")
+        elif isinstance(value, dict):
+            lines.append(f"- {key}: {len(value)} 个字段")
+        else:
+            lines.append(f"- {key}: {str(value)[:80]}")
+    return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=8)
+def _summary_cached(path: str, mtime_ns: int) -> str:
+    return _summarize(_load_cached(path, mtime_ns))
+
+
+async def _read_json_summary(path: Path, uri: str) -> str:
+    """读取 JSON 文件的摘要，并注明完整数据的资源 URI"""
+    summary = await asyncio.to_thread(_summary_cached, str(path), os.stat(path).st_mtime_ns)
+    return f"{summary}\n完整数据见 MCP 资源 `{uri}`（或调用时传 full=true）\n"
+
+
+async def _read_json_pretty(path: Path) -> str:
+    """在线程中读取 JSON 文件并返回缩进格式的文本，避免大文件阻塞事件循环上的其他工具调用"""
+    return await asyncio.to_thread(_pretty_cached, str(path), os.stat(path).st_mtime_ns)
+
+
 class IAMIGraphRAGServer:
     """IAMI GraphRAG MCP 服务器"""
 
@@ -39,34 +177,62 @@ class IAMIGraphRAGServer:
         self.adaptive_agent = None
         self.loader = IAMIDataLoader()
 
-        # 初始化索引器
-        self._init_indexer()
+        # 索引器在第一次需要时才初始化，MCP initialize 不必等待 LightRAG 加载
+        self._init_lock = asyncio.Lock()
+        self._initialized = False
 
-        # 注册工具
+        # 注册工具和资源
         self._register_tools()
-
-    def _init_indexer(self):
-        """初始化 GraphRAG 索引器"""
-        config = IndexConfig(
-            working_dir=os.getenv("GRAPHRAG_INDEX_DIR", "./graphrag/storage/index"),
-            llm_model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
-            embedding_model=os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"),
-            api_base=os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1"),
-            api_key=os.getenv("DEEPSEEK_API_KEY")
-        )
-
-        # 初始化 LightRAG 索引器（向后兼容）
-        self.indexer = IAMIGraphIndexer(config)
-
-        # 初始化混合索引器（LightRAG + ChromaDB）
-        self.hybrid_indexer = HybridIndexer(
-            lightrag_config=config,
-            chroma_persist_dir=os.getenv("CHROMA_PERSIST_DIR", "./memory/vector_store"),
-            chroma_collection=os.getenv("CHROMA_COLLECTION", "iami_conversations")
+        self._register_resources()
+
+    async def _init_indexer_async(self):
+        """初始化 GraphRAG 索引器（构造过程是阻塞 I/O，在线程池中并发执行）"""
+        config = _default_config()
+        loop = asyncio.get_running_loop()
+
+        # LightRAG 索引器（向后兼容）与混合索引器（LightRAG + ChromaDB）同时构造：
+        # 两者共用同一个 LightRAG 实例，ChromaDB 的打开与 LightRAG 的加载可以重叠
+        indexer, hybrid_indexer = await asyncio.gather(
+            loop.run_in_executor(None, IAMIGraphIndexer, config),
+            loop.run_in_executor(None, functools.partial(
+                HybridIndexer,
+                lightrag_config=config,
+                chroma_persist_dir=CHROMA_PERSIST_DIR,
+                chroma_collection=CHROMA_COLLECTION
+            ))
         )
 
         # 初始化自适应 RAG 代理
-        self.adaptive_agent = AdaptiveRAGAgent(self.hybrid_indexer)
+        self.adaptive_agent = await loop.run_in_executor(None, AdaptiveRAGAgent, hybrid_indexer)
+        self.hybrid_indexer = hybrid_indexer
+        self.indexer = indexer
+
+    async def _ensure_initialized(self):
+        """首次调用时初始化索引器（加锁，只初始化一次）"""
+        if self._initialized:
+            return
+        async with self._init_lock:
+            if not self._initialized:
+                await self._init_indexer_async()
+                self._initialized = True
+
+    def _register_resources(self):
+        """把关系网络、时间轴和人物画像注册为 MCP 资源，工具只返回摘要和 URI"""
+
+        @self.server.list_resources()
+        async def handle_list_resources() -> list[types.Resource]:
+            return [
+                types.Resource(uri=uri, name=name, mimeType="application/json")
+                for uri, (path, name) in _RESOURCES.items()
+                if path.exists()
+            ]
+
+        @self.server.read_resource()
+        async def handle_read_resource(uri) -> str:
+            entry = _RESOURCES.get(str(uri))
+            if entry is None or not entry[0].exists():
+                raise ValueError(f"Unknown resource: {uri}")
+            return await _read_json_pretty(entry[0])
 
     def _register_tools(self):
         """注册 MCP 工具"""
@@ -123,6 +289,11 @@ class IAMIGraphRAGServer:
                             "person_name": {
                                 "type": "string",
                                 "description": "特定人物名称（可选）"
+                            },
+                            "full": {
+                                "type": "boolean",
+                                "description": "返回完整 JSON（默认只返回摘要和资源 URI）",
+                                "default": False
                             }
                         }
                     }
@@ -140,6 +311,11 @@ class IAMIGraphRAGServer:
                             "end_date": {
                                 "type": "string",
                                 "description": "结束日期（可选，ISO格式）"
+                            },
+                            "full": {
+                                "type": "boolean",
+                                "description": "返回完整 JSON（默认只返回摘要和资源 URI）",
+                                "default": False
                             }
                         }
                     }
@@ -149,7 +325,13 @@ class IAMIGraphRAGServer:
                     description="获取用户的综合人物画像。包括性格、价值观、思维模式等核心特征。",
                     inputSchema={
                         "type": "object",
-                        "properties": {}
+                        "properties": {
+                            "full": {
+                                "type": "boolean",
+                                "description": "返回完整 JSON（默认只返回摘要和资源 URI）",
+                                "default": False
+                            }
+                        }
                     }
                 ),
                 types.Tool(
@@ -244,6 +426,7 @@ class IAMIGraphRAGServer:
 
     async def _handle_query(self, args: dict) -> list[types.TextContent]:
         """处理查询请求"""
+        await self._ensure_initialized()
         query = args.get("query", "")
         mode = args.get("mode", "hybrid")
         top_k = args.get("top_k", 5)
@@ -259,18 +442,22 @@ class IAMIGraphRAGServer:
 
     async def _handle_rebuild_index(self, args: dict) -> list[types.TextContent]:
         """处理重建索引请求"""
+        await self._ensure_initialized()
         force = args.get("force", False)
 
         # 加载所有文档
         documents = self.loader.load_all_data()
 
         # 索引文档
-        results = await self.indexer.index_documents(documents)
+        # force 为 True 时忽略哈希记录，全部重新插入；
+        # 经由混合索引器写入，使其版本号递增，自适应查询的答案缓存随之失效
+        results = await self.hybrid_indexer.rebuild_lightrag(documents, force=force)
 
         response = f"""# 索引重建完成
 
 - 总文档数: {results['total']}
 - 成功: {results['success']}
+- 未变化（跳过）: {results['skipped']}
 - 失败: {results['failed']}
 
 """
@@ -286,7 +473,7 @@ class IAMIGraphRAGServer:
         person_name = args.get("person_name")
 
         # 读取关系网络文件
-        network_file = Path("memory/relationships/network.json")
+        network_file = NETWORK_FILE
 
         if not network_file.exists():
             return [types.TextContent(
@@ -294,23 +481,33 @@ class IAMIGraphRAGServer:
                 text="关系网络文件不存在"
             )]
 
-        with open(network_file, 'r', encoding='utf-8') as f:
-            network_data = json.load(f)
-
         if person_name:
-            # 查询特定人物
+            # 查询特定人物：只返回与该人物相关的条目
+            index = await asyncio.to_thread(
+                _person_index_cached, str(network_file), os.stat(network_file).st_mtime_ns
+            )
+            entries = index.get(person_name)
+            if not entries:
+                return [types.TextContent(
+                    type="text",
+                    text=f"关系网络中未找到 {person_name}"
+                )]
+
             response = f"# {person_name} 的关系信息\n\n"
-            response += json.dumps(network_data, ensure_ascii=False, indent=2)
+            response += _pretty(entries)
         else:
             # 返回整个网络概览
             response = "# 人际关系网络\n\n"
-            response += json.dumps(network_data, ensure_ascii=False, indent=2)
+            if args.get("full"):
+                response += await _read_json_pretty(network_file)
+            else:
+                response += await _read_json_summary(network_file, "iami://relationships")
 
         return [types.TextContent(type="text", text=response)]
 
     async def _handle_get_timeline(self, args: dict) -> list[types.TextContent]:
         """处理获取时间轴请求"""
-        snapshots_file = Path("memory/timeline/snapshots.json")
+        snapshots_file = SNAPSHOTS_FILE
 
         if not snapshots_file.exists():
             return [types.TextContent(
@@ -318,17 +515,17 @@ class IAMIGraphRAGServer:
                 text="时间轴文件不存在"
             )]
 
-        with open(snapshots_file, 'r', encoding='utf-8') as f:
-            timeline_data = json.load(f)
-
         response = "# 思想演变时间轴\n\n"
-        response += json.dumps(timeline_data, ensure_ascii=False, indent=2)
+        if args.get("full"):
+            response += await _read_json_pretty(snapshots_file)
+        else:
+            response += await _read_json_summary(snapshots_file, "iami://timeline")
 
         return [types.TextContent(type="text", text=response)]
 
     async def _handle_get_profile(self, args: dict) -> list[types.TextContent]:
         """处理获取人物画像请求"""
-        profile_file = Path("analysis/profile.json")
+        profile_file = PROFILE_FILE
 
         if not profile_file.exists():
             return [types.TextContent(
@@ -336,33 +533,37 @@ class IAMIGraphRAGServer:
                 text="人物画像文件不存在"
             )]
 
-        with open(profile_file, 'r', encoding='utf-8') as f:
-            profile_data = json.load(f)
-
         response = "# 综合人物画像\n\n"
-        response += json.dumps(profile_data, ensure_ascii=False, indent=2)
+        if args.get("full"):
+            response += await _read_json_pretty(profile_file)
+        else:
+            response += await _read_json_summary(profile_file, "iami://profile")
 
         return [types.TextContent(type="text", text=response)]
 
     async def _handle_index_stats(self, args: dict) -> list[types.TextContent]:
         """处理获取索引统计请求"""
+        await self._ensure_initialized()
         stats = self.indexer.get_stats()
 
         response = f"""# 索引统计信息
 
 - 工作目录: {stats['working_dir']}
 - 存在: {stats['exists']}
-- 文件数: {len(stats['files'])}
+- 文件数: {stats['file_count']}
 
 ## 文件列表:
 """
         for f in stats['files']:
             response += f"- {f}\n"
+        if stats['file_count'] > len(stats['files']):
+            response += f"- ……另有 {stats['file_count'] - len(stats['files'])} 个文件\n"
 
         return [types.TextContent(type="text", text=response)]
 
     async def _handle_adaptive_query(self, args: dict) -> list[types.TextContent]:
         """处理自适应查询请求"""
+        await self._ensure_initialized()
         query = args.get("query", "")
 
         if not self.adaptive_agent:
@@ -411,6 +612,7 @@ class IAMIGraphRAGServer:
 
     async def _handle_index_hybrid(self, args: dict) -> list[types.TextContent]:
         """处理混合索引请求"""
+        await self._ensure_initialized()
         doc_type = args.get("doc_type", "")
         content = args.get("content", "")
         metadata = args.get("metadata", {})
@@ -488,4 +690,5 @@ async def main():
 
 
 if __name__ == "__main__":
+    install_uvloop()
     asyncio.run(main())
@@ -156,7 +156,7 @@ async def test_hybrid_indexer():
     print(f"\n➤ 统计信息:")
     print(f"  LightRAG:")
     print(f"  - 工作目录: {stats['lightrag']['working_dir']}")
-    print(f"  - 文件数: {len(stats['lightrag'].get('files', []))}")
+    print(f"  - 文件数: {stats['lightrag'].get('file_count', 0)}")
     print(f"  ChromaDB:")
     print(f"  - 集合: {stats['chromadb']['collection_name']}")
     print(f"  - 文档数: {stats['chromadb']['document_count']}")
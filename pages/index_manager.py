@@ -52,7 +52,7 @@ def show_index_stats(indexer):
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            file_count = len(lightrag_stats.get("files", []))
+            file_count = lightrag_stats.get("file_count", 0)
             st.markdown(f'''
                 <div class="stats-card">
                     <div class="stats-number">{file_count}</div>
@@ -146,7 +146,7 @@ def manage_index(indexer):
 
                     # 使用 LightRAG 索引器
                     results = asyncio.run(
-                        st.session_state.indexer.lightrag_indexer.index_documents(documents)
+                        st.session_state.indexer.rebuild_lightrag(documents, force=True)
                     )
 
                     st.success("◈ 知识图谱索引重建完成")
@@ -163,7 +163,7 @@ def manage_index(indexer):
                 try:
                     # 清空现有集合
                     await_result = asyncio.run(
-                        st.session_state.indexer.chroma_indexer.reset_collection()
+                        st.session_state.indexer.reset_chromadb()
                     )
 
                     if await_result:
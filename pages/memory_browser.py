@@ -299,7 +299,7 @@ def show_stories():
                         st.markdown(f"**背景**: {full_story.setting.get('world', '')}")
                         
                         st.markdown("### 章节回顾")
-                        for scene in full_story.scenes:
+                        for scene in full_story.scenes[:1] + full_story.scene_summaries + full_story.scenes[1:]:
                             st.text(f"第 {scene['scene_number']+1} 章: {scene['title']}")
                 except Exception as e:
                     st.error(f"加载详情失败: {e}")
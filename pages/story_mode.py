@@ -8,9 +8,9 @@
 import asyncio
 import streamlit as st
 import json
+import time
 import threading
 import concurrent.futures
-from datetime import datetime
 
 # 后台线程池
 _executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
@@ -198,7 +198,7 @@ def show_story_start(agent):
 
         from graphrag.agents import StoryGenre
 
-        genre_options = ["随机生成"] + StoryGenre.all_genres()
+        genre_options = ["随机生成", *StoryGenre.all_genres()]
 
         selected_genre = st.selectbox(
             "故事类型",
@@ -293,9 +293,10 @@ def show_ongoing_story(agent):
     # 1. 历史回顾 (折叠显示)
     if len(story.scenes) > 0:
         with st.expander("◈ 查看故事历程", expanded=False):
-            for scene in story.scenes:
+            # 早期章节只保留摘要（开场场景始终完整保留在最前面）
+            for scene in story.scenes[:1] + story.scene_summaries + story.scenes[1:]:
                 st.markdown(f"### 第 {scene['scene_number']} 章: {scene['title']}")
-                st.markdown(scene['description'])
+                st.markdown(scene.get('description', '（早期章节仅保留摘要）'))
                 st.markdown("---")
 
     # 2. 上一个选择的后果 (作为衔接)
@@ -405,9 +406,9 @@ def handle_choice(agent, story, choice, scene_data):
             "description": scene_data['description'],
             "environment": scene_data.get('environment_details', ''),
             "mood": scene_data.get('character_emotions', ''),
-            "timestamp": datetime.now().isoformat()
+            "ts_ns": time.time_ns()
         }
-        story.scenes.append(new_scene)
+        story.record_scene(new_scene, scene_data.get('story_triples'))
         story.current_scene = scene_data['scene_number']
         
         # 2. 获取下一场景数据（优先使用预加载）
@@ -432,9 +433,9 @@ def handle_choice(agent, story, choice, scene_data):
             "consequence": next_scene_data.get('immediate_consequence', '你的行动产生了意想不到的影响。'),
             "npc_reactions": next_scene_data.get('npc_reactions', {}),
             "analysis": {}, # 后台深度分析会填充此项
-            "timestamp": datetime.now().isoformat()
+            "ts_ns": time.time_ns()
         }
-        story.choices_made.append(choice_record)
+        story.record_choice(choice_record)
         
         # 4. 更新世界状态
         world_changes = next_scene_data.get('world_state_changes', {})
@@ -586,9 +587,9 @@ def show_story_ending(agent):
             export_text += f"**类型**: {story.genre}\n\n"
             export_text += "---\n\n"
 
-            for scene in story.scenes:
+            for scene in story.scenes[:1] + story.scene_summaries + story.scenes[1:]:
                 export_text += f"## 第 {scene['scene_number'] + 1} 章\n\n"
-                export_text += f"{scene['description']}\n\n"
+                export_text += f"{scene.get('description', scene.get('title', ''))}\n\n"
 
                 # 找到这个场景的选择
                 choices = [c for c in story.choices_made if c['scene_number'] == scene['scene_number']]